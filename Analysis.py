@@ -0,0 +1,460 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import hashlib
+import math
+import os
+import shutil
+import struct
+import subprocess
+import threading
+from collections import OrderedDict, deque, namedtuple
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+from FileHash import partialHash
+from Instrumentation import recorder, span
+
+SAMPLE_RATE = 48000
+CHANNELS = 2
+# Loudness is measured on 100 ms blocks, four of them make the 400 ms gating block of BS.1770
+BLOCK_FRAMES = SAMPLE_RATE // 10
+BLOCK_BYTES = BLOCK_FRAMES * CHANNELS * 2
+READ_BYTES = BLOCK_BYTES * 50
+WAVEFORM_POINTS = 256
+ABSOLUTE_GATE = -70.0
+RELATIVE_GATE = -10.0
+# ReplayGain 2.0 plays everything as loud as a -18 LUFS track
+REFERENCE_LOUDNESS = -18.0
+MAX_GAIN_DB = 12.0
+# K-weighting of ITU-R BS.1770 at 48 kHz, (b, a) of the high shelf and the high pass
+K_FILTERS = (((1.53512485958697, -2.69169618940638, 1.19839281085285), (1.0, -1.69065929318241, 0.73248077421585)),
+             ((1.0, -2.0, 1.0), (1.0, -1.99004745483398, 0.99007225036621)))
+
+CACHE_MAGIC = b'TQAN'
+CACHE_VERSION = 1
+CACHE_HEADER = struct.Struct('<4sHH')
+# content hash, stat key, loudness (NaN when unknown), duration in ms, then the peak and RMS columns
+RECORD = struct.Struct('<16s8sfI')
+RECORD_SIZE = RECORD.size + 2 * WAVEFORM_POINTS
+PROGRESS_EVERY = 50
+
+TrackAnalysis = namedtuple('TrackAnalysis', 'loudness duration peaks rms')
+
+
+def analysisAvailable():
+    return numpy is not None and shutil.which('ffmpeg') is not None
+
+
+def replayGain(loudness):
+    """ Linear volume factor that brings a track of the given integrated loudness to the reference. """
+    if loudness is None:
+        return 1.0
+    return 10 ** (max(-MAX_GAIN_DB, min(MAX_GAIN_DB, REFERENCE_LOUDNESS - loudness)) / 20)
+
+
+# Decoding and measuring, run in worker processes
+
+def lowerPriority():
+    # Analysis may run all night, it must never take the CPU from playback
+    if hasattr(os, 'nice'):
+        os.nice(10)
+
+
+def decode(path):
+    """ Yield the track as 48 kHz stereo 16 bit PCM, decoded by ffmpeg. """
+    process = subprocess.Popen(['ffmpeg', '-nostdin', '-v', 'error', '-i', path, '-map', '0:a:0', '-f', 's16le',
+                                '-acodec', 'pcm_s16le', '-ac', str(CHANNELS), '-ar', str(SAMPLE_RATE), '-'],
+                               stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+    try:
+        for chunk in iter(lambda: process.stdout.read(READ_BYTES), b''):
+            yield chunk
+    finally:
+        process.stdout.close()
+        process.kill()
+        process.wait()
+
+
+def kWeighting(size):
+    """ Squared K-weighting response at the rfft bins of size samples, scaled so that summing the weighted
+    power spectrum gives the mean square of the filtered block (Parseval). """
+    delay = numpy.exp(-2j * numpy.pi * numpy.fft.rfftfreq(size))
+    response = numpy.ones(len(delay))
+    for b, a in K_FILTERS:
+        response *= numpy.abs((b[0] + b[1] * delay + b[2] * delay ** 2) / (a[0] + a[1] * delay + a[2] * delay ** 2)) ** 2
+    # Bins other than DC and Nyquist stand for their negative frequency twin as well
+    response[1:(size + 1) // 2] *= 2
+    return response / (size * size)
+
+
+def analyzePcm(chunks):
+    """ TrackAnalysis of 16 bit stereo PCM chunks, None when there was no audio.
+
+    The K-weighting filter is applied in the frequency domain to each 100 ms block at once, which
+    only differs from the time domain filter at block edges, well below 0.1 LU on music.
+    """
+    weights = kWeighting(BLOCK_FRAMES)[:, None]
+    peaks = []
+    squares = []
+    energies = []
+    pending = b''
+    frames = 0
+
+    def measure(data, complete):
+        samples = numpy.frombuffer(data, '<i2').reshape(-1, BLOCK_FRAMES, CHANNELS).astype(numpy.float32) / 32768
+        peaks.append(numpy.abs(samples).max(axis=(1, 2)))
+        squares.append((samples * samples).mean(axis=(1, 2)))
+        if complete:
+            spectrum = numpy.fft.rfft(samples, axis=1)
+            power = spectrum.real ** 2 + spectrum.imag ** 2
+            # Channel weights are 1 for left and right
+            energies.append((power * weights).sum(axis=(1, 2)))
+
+    for chunk in chunks:
+        frames += len(chunk) // (CHANNELS * 2)
+        data = pending + chunk if pending else chunk
+        usable = len(data) - len(data) % BLOCK_BYTES
+        if usable:
+            measure(data[:usable], True)
+        pending = data[usable:]
+    if pending:
+        # The incomplete last block is drawn but, as in BS.1770, not measured
+        pending = pending[:len(pending) - len(pending) % (CHANNELS * 2)]
+        measure(pending + bytes(BLOCK_BYTES - len(pending)), False)
+    if not frames:
+        return None
+    peaks = numpy.concatenate(peaks)
+    squares = numpy.concatenate(squares)
+    loudness = integratedLoudness(numpy.concatenate(energies)) if energies else None
+    peakColumns, rmsColumns = waveform(peaks, squares)
+    return TrackAnalysis(loudness, frames * 1000 // SAMPLE_RATE, peakColumns, rmsColumns)
+
+
+def integratedLoudness(energies):
+    """ Gated integrated loudness in LUFS of 100 ms block energies, None for silence or short tracks. """
+    if len(energies) < 4:
+        return None
+    blocks = (energies[:-3] + energies[1:-2] + energies[2:-1] + energies[3:]) / 4
+    blocks = blocks[blocks > 10 ** ((ABSOLUTE_GATE + 0.691) / 10)]
+    if not len(blocks):
+        return None
+    relative = -0.691 + 10 * math.log10(blocks.mean()) + RELATIVE_GATE
+    blocks = blocks[blocks > 10 ** ((relative + 0.691) / 10)]
+    return -0.691 + 10 * math.log10(blocks.mean())
+
+
+def waveform(peaks, squares):
+    """ Peak and RMS of the blocks reduced to WAVEFORM_POINTS columns, as bytes scaled to 0-255. """
+    edges = numpy.arange(WAVEFORM_POINTS + 1) * len(peaks) // WAVEFORM_POINTS
+    starts = numpy.minimum(edges[:-1], len(peaks) - 1)
+    counts = numpy.maximum(1, numpy.diff(edges))
+    peakColumns = numpy.maximum.reduceat(peaks, starts)
+    rmsColumns = numpy.sqrt(numpy.add.reduceat(squares, starts) / counts)
+    # reduceat sums up to the next start, which is the wrong count where columns share a block
+    rmsColumns = numpy.where(numpy.diff(edges) > 0, rmsColumns, numpy.sqrt(squares[starts]))
+    return (numpy.clip(peakColumns * 255, 0, 255).astype(numpy.uint8).tobytes(),
+            numpy.clip(rmsColumns * 255, 0, 255).astype(numpy.uint8).tobytes())
+
+
+def analyzeFile(path):
+    try:
+        return analyzePcm(decode(path))
+    except (OSError, ValueError):
+        return None
+
+
+# Cache
+
+def statKey(path, stat):
+    text = '%s\0%d\0%d' % (path, stat.st_mtime_ns, stat.st_size)
+    return hashlib.blake2b(text.encode('utf-8', 'surrogateescape'), digest_size=8).digest()
+
+
+class AnalysisCache(object):
+    """ Fixed size records of the analyzed tracks in one append-only file, keyed by content hash.
+
+    Only a stat key (path, mtime, size) to record dictionary is kept in memory. A file that moved or
+    was touched is found again by its content hash, and gets a record under its new stat key. The
+    content hashes are only loaded while a whole library is worked through, single lookups scan the
+    file instead. Not thread safe, the Analyzer owns it.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.records = {}
+        self.hashes = None
+        self.count = 0
+        self.file = None
+        self.open()
+
+    def open(self):
+        try:
+            self.file = open(self.path, 'r+b')
+        except FileNotFoundError:
+            self.file = open(self.path, 'w+b')
+        data = self.file.read()
+        if len(data) < CACHE_HEADER.size or \
+                CACHE_HEADER.unpack_from(data, 0) != (CACHE_MAGIC, CACHE_VERSION, WAVEFORM_POINTS):
+            # A different format, start over
+            self.file.seek(0)
+            self.file.truncate()
+            self.file.write(CACHE_HEADER.pack(CACHE_MAGIC, CACHE_VERSION, WAVEFORM_POINTS))
+            self.file.flush()
+            return
+        # A record cut short by a crash is dropped
+        self.count = (len(data) - CACHE_HEADER.size) // RECORD_SIZE
+        self.file.truncate(CACHE_HEADER.size + self.count * RECORD_SIZE)
+        for index in range(self.count):
+            offset = CACHE_HEADER.size + index * RECORD_SIZE + 16
+            self.records[data[offset:offset + 8]] = index
+
+    def close(self):
+        self.file.close()
+
+    def read(self, index):
+        with span('read analysis.cache', RECORD_SIZE):
+            self.file.seek(CACHE_HEADER.size + index * RECORD_SIZE)
+            data = self.file.read(RECORD_SIZE)
+        contentHash, _, loudness, duration = RECORD.unpack_from(data, 0)
+        peaks = data[RECORD.size:RECORD.size + WAVEFORM_POINTS]
+        return contentHash, TrackAnalysis(None if math.isnan(loudness) else loudness, duration, peaks,
+                                          data[RECORD.size + WAVEFORM_POINTS:])
+
+    def get(self, key):
+        index = self.records.get(key)
+        return self.read(index)[1] if index is not None else None
+
+    def loadHashes(self):
+        self.file.seek(0)
+        data = self.file.read()
+        self.hashes = {}
+        for index in range(self.count):
+            offset = CACHE_HEADER.size + index * RECORD_SIZE
+            self.hashes[data[offset:offset + 16]] = index
+
+    def dropHashes(self):
+        self.hashes = None
+
+    def find(self, contentHash):
+        """ The analysis stored under contentHash. """
+        if self.hashes is not None:
+            index = self.hashes.get(contentHash)
+            return self.read(index)[1] if index is not None else None
+        self.file.seek(0)
+        data = self.file.read()
+        position = data.find(contentHash, CACHE_HEADER.size)
+        while position >= 0:
+            if (position - CACHE_HEADER.size) % RECORD_SIZE == 0:
+                return self.read((position - CACHE_HEADER.size) // RECORD_SIZE)[1]
+            position = data.find(contentHash, position + 1)
+        return None
+
+    def put(self, key, contentHash, analysis):
+        loudness = float('nan') if analysis.loudness is None else analysis.loudness
+        record = RECORD.pack(contentHash, key, loudness, analysis.duration) + \
+            analysis.peaks.ljust(WAVEFORM_POINTS, b'\0') + analysis.rms.ljust(WAVEFORM_POINTS, b'\0')
+        with span('write analysis.cache', RECORD_SIZE):
+            self.file.seek(CACHE_HEADER.size + self.count * RECORD_SIZE)
+            self.file.write(record)
+            self.file.flush()
+        self.records[key] = self.count
+        if self.hashes is not None:
+            self.hashes[contentHash] = self.count
+        self.count += 1
+
+
+EMPTY = TrackAnalysis(None, 0, b'', b'')
+
+
+class Analyzer(object):
+    """ Analyzes tracks in a low priority process pool, tracks about to play ahead of the library.
+
+    request() is for the playing and upcoming tracks, analyzeAll() queues a whole library that is
+    worked through a few tracks at a time so requests never wait long. Everything that touches the
+    disk runs on the analyzer's thread, results are passed to onReady(path, analysis) from there.
+    """
+
+    def __init__(self, cachePath, onReady, onProgress=None, workers=None):
+        self.cachePath = cachePath
+        self.cache = None
+        self.onReady = onReady
+        self.onProgress = onProgress
+        self.workers = workers or max(1, (os.cpu_count() or 2) // 2)
+        self.pool = ProcessPoolExecutor(self.workers, initializer=lowerPriority)
+        # Jobs lost with a worker that died are tried again one at a time in a pool of their own,
+        # so the track that brings a worker down is found without taking the others with it
+        self.suspectPool = ProcessPoolExecutor(1, initializer=lowerPriority)
+        self.suspects = deque()
+        self.suspect = None
+        self.condition = threading.Condition()
+        self.urgent = deque()
+        self.background = deque()
+        self.finished = []
+        self.pending = {}
+        self.recent = OrderedDict()
+        self.done = 0
+        self.total = 0
+        self.closed = False
+        threading.Thread(target=self.run, daemon=True).start()
+
+    def request(self, path):
+        with self.condition:
+            self.urgent.append(path)
+            self.condition.notify()
+
+    def analyzeAll(self, paths):
+        """ Queue paths for the background, already analyzed ones are skipped without being read. """
+        with self.condition:
+            self.background.extend(paths)
+            self.total += len(paths)
+            self.condition.notify()
+
+    def cancelBackground(self):
+        with self.condition:
+            self.background.clear()
+            self.done = self.total = 0
+
+    def close(self):
+        with self.condition:
+            self.closed = True
+            self.condition.notify()
+        self.pool.shutdown(wait=False, cancel_futures=True)
+        self.suspectPool.shutdown(wait=False, cancel_futures=True)
+
+    def run(self):
+        # Reading the cache index is the analyzer's first job, not the caller's
+        self.cache = AnalysisCache(self.cachePath)
+        while True:
+            with self.condition:
+                while not (self.closed or self.finished or self.urgent or
+                           (self.background and self.backgroundJobs() < self.workers)):
+                    self.condition.wait()
+                if self.closed:
+                    break
+                finished, self.finished = self.finished, []
+                if self.urgent:
+                    path, urgent = self.urgent.popleft(), True
+                elif self.background and self.backgroundJobs() < self.workers:
+                    path, urgent = self.background.popleft(), False
+                else:
+                    path = None
+                libraryDone = not self.background
+            for job, analysis in finished:
+                self.finish(job, analysis)
+            if self.suspect is None and self.suspects:
+                self.suspect = self.suspects.popleft()
+                self.submit(self.suspect)
+            if path is not None:
+                if not urgent and self.cache.hashes is None:
+                    self.cache.loadHashes()
+                self.lookup(path, urgent)
+            if libraryDone and self.cache.hashes is not None and not self.backgroundJobs():
+                self.cache.dropHashes()
+        # The pools may have been replaced after close() shut down the ones it saw
+        self.pool.shutdown(wait=False)
+        self.suspectPool.shutdown(wait=False)
+        self.cache.close()
+
+    def backgroundJobs(self):
+        return sum(1 for job in self.pending.values() if job[4])
+
+    def lookup(self, path, urgent):
+        if path in self.recent:
+            self.recent.move_to_end(path)
+            self.deliver(path, self.recent[path], urgent, not urgent)
+            return
+        if path in self.pending:
+            # Asked for by the player while the library run has it, or the other way round
+            self.pending[path][3 if urgent else 4] = True
+            return
+        try:
+            stat = os.stat(path)
+            key = statKey(path, stat)
+            analysis = self.cache.get(key)
+            if analysis is None:
+                contentHash = bytes.fromhex(partialHash(path, stat.st_size))
+                analysis = self.cache.find(contentHash)
+                if analysis is not None:
+                    self.cache.put(key, contentHash, analysis)
+        except OSError:
+            self.deliver(path, EMPTY, urgent, not urgent)
+            return
+        if analysis is not None:
+            recorder.count('analysis cache hits')
+            self.deliver(path, analysis, urgent, not urgent)
+            return
+        recorder.count('analysis cache misses')
+        job = [path, key, contentHash, urgent, not urgent]
+        self.pending[path] = job
+        self.submit(job)
+
+    def submit(self, job):
+        suspect = job is self.suspect
+        pool = self.suspectPool if suspect else self.pool
+        try:
+            future = pool.submit(analyzeFile, job[0])
+        except BrokenProcessPool:
+            # A worker died and the pool with it, a new one takes over. Its workers are gone already
+            pool.shutdown()
+            pool = ProcessPoolExecutor(1 if suspect else self.workers, initializer=lowerPriority)
+            if suspect:
+                self.suspectPool = pool
+            else:
+                self.pool = pool
+            future = pool.submit(analyzeFile, job[0])
+        future.add_done_callback(lambda future: self.jobDone(job, future))
+
+    def jobDone(self, job, future):
+        # Only close() cancels jobs, a track that was never analyzed must not be stored as a failed one
+        if future.cancelled():
+            return
+        try:
+            analysis = future.result() or EMPTY
+        except BrokenProcessPool:
+            # Every job queued when a worker died fails with it, None has it tried again
+            analysis = None
+        except Exception:
+            analysis = EMPTY
+        with self.condition:
+            self.finished.append((job, analysis))
+            self.condition.notify()
+
+    def finish(self, job, analysis):
+        if job is self.suspect:
+            self.suspect = None
+            if analysis is None:
+                # Took its worker down on its own, left out of the cache so a later run tries it again
+                del self.pending[job[0]]
+                self.deliver(job[0], EMPTY, job[3], job[4])
+                return
+        elif analysis is None:
+            self.suspects.append(job)
+            return
+        self.store(job, analysis)
+
+    def store(self, job, analysis):
+        path, key, contentHash, urgent, background = job
+        del self.pending[path]
+        # Failed tracks are stored too, so a library run does not retry them every night
+        self.cache.put(key, contentHash, analysis)
+        self.deliver(path, analysis, urgent, background)
+
+    def deliver(self, path, analysis, urgent, background):
+        self.recent[path] = analysis
+        while len(self.recent) > 64:
+            self.recent.popitem(last=False)
+        if urgent:
+            self.onReady(path, analysis)
+        if not background:
+            return
+        with self.condition:
+            self.done += 1
+            done, total = self.done, self.total
+            if done >= total:
+                self.done = self.total = 0
+        if self.onProgress is not None and (done % PROGRESS_EVERY == 0 or done >= total):
+            self.onProgress(done, total)
@@ -0,0 +1,394 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import base64
+import hashlib
+import os
+import pickle
+import struct
+import threading
+from collections import OrderedDict, deque
+
+from PyQt5.QtCore import Qt, QObject, QRunnable, QThread, QThreadPool, pyqtSignal
+from PyQt5.QtGui import QImage, QPixmap
+
+from Instrumentation import recorder, span
+from MetaData import mp4Boxes, oggPackets, syncsafe
+
+# Pictures bigger than this are skipped, a cover is rarely more than a few hundred kilobytes
+MAX_PICTURE_SIZE = 16 * 1024 * 1024
+COVER_SIZE = 256
+ICON_SIZE = 18
+FOLDER_NAMES = ('cover', 'folder', 'front', 'album', 'albumart')
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png')
+FRONT_COVER = 3
+MAX_PENDING = 256
+MAX_INDEX_ENTRIES = 250000
+
+
+# Extraction, runs on the worker threads
+
+def embeddedPicture(path):
+    """ Bytes of the front cover embedded in an audio file, or of its first picture, None without one. """
+    try:
+        with open(path, 'rb') as f:
+            magic = f.read(12)
+            f.seek(0)
+            if magic.startswith(b'fLaC') or (magic.startswith(b'ID3') and path.lower().endswith('.flac')):
+                return flacPicture(f)
+            elif magic.startswith(b'OggS'):
+                return oggPicture(f)
+            elif magic[4:8] == b'ftyp':
+                return mp4Picture(f)
+            return id3Picture(f)
+    except (OSError, struct.error, ValueError, IndexError):
+        return None
+
+
+def id3Picture(f):
+    header = f.read(10)
+    if len(header) < 10 or not header.startswith(b'ID3'):
+        return None
+    major = header[3]
+    flags = header[5]
+    size = syncsafe(header[6:10])
+    data = f.read(min(size, MAX_PICTURE_SIZE))
+    if flags & 0x80 and major < 4:
+        data = data.replace(b'\xff\x00', b'\xff')
+    offset = 0
+    if flags & 0x40:
+        offset = syncsafe(data[:4]) if major == 4 else struct.unpack_from('>I', data)[0] + 4
+    headerSize = 6 if major == 2 else 10
+    found = None
+    while offset + headerSize <= len(data) and data[offset] != 0:
+        if major == 2:
+            frameId = data[offset:offset + 3]
+            frameSize = int.from_bytes(data[offset + 3:offset + 6], 'big')
+        else:
+            frameId = data[offset:offset + 4]
+            frameSize = syncsafe(data[offset + 4:offset + 8]) if major == 4 else \
+                struct.unpack_from('>I', data, offset + 4)[0]
+        body = data[offset + headerSize:offset + headerSize + frameSize]
+        offset += headerSize + frameSize
+        if frameId not in (b'APIC', b'PIC'):
+            continue
+        encoding = body[0]
+        if frameId == b'PIC':
+            position = 4
+        else:
+            position = body.index(b'\x00', 1) + 1
+        pictureType = body[position]
+        # The description ends with a null of the text encoding's width
+        terminator = b'\x00\x00' if encoding in (1, 2) else b'\x00'
+        end = body.find(terminator, position + 1)
+        while terminator == b'\x00\x00' and end >= 0 and (end - position - 1) % 2:
+            end = body.find(terminator, end + 1)
+        if end < 0:
+            continue
+        picture = body[end + len(terminator):]
+        if pictureType == FRONT_COVER:
+            return picture
+        found = found or picture
+    return found
+
+
+def flacPictureBlock(block):
+    """ Picture type and bytes of a FLAC PICTURE block, the same layout is used in Ogg comments. """
+    pictureType, mimeLength = struct.unpack_from('>II', block, 0)
+    offset = 8 + mimeLength
+    descriptionLength = struct.unpack_from('>I', block, offset)[0]
+    offset += 4 + descriptionLength + 16
+    length = struct.unpack_from('>I', block, offset)[0]
+    return pictureType, block[offset + 4:offset + 4 + length]
+
+
+def flacPicture(f):
+    if f.read(3) == b'ID3':
+        f.seek(6)
+        f.seek(10 + syncsafe(f.read(4)))
+    else:
+        f.seek(0)
+    if f.read(4) != b'fLaC':
+        return None
+    found = None
+    last = False
+    while not last:
+        header = f.read(4)
+        if len(header) < 4:
+            break
+        last = bool(header[0] & 0x80)
+        length = int.from_bytes(header[1:4], 'big')
+        if header[0] & 0x7f == 6 and length <= MAX_PICTURE_SIZE:
+            pictureType, picture = flacPictureBlock(f.read(length))
+            if pictureType == FRONT_COVER:
+                return picture
+            found = found or picture
+        else:
+            f.seek(length, 1)
+    return found
+
+
+def oggPicture(f):
+    packets = oggPackets(f, MAX_PICTURE_SIZE)
+    ident = next(packets, b'')
+    comment = next(packets, b'')
+    if ident.startswith(b'\x01vorbis') and comment.startswith(b'\x03vorbis'):
+        data = comment[7:]
+    elif ident.startswith(b'OpusHead') and comment.startswith(b'OpusTags'):
+        data = comment[8:]
+    else:
+        return None
+    offset = 4 + struct.unpack_from('<I', data, 0)[0]
+    count = struct.unpack_from('<I', data, offset)[0]
+    offset += 4
+    found = None
+    for _ in range(count):
+        length = struct.unpack_from('<I', data, offset)[0]
+        comment = data[offset + 4:offset + 4 + length]
+        offset += 4 + length
+        key, _, value = comment.partition(b'=')
+        if key.upper() == b'METADATA_BLOCK_PICTURE':
+            pictureType, picture = flacPictureBlock(base64.b64decode(value))
+            if pictureType == FRONT_COVER:
+                return picture
+            found = found or picture
+    return found
+
+
+def mp4Picture(f):
+    # The cover is the data box of moov/udta/meta/ilst/covr
+    end = os.fstat(f.fileno()).st_size
+    for kind in (b'moov', b'udta', b'meta', b'ilst', b'covr', b'data'):
+        for child, start, childEnd in mp4Boxes(f, end):
+            if child == kind:
+                # meta is a full box, its children start after the version and flags
+                f.seek(start + 4 if kind == b'meta' else start)
+                end = childEnd
+                break
+        else:
+            return None
+    if end - f.tell() > MAX_PICTURE_SIZE:
+        return None
+    # The data box starts with its type and locale
+    return f.read(end - f.tell())[8:]
+
+
+def folderPicture(directory):
+    """ Bytes of cover.jpg, folder.jpg and the like next to the audio files, matched case-insensitively. """
+    try:
+        names = {entry.name.lower(): entry.path for entry in os.scandir(directory)
+                 if entry.name.lower().endswith(IMAGE_EXTENSIONS)}
+    except OSError:
+        return None
+    for name in FOLDER_NAMES:
+        for extension in IMAGE_EXTENSIONS:
+            path = names.get(name + extension)
+            if path is not None and os.path.getsize(path) <= MAX_PICTURE_SIZE:
+                with open(path, 'rb') as f:
+                    return f.read()
+    return None
+
+
+def scaled(image, size):
+    return image.scaled(size, size, Qt.KeepAspectRatio, Qt.SmoothTransformation)
+
+
+class PixmapLru(object):
+    """ Pixmaps by key, least recently used ones dropped beyond a budget of bytes, like QPixmapCache. """
+
+    def __init__(self, budget):
+        self.budget = budget
+        self.bytes = 0
+        self.pixmaps = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        pixmap = self.pixmaps.get(key)
+        if pixmap is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.pixmaps.move_to_end(key)
+        return pixmap
+
+    def put(self, key, pixmap):
+        old = self.pixmaps.pop(key, None)
+        if old is not None:
+            self.bytes -= pixmapBytes(old)
+        self.pixmaps[key] = pixmap
+        self.bytes += pixmapBytes(pixmap)
+        while self.bytes > self.budget and len(self.pixmaps) > 1:
+            self.bytes -= pixmapBytes(self.pixmaps.popitem(last=False)[1])
+
+
+def pixmapBytes(pixmap):
+    return pixmap.width() * pixmap.height() * pixmap.depth() // 8
+
+
+class ArtworkJob(QRunnable):
+    def __init__(self, artwork):
+        super(ArtworkJob, self).__init__()
+        self.artwork = artwork
+
+    def run(self):
+        self.artwork.loadNext()
+
+
+class Artwork(QObject):
+    """ Cover art of tracks, embedded or from the folder, as fixed-size thumbnails.
+
+    Pictures are found and scaled on a low priority thread pool, never on the GUI thread. The
+    thumbnails are stored on disk by a hash of the picture, so an album's tracks share one file,
+    and kept as pixmaps in a memory LRU with a byte budget. cover() and icon() answer from memory
+    or return None and queue the track, artworkReady follows once it is loaded. The most recent
+    requests are served first and the oldest dropped, they are for rows scrolled out of view.
+    """
+    artworkReady = pyqtSignal(str)
+    imagesLoaded = pyqtSignal(str, object, object, object)
+
+    def __init__(self, directory, budget=32 * 1024 * 1024, workers=2, parent=None):
+        super(Artwork, self).__init__(parent)
+        self.directory = directory
+        self.indexPath = os.path.join(directory, 'index')
+        self.pixmaps = PixmapLru(budget)
+        # path: ((mtime, size), picture hash), the hash is '' for tracks without art
+        self.keys = OrderedDict()
+        self.keysDirty = False
+        # Tracks without art are looked at again once per run, art may have been added since
+        self.checked = set()
+        self.folders = {}
+        self.lock = threading.Lock()
+        self.pending = deque()
+        self.queued = set()
+        self.pool = QThreadPool(self)
+        self.pool.setMaxThreadCount(workers)
+        self.imagesLoaded.connect(self.storeImages)
+        self.loadIndex()
+
+    def cover(self, path):
+        return self.pixmap(path, 'cover')
+
+    def icon(self, path):
+        return self.pixmap(path, 'icon')
+
+    def pixmap(self, path, size):
+        entry = self.keys.get(path)
+        if entry is not None:
+            if entry[1]:
+                pixmap = self.pixmaps.get((entry[1], size))
+                if pixmap is not None:
+                    return pixmap
+            elif path in self.checked:
+                return None
+        self.request(path)
+        return None
+
+    def request(self, path):
+        with self.lock:
+            if path in self.queued:
+                return
+            self.queued.add(path)
+            self.pending.append(path)
+            while len(self.pending) > MAX_PENDING:
+                self.queued.discard(self.pending.popleft())
+        self.pool.start(ArtworkJob(self))
+
+    def loadNext(self):
+        QThread.currentThread().setPriority(QThread.LowPriority)
+        with self.lock:
+            if not self.pending:
+                return
+            path = self.pending.pop()
+        try:
+            stat = os.stat(path)
+            stamp = (stat.st_mtime_ns, stat.st_size)
+            key, cover = self.load(path, stamp)
+        except OSError:
+            stamp, key, cover = None, '', None
+        finally:
+            with self.lock:
+                self.queued.discard(path)
+        icon = scaled(cover, ICON_SIZE) if cover is not None else None
+        self.imagesLoaded.emit(path, (stamp, key), cover, icon)
+
+    def load(self, path, stamp):
+        """ (hash, cover QImage) of a track's art, ('', None) without any. """
+        entry = self.keys.get(path)
+        if entry is not None and entry[0] == stamp and entry[1]:
+            image = QImage(self.thumbnailPath(entry[1]))
+            if not image.isNull():
+                return entry[1], image
+        with span('read artwork') as io:
+            picture = embeddedPicture(path)
+            if picture is None:
+                picture = self.folderPicture(os.path.dirname(path))
+            io.size = len(picture) if picture else 0
+        if not picture:
+            return '', None
+        recorder.count('artwork extracted')
+        key = hashlib.blake2b(picture, digest_size=16).hexdigest()
+        thumbnail = self.thumbnailPath(key)
+        image = QImage(thumbnail)
+        if image.isNull():
+            image = QImage.fromData(picture)
+            if image.isNull():
+                return '', None
+            image = scaled(image, COVER_SIZE)
+            os.makedirs(os.path.dirname(thumbnail), exist_ok=True)
+            temp = '%s.%d.tmp' % (thumbnail, threading.get_ident())
+            if image.save(temp, 'PNG' if image.hasAlphaChannel() else 'JPG', 90):
+                os.replace(temp, thumbnail)
+        return key, image
+
+    def folderPicture(self, directory):
+        # Every track of an album asks for the same folder, it is only searched once
+        with self.lock:
+            if directory in self.folders:
+                return self.folders[directory]
+        picture = folderPicture(directory)
+        with self.lock:
+            self.folders[directory] = picture
+            while len(self.folders) > 64:
+                self.folders.pop(next(iter(self.folders)))
+        return picture
+
+    def thumbnailPath(self, key):
+        return os.path.join(self.directory, key[:2], key)
+
+    def storeImages(self, path, entry, cover, icon):
+        key = entry[1]
+        self.checked.add(path)
+        self.keys[path] = entry
+        self.keys.move_to_end(path)
+        while len(self.keys) > MAX_INDEX_ENTRIES:
+            self.keys.popitem(last=False)
+        self.keysDirty = True
+        if cover is not None:
+            self.pixmaps.put((key, 'cover'), QPixmap.fromImage(cover))
+            self.pixmaps.put((key, 'icon'), QPixmap.fromImage(icon))
+            self.artworkReady.emit(path)
+
+    def hitRate(self):
+        return self.pixmaps.hits / max(1, self.pixmaps.hits + self.pixmaps.misses)
+
+    def loadIndex(self):
+        try:
+            with span('read artwork index') as io, open(self.indexPath, 'rb') as f:
+                io.size = os.fstat(f.fileno()).st_size
+                self.keys = pickle.load(f)
+        except (OSError, EOFError, pickle.UnpicklingError, AttributeError, ValueError):
+            self.keys = OrderedDict()
+
+    def close(self):
+        self.pool.clear()
+        with self.lock:
+            self.pending.clear()
+            self.queued.clear()
+        self.pool.waitForDone(1000)
+        if not self.keysDirty:
+            return
+        os.makedirs(self.directory, exist_ok=True)
+        temp = self.indexPath + '.tmp'
+        with span('write artwork index'), open(temp, 'wb') as f:
+            pickle.dump(self.keys, f, pickle.HIGHEST_PROTOCOL)
+        os.replace(temp, self.indexPath)
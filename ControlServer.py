@@ -0,0 +1,309 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import asyncio
+import inspect
+import json
+import os
+import socket
+import stat
+import threading
+from concurrent.futures import Future, TimeoutError
+
+from PyQt5.QtCore import QObject, Qt, pyqtSignal
+
+from History import KIND_NAMES
+from Instrumentation import timed
+from PlayerCore import MODES, MODE_NAMES, STATES
+
+PARSE_ERROR = -32700
+INVALID_REQUEST = -32600
+METHOD_NOT_FOUND = -32601
+INVALID_PARAMS = -32602
+INTERNAL_ERROR = -32603
+EVENTS = frozenset(('state', 'position', 'track', 'mode', 'volume', 'queue'))
+MAX_LINE = 16 * 1024 * 1024
+
+
+class RpcError(Exception):
+    def __init__(self, code, message):
+        super(RpcError, self).__init__(message)
+        self.code = code
+
+
+class ControlServer(QObject):
+    """ JSON-RPC 2.0 over a Unix socket, one request, notification or batch per line.
+
+    The socket is served by an asyncio loop on its own thread. Calls are handed to the Qt thread that
+    owns the core, a whole batch in one hop, and subscribers are sent events as notifications
+    instead of polling for them.
+    """
+    callsReceived = pyqtSignal(object, object)
+
+    def __init__(self, core, path, parent=None):
+        super(ControlServer, self).__init__(parent)
+        self.core = core
+        self.path = path
+        self.loop = None
+        self.server = None
+        # Device and inode of the socket this instance bound, close() leaves any other file alone
+        self.socketId = None
+        self.clients = set()
+        self.subscribers = {}
+        self.methods = {
+            'play': self.core.play, 'pause': self.core.pause, 'stop': self.core.stop, 'next': self.core.next,
+            'previous': self.core.previous, 'seek': self.seek, 'setVolume': self.core.setVolume,
+            'setMuted': self.core.setMuted, 'setMode': self.setMode, 'playTrack': self.core.playTrack,
+            'enqueue': self.enqueue, 'remove': self.remove, 'clear': self.core.clear,
+            'status': self.core.status, 'tracks': self.tracks, 'history': self.history, 'topTracks': self.topTracks,
+        }
+        self.callsReceived.connect(self.runCalls, Qt.QueuedConnection)
+        self.core.started.connect(self.connectEngine)
+        if self.core.engine is not None:
+            self.connectEngine()
+        self.core.currentChanged.connect(lambda row: self.publish('track', lambda: self.core.trackInfo(row)))
+        self.core.modeChanged.connect(lambda mode: self.publish('mode', {'mode': MODE_NAMES.get(mode, 'sequential')}))
+        self.core.model.tracksChanged.connect(lambda: self.publish('queue', {'tracks': self.core.model.trackCount()}))
+
+    def connectEngine(self):
+        engine = self.core.engine
+        engine.stateChanged.connect(lambda state: self.publish('state', {'state': STATES.get(state, 'stopped')}))
+        engine.positionChanged.connect(lambda position: self.publish('position', {'position': position}))
+        engine.volumeChanged.connect(lambda volume: self.publish('volume', {'volume': volume,
+                                                                            'muted': engine.isMuted()}))
+        engine.mutedChanged.connect(lambda muted: self.publish('volume', {'volume': engine.volume(),
+                                                                          'muted': muted}))
+
+    def start(self):
+        """ Listen on the socket, returns False where Unix sockets are not available. """
+        if not hasattr(socket, 'AF_UNIX'):
+            return False
+        ready = Future()
+        threading.Thread(target=self.serve, args=(ready,), daemon=True).start()
+        return ready.result()
+
+    def serve(self, ready):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        try:
+            if socketInUse(self.path):
+                raise OSError("Another player listens on %s" % self.path)
+            self.server = self.loop.run_until_complete(
+                asyncio.start_unix_server(self.client, self.path, limit=MAX_LINE))
+            # Only the user running the player may control it, the umask is left alone as it is the whole process'
+            os.chmod(self.path, 0o600)
+            info = os.stat(self.path)
+            self.socketId = (info.st_dev, info.st_ino)
+        except (OSError, NotImplementedError):
+            if self.server is not None:
+                self.server.close()
+                self.server = None
+            self.loop.close()
+            self.loop = None
+            ready.set_result(False)
+            return
+        ready.set_result(True)
+        self.loop.run_forever()
+
+    def close(self):
+        if self.loop is None:
+            return
+        closed = asyncio.run_coroutine_threadsafe(self.shutdown(), self.loop)
+        try:
+            closed.result(1)
+        except TimeoutError:
+            pass
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        try:
+            info = os.stat(self.path)
+            if (info.st_dev, info.st_ino) == self.socketId:
+                os.unlink(self.path)
+        except OSError:
+            pass
+
+    async def shutdown(self):
+        # Controllers see the connection end instead of the process going away under them
+        self.server.close()
+        writers = list(self.clients)
+        for writer in writers:
+            writer.close()
+        await asyncio.gather(*(writer.wait_closed() for writer in writers), return_exceptions=True)
+        await self.server.wait_closed()
+
+    async def client(self, reader, writer):
+        self.clients.add(writer)
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                if not line.strip():
+                    continue
+                response = await self.handle(line, writer)
+                if response is not None:
+                    writer.write(json.dumps(response).encode('utf-8') + b'\n')
+                    await writer.drain()
+        except (ConnectionError, ValueError):
+            pass
+        finally:
+            self.clients.discard(writer)
+            self.subscribers.pop(writer, None)
+            writer.close()
+
+    async def handle(self, line, writer):
+        try:
+            message = json.loads(line.decode('utf-8'))
+        except ValueError:
+            return errorResponse(None, PARSE_ERROR, 'Parse error')
+        batch = isinstance(message, list)
+        requests = message if batch else [message]
+        if not requests:
+            return errorResponse(None, INVALID_REQUEST, 'Empty batch')
+        # Subscriptions belong to the connection and are answered here, everything else runs on the Qt thread
+        responses = [None] * len(requests)
+        calls = []
+        for position, request in enumerate(requests):
+            if not isinstance(request, dict) or request.get('jsonrpc') != '2.0' or \
+                    not isinstance(request.get('method'), str):
+                responses[position] = errorResponse(None, INVALID_REQUEST, 'Invalid request')
+            elif request['method'] in ('subscribe', 'unsubscribe'):
+                responses[position] = self.subscribe(writer, request)
+            else:
+                calls.append((position, request))
+        if calls:
+            future = Future()
+            self.callsReceived.emit([request for _, request in calls], future)
+            for (position, request), response in zip(calls, await asyncio.wrap_future(future)):
+                responses[position] = response
+        # Notifications, requests without an id, get no response
+        responses = [response for response, request in zip(responses, requests)
+                     if response is not None and not (isinstance(request, dict) and 'id' not in request)]
+        if not responses:
+            return None
+        return responses if batch else responses[0]
+
+    def subscribe(self, writer, request):
+        params = request.get('params') or {}
+        events = params.get('events', list(EVENTS)) if isinstance(params, dict) else params
+        if not isinstance(events, list) or not all(isinstance(event, str) and event in EVENTS for event in events):
+            return errorResponse(request.get('id'), INVALID_PARAMS, 'Events are %s' % ', '.join(sorted(EVENTS)))
+        subscribed = self.subscribers.setdefault(writer, set())
+        if request['method'] == 'subscribe':
+            subscribed.update(events)
+        else:
+            subscribed.difference_update(events)
+        return {'jsonrpc': '2.0', 'id': request.get('id'), 'result': sorted(subscribed)}
+
+    @timed()
+    def runCalls(self, requests, future):
+        future.set_result([self.call(request) for request in requests])
+
+    def call(self, request):
+        requestId = request.get('id')
+        method = self.methods.get(request['method'])
+        if method is None:
+            return errorResponse(requestId, METHOD_NOT_FOUND, 'Method not found: %s' % request['method'])
+        params = request.get('params', [])
+        if isinstance(params, dict):
+            args, kwargs = (), params
+        elif isinstance(params, list):
+            args, kwargs = params, {}
+        else:
+            return errorResponse(requestId, INVALID_PARAMS, 'Params must be a list or an object')
+        # Only a call that does not fit the signature is the caller's fault, errors inside the method are ours
+        try:
+            inspect.signature(method).bind(*args, **kwargs)
+        except TypeError as error:
+            return errorResponse(requestId, INVALID_PARAMS, str(error))
+        try:
+            result = method(*args, **kwargs)
+        except RpcError as error:
+            return errorResponse(requestId, error.code, str(error))
+        except Exception as error:
+            return errorResponse(requestId, INTERNAL_ERROR, str(error))
+        return {'jsonrpc': '2.0', 'id': requestId, 'result': result}
+
+    def publish(self, event, params):
+        """ Send an event to its subscribers, params can be a function so it is only built when needed. """
+        if self.loop is None or not self.subscribers:
+            return
+        if callable(params):
+            params = params()
+        line = json.dumps({'jsonrpc': '2.0', 'method': 'event', 'params': dict(params or {}, event=event)})
+        self.loop.call_soon_threadsafe(self.send, event, line.encode('utf-8') + b'\n')
+
+    def send(self, event, data):
+        for writer, events in list(self.subscribers.items()):
+            if event in events and not writer.is_closing():
+                # A controller that stops reading loses events instead of growing the buffer without end
+                if writer.transport.get_write_buffer_size() < MAX_LINE:
+                    writer.write(data)
+
+    # Methods that adapt their parameters
+
+    def seek(self, position):
+        self.core.seek(integer(position))
+
+    def setMode(self, mode):
+        if mode not in MODES:
+            raise RpcError(INVALID_PARAMS, 'Modes are %s' % ', '.join(sorted(MODES)))
+        self.core.setPlaybackMode(MODES[mode])
+        return mode
+
+    def enqueue(self, paths, play=False):
+        if isinstance(paths, str):
+            paths = [paths]
+        first = self.core.model.trackCount()
+        count = self.core.addTracks(paths)
+        if play and count:
+            self.core.playTrack(first)
+        return count
+
+    def remove(self, rows):
+        # Checked before anything changes, rows outside the queue would shift the playing row
+        count = self.core.model.trackCount()
+        if not isinstance(rows, list) or not all(type(row) is int and 0 <= row < count for row in rows):
+            raise RpcError(INVALID_PARAMS, 'Rows must be a list of rows below %d' % count)
+        return self.core.removeTracks(rows)
+
+    def tracks(self, start=0, count=100):
+        last = min(self.core.model.trackCount(), start + count)
+        return [self.core.trackInfo(row) for row in range(max(0, start), last)]
+
+    def history(self, start=0, end=None, limit=1000):
+        return [{'time': event.time, 'path': event.path, 'event': KIND_NAMES[event.kind], 'position': event.position}
+                for event in self.core.history.events(integer(start), end, integer(limit))]
+
+    def topTracks(self, start=None, end=None, limit=25):
+        return [{'path': path, 'plays': plays} for path, plays in self.core.history.topTracks(start, end, integer(limit))]
+
+
+def socketInUse(path):
+    """ Whether a player answers on path. A socket left behind by one that is gone is removed. """
+    probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        probe.connect(path)
+    except FileNotFoundError:
+        return False
+    except ConnectionRefusedError:
+        # Linux refuses connections to other files too
+        if not stat.S_ISSOCK(os.lstat(path).st_mode):
+            return True
+        os.unlink(path)
+        return False
+    except OSError:
+        # Not a socket, or not ours to connect to, either way not ours to remove
+        return True
+    finally:
+        probe.close()
+    return True
+
+
+def integer(value):
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        raise RpcError(INVALID_PARAMS, 'Expected a number, got %r' % (value,))
+
+
+def errorResponse(requestId, code, message):
+    return {'jsonrpc': '2.0', 'id': requestId, 'error': {'code': code, 'message': message}}
@@ -0,0 +1,28 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+from PyQt5.QtCore import Qt
+from PyQt5.QtWidgets import QLabel
+
+COVER_VIEW_SIZE = 100
+
+
+class CoverView(QLabel):
+    """ Cover of the playing track under the playlist list, hidden while there is none. """
+
+    def __init__(self, parent=None):
+        super(CoverView, self).__init__(parent)
+        self.setAlignment(Qt.AlignCenter)
+        self.setFixedSize(COVER_VIEW_SIZE, COVER_VIEW_SIZE)
+        self.hide()
+
+    def setCover(self, pixmap):
+        if pixmap is None:
+            self.clear()
+            self.hide()
+            return
+        ratio = self.devicePixelRatioF()
+        scaled = pixmap.scaled(int(COVER_VIEW_SIZE * ratio), int(COVER_VIEW_SIZE * ratio), Qt.KeepAspectRatio,
+                               Qt.SmoothTransformation)
+        scaled.setDevicePixelRatio(ratio)
+        self.setPixmap(scaled)
+        self.show()
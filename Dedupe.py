@@ -0,0 +1,242 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import os
+import re
+import subprocess
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+from Analysis import analysisAvailable, lowerPriority
+from FileHash import fullHash, partialHash
+
+# Candidates for the acoustic tier, same normalized artist and title and about the same length
+DURATION_TOLERANCE = 3000
+FINGERPRINT_RATE = 5512
+FINGERPRINT_SECONDS = 60
+FRAME = 2048
+HOP = 128
+BANDS = 33
+LOW_HZ = 300
+HIGH_HZ = 2000
+# Bit error rate below which two fingerprints are the same recording, unrelated audio is near 0.5
+MATCH_BER = 0.3
+# Frames of misalignment tried, about a second and a half of extra leading silence
+MAX_OFFSET = 64
+MIN_FRAMES = 64
+PROGRESS_EVERY = 500
+STORE_EVERY = 1000
+
+Candidate = namedtuple('Candidate', 'path size mtime title artist duration')
+DuplicateGroup = namedtuple('DuplicateGroup', 'kind paths')
+
+
+def acousticAvailable():
+    return analysisAvailable()
+
+
+# Acoustic fingerprints, computed in worker processes
+
+def acousticFingerprint(path):
+    """ 32 bit sub-fingerprints of the opening minute, the signs of band energy differences over time and
+    frequency (Haitsma and Kalker), as bytes, None when the file cannot be decoded. """
+    try:
+        output = subprocess.run(['ffmpeg', '-nostdin', '-v', 'error', '-i', path, '-t', str(FINGERPRINT_SECONDS),
+                                 '-map', '0:a:0', '-f', 's16le', '-acodec', 'pcm_s16le', '-ac', '1',
+                                 '-ar', str(FINGERPRINT_RATE), '-'],
+                                stdout=subprocess.PIPE, stderr=subprocess.DEVNULL).stdout
+    except OSError:
+        return None
+    samples = numpy.frombuffer(output[:len(output) & ~1], '<i2').astype(numpy.float32)
+    count = (len(samples) - FRAME) // HOP + 1
+    if count < MIN_FRAMES:
+        return None
+    frames = numpy.lib.stride_tricks.as_strided(samples, (count, FRAME), (HOP * 4, 4))
+    spectrum = numpy.abs(numpy.fft.rfft(frames * numpy.hanning(FRAME), axis=1)) ** 2
+    edges = numpy.geomspace(LOW_HZ, HIGH_HZ, BANDS + 1) * FRAME / FINGERPRINT_RATE
+    energies = numpy.add.reduceat(spectrum, edges.astype(int)[:-1], axis=1)
+    differences = energies[:, :-1] - energies[:, 1:]
+    bits = (differences[1:] - differences[:-1]) > 0
+    return numpy.packbits(bits, axis=1).tobytes()
+
+
+def bitErrorRate(first, second):
+    """ Lowest share of differing bits of two fingerprints over small alignment offsets. """
+    first = numpy.frombuffer(first, numpy.uint32)
+    second = numpy.frombuffer(second, numpy.uint32)
+    best = 1.0
+    for offset in range(-MAX_OFFSET, MAX_OFFSET + 1):
+        a = first[max(0, offset):]
+        b = second[max(0, -offset):]
+        length = min(len(a), len(b))
+        if length < MIN_FRAMES:
+            continue
+        errors = numpy.unpackbits((a[:length] ^ b[:length]).view(numpy.uint8)).sum()
+        best = min(best, errors / (length * 32))
+    return best
+
+
+def songKey(candidate):
+    """ Lower case artist and title without punctuation, the file name when the title tag is empty. """
+    title = candidate.title or re.sub(r'^[\d\s._-]+', '', os.path.splitext(os.path.basename(candidate.path))[0])
+    return ' '.join(re.findall(r'\w+', ('%s %s' % (candidate.artist, title)).lower()))
+
+
+class Deduper(object):
+    """ Finds duplicate files in tiers, each only reading what the one before could not decide.
+
+    Files are first grouped by size, which costs nothing. Only files sharing a size get a partial
+    hash of their head and tail, and only files sharing that get a full streaming hash. The optional
+    acoustic tier decodes the opening minute of tracks with the same artist, title and length
+    that are not identical files, to find different rips of a recording. Hashes and fingerprints are
+    kept in the library index, valid while the file's size and mtime stay the same.
+    """
+
+    def __init__(self, index, workers=4, acoustic=False, onProgress=None):
+        self.index = index
+        self.workers = workers
+        self.acoustic = acoustic and acousticAvailable()
+        self.onProgress = onProgress
+        self.cancelled = False
+        self.pending = []
+
+    def cancel(self):
+        self.cancelled = True
+
+    def progress(self, stage, done, total):
+        if self.onProgress is not None and (done % PROGRESS_EVERY == 0 or done == total):
+            self.onProgress(stage, done, total)
+
+    def find(self, candidates):
+        """ DuplicateGroups of candidates, the copy to keep first in each group. """
+        bySize = {}
+        for candidate in candidates:
+            if candidate.size > 0:
+                bySize.setdefault(candidate.size, []).append(candidate)
+        sameSize = [candidate for group in bySize.values() if len(group) > 1 for candidate in group]
+        cached = self.index.fingerprints([candidate.path for candidate in sameSize])
+        hashes = {}
+        for candidate in sameSize:
+            row = cached.get(candidate.path)
+            if row is not None and row[:2] == (candidate.size, candidate.mtime):
+                hashes[candidate.path] = [row[2], row[3]]
+            else:
+                hashes[candidate.path] = [None, None]
+
+        groups = self.refine('partial', [group for group in bySize.values() if len(group) > 1], hashes, 0,
+                             lambda candidate: partialHash(candidate.path, candidate.size))
+        groups = self.refine('full', groups, hashes, 1, lambda candidate: fullHash(candidate.path))
+        self.store()
+        if self.cancelled:
+            return []
+        duplicates = [DuplicateGroup('identical', [candidate.path for candidate in
+                                                   sorted(group, key=lambda candidate: (len(candidate.path),
+                                                                                        candidate.path))])
+                      for group in groups]
+        if self.acoustic:
+            copies = {path for group in duplicates for path in group.paths[1:]}
+            duplicates.extend(self.findRecordings([candidate for candidate in candidates
+                                                   if candidate.path not in copies]))
+        return duplicates
+
+    def refine(self, stage, groups, hashes, tier, digest):
+        """ Split groups by one more hash, computing the ones not cached on the worker threads. """
+        missing = [candidate for group in groups for candidate in group if hashes[candidate.path][tier] is None]
+        done = 0
+        with ThreadPoolExecutor(self.workers) as pool:
+            for candidate, value in zip(missing, pool.map(lambda candidate: self.safely(digest, candidate), missing)):
+                if self.cancelled:
+                    break
+                hashes[candidate.path][tier] = value
+                self.pending.append((candidate, hashes[candidate.path]))
+                done += 1
+                self.progress(stage, done, len(missing))
+                if len(self.pending) >= STORE_EVERY:
+                    self.store()
+        refined = []
+        for group in groups:
+            split = {}
+            for candidate in group:
+                value = hashes[candidate.path][tier]
+                if value is not None:
+                    split.setdefault(value, []).append(candidate)
+            refined.extend(subgroup for subgroup in split.values() if len(subgroup) > 1)
+        return refined
+
+    def safely(self, digest, candidate):
+        if self.cancelled:
+            return None
+        try:
+            return digest(candidate)
+        except OSError:
+            return None
+
+    def store(self):
+        if self.pending:
+            self.index.storeFingerprints([(candidate.path, candidate.size, candidate.mtime, values[0], values[1])
+                                          for candidate, values in self.pending])
+            self.pending = []
+
+    def findRecordings(self, candidates):
+        songs = {}
+        for candidate in candidates:
+            songs.setdefault(songKey(candidate), []).append(candidate)
+        suspects = [group for key, group in songs.items() if key and len(group) > 1]
+        paths = [candidate.path for group in suspects for candidate in group]
+        stamps = {candidate.path: (candidate.size, candidate.mtime) for group in suspects for candidate in group}
+        fingerprints = {path: row[2] for path, row in self.index.acousticFingerprints(paths).items()
+                        if row[:2] == stamps[path]}
+        missing = [path for path in paths if path not in fingerprints]
+        done = 0
+        computed = []
+        with ProcessPoolExecutor(self.workers, initializer=lowerPriority) as pool:
+            for path, fingerprint in zip(missing, pool.map(acousticFingerprint, missing)):
+                if self.cancelled:
+                    break
+                fingerprints[path] = fingerprint
+                computed.append((path, stamps[path][0], stamps[path][1], fingerprint))
+                done += 1
+                self.progress('acoustic', done, len(missing))
+        self.index.storeAcousticFingerprints(computed)
+        if self.cancelled:
+            return []
+
+        duplicates = []
+        for group in suspects:
+            # Highest bit rate first, the rip to keep
+            group = sorted(group, key=lambda candidate: (-candidate.size / max(1, candidate.duration),
+                                                         candidate.path))
+            remaining = [candidate for candidate in group if fingerprints.get(candidate.path)]
+            while len(remaining) > 1:
+                first = remaining[0]
+                same = [candidate for candidate in remaining[1:]
+                        if abs(candidate.duration - first.duration) <= DURATION_TOLERANCE
+                        and bitErrorRate(fingerprints[first.path], fingerprints[candidate.path]) < MATCH_BER]
+                if same:
+                    duplicates.append(DuplicateGroup('recording',
+                                                     [first.path] + [candidate.path for candidate in same]))
+                remaining = [candidate for candidate in remaining[1:] if candidate not in same]
+        return duplicates
+
+
+def libraryCandidates(index, roots=None):
+    prefixes = tuple(os.path.join(root, '') for root in roots or ())
+    return [Candidate(record.path, record.size, record.mtime, record.title, record.artist, record.duration)
+            for record in index.records() if not prefixes or record.path.startswith(prefixes)]
+
+
+def fileCandidates(paths, titles=None, artists=None, durations=None):
+    """ Candidates for files outside the library index, stat'ed here. """
+    candidates = []
+    for position, path in enumerate(paths):
+        try:
+            stat = os.stat(path)
+        except OSError:
+            continue
+        candidates.append(Candidate(path, stat.st_size, stat.st_mtime_ns, titles[position] if titles else '',
+                                    artists[position] if artists else '', durations[position] if durations else 0))
+    return candidates
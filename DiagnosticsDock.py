@@ -0,0 +1,119 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+from time import perf_counter_ns
+
+from PyQt5.QtCore import Qt, QObject, QTimer, pyqtSignal
+from PyQt5.QtWidgets import (QDockWidget, QFileDialog, QHBoxLayout, QPushButton, QTreeWidget, QTreeWidgetItem,
+                             QVBoxLayout, QWidget)
+
+from Instrumentation import recorder, tracePath
+from ReadAheadCache import formatBytes
+
+CATEGORIES = (('slot', 'Slots'), ('loop', 'Event loop'), ('io', 'File I/O'))
+
+
+class LagMonitor(QObject):
+    """ Measures how late a short repeating timer fires, the time the event loop was busy with something else. """
+
+    def __init__(self, interval=50, parent=None):
+        super(LagMonitor, self).__init__(parent)
+        self.interval = interval * 1000000
+        self.last = None
+        self.timer = QTimer(self)
+        self.timer.setTimerType(Qt.PreciseTimer)
+        self.timer.setInterval(interval)
+        self.timer.timeout.connect(self.tick)
+
+    def start(self):
+        self.last = perf_counter_ns()
+        self.timer.start()
+
+    def stop(self):
+        self.timer.stop()
+
+    def tick(self):
+        now = perf_counter_ns()
+        if recorder.enabled:
+            # The lag is recorded as a span covering the late part, so stalls show up in the trace
+            lag = max(0, now - self.last - self.interval)
+            recorder.record('loop', 'event loop lag', now - lag, now)
+            recorder.sample('event loop lag ms', lag / 1e6)
+        self.last = now
+
+
+class DiagnosticsDock(QDockWidget):
+    """ Slot latencies, event loop lag, file I/O and cache statistics, recorded only while the dock is open. """
+    closed = pyqtSignal()
+
+    def __init__(self, parent=None):
+        super(DiagnosticsDock, self).__init__("Diagnostics", parent)
+        self.setObjectName('diagnostics')
+        self.tree = QTreeWidget()
+        self.tree.setHeaderLabels(("Name", "Calls", "Mean ms", "p50 ms", "p95 ms", "Max ms", "Bytes"))
+        self.tree.setRootIsDecorated(True)
+        self.tree.setUniformRowHeights(True)
+        self.tree.header().resizeSection(0, 260)
+        reset = QPushButton("Reset")
+        reset.clicked.connect(self.reset)
+        export = QPushButton("Export Trace...")
+        export.clicked.connect(self.exportTrace)
+        buttons = QHBoxLayout()
+        buttons.addStretch()
+        buttons.addWidget(reset)
+        buttons.addWidget(export)
+        layout = QVBoxLayout()
+        layout.addWidget(self.tree)
+        layout.addLayout(buttons)
+        widget = QWidget()
+        widget.setLayout(layout)
+        self.setWidget(widget)
+
+        self.lagMonitor = LagMonitor(parent=self)
+        self.refreshTimer = QTimer(self)
+        self.refreshTimer.setInterval(1000)
+        self.refreshTimer.timeout.connect(self.refresh)
+
+    def showEvent(self, event):
+        recorder.setEnabled(True)
+        self.lagMonitor.start()
+        self.refreshTimer.start()
+        self.refresh()
+        super(DiagnosticsDock, self).showEvent(event)
+
+    def closeEvent(self, event):
+        self.refreshTimer.stop()
+        # A trace asked for on the command line keeps recording until exit
+        if tracePath() is None:
+            self.lagMonitor.stop()
+            recorder.setEnabled(False)
+        self.closed.emit()
+        super(DiagnosticsDock, self).closeEvent(event)
+
+    def refresh(self):
+        histograms, counters = recorder.snapshot()
+        expanded = {self.tree.topLevelItem(i).text(0) for i in range(self.tree.topLevelItemCount())
+                    if self.tree.topLevelItem(i).isExpanded()}
+        self.tree.clear()
+        for category, title in CATEGORIES:
+            group = QTreeWidgetItem(self.tree, [title])
+            for (itemCategory, name), histogram in histograms:
+                if itemCategory == category:
+                    QTreeWidgetItem(group, [name, str(histogram.count), '%.2f' % histogram.mean(),
+                                            '%.2f' % histogram.percentile(0.5), '%.2f' % histogram.percentile(0.95),
+                                            '%.2f' % (histogram.maximum / 1e6),
+                                            formatBytes(histogram.bytes) if histogram.bytes else ''])
+        group = QTreeWidgetItem(self.tree, ["Counters and caches"])
+        for name, value in sorted(counters.items()) + recorder.gaugeValues():
+            QTreeWidgetItem(group, [name, '%.1f%%' % (value * 100) if isinstance(value, float) else str(value)])
+        for i in range(self.tree.topLevelItemCount()):
+            item = self.tree.topLevelItem(i)
+            item.setExpanded(not expanded or item.text(0) in expanded)
+
+    def reset(self):
+        recorder.reset()
+        self.refresh()
+
+    def exportTrace(self):
+        path, _ = QFileDialog.getSaveFileName(self, "Export Trace", "tranquility-trace.json", 'Trace (*.json)')
+        if path:
+            recorder.writeTrace(path)
@@ -0,0 +1,104 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import os
+
+from PyQt5.QtCore import Qt, QFile, pyqtSignal
+from PyQt5.QtWidgets import (QDialog, QHBoxLayout, QMessageBox, QPushButton, QTreeWidget, QTreeWidgetItem,
+                             QVBoxLayout)
+
+from ReadAheadCache import formatBytes
+
+KIND_LABELS = {'identical': "Identical files", 'recording': "Same recording"}
+
+
+class DuplicatesDialog(QDialog):
+    """ Duplicate groups with the copies to get rid of checked, the first of each group is the one kept. """
+    removeFromPlaylist = pyqtSignal(list)
+    filesTrashed = pyqtSignal(list)
+
+    def __init__(self, groups, parent=None):
+        super(DuplicatesDialog, self).__init__(parent)
+        self.setWindowTitle("Duplicates")
+        self.resize(700, 450)
+        self.tree = QTreeWidget()
+        self.tree.setHeaderLabels(("File", "Size"))
+        self.tree.setUniformRowHeights(True)
+        self.tree.header().resizeSection(0, 560)
+        # Groups are filled in without per item signals, a big library can have thousands
+        self.tree.setUpdatesEnabled(False)
+        wasted = 0
+        for group in groups:
+            sizes = [self.fileSize(path) for path in group.paths]
+            wasted += sum(sizes[1:])
+            top = QTreeWidgetItem(self.tree, ["%s, %d copies" % (KIND_LABELS[group.kind], len(group.paths)),
+                                              formatBytes(sum(sizes[1:]))])
+            for position, (path, size) in enumerate(zip(group.paths, sizes)):
+                item = QTreeWidgetItem(top, [path, formatBytes(size)])
+                item.setData(0, Qt.UserRole, path)
+                item.setFlags(item.flags() | Qt.ItemIsUserCheckable)
+                item.setCheckState(0, Qt.Checked if position else Qt.Unchecked)
+            top.setExpanded(len(groups) < 200)
+        self.tree.setUpdatesEnabled(True)
+        self.setWindowTitle("Duplicates: %d groups, %s in extra copies" % (len(groups), formatBytes(wasted)))
+
+        keepFirst = QPushButton("Keep First in Each Group")
+        keepFirst.clicked.connect(lambda: self.checkAll(lambda position: position > 0))
+        uncheck = QPushButton("Uncheck All")
+        uncheck.clicked.connect(lambda: self.checkAll(lambda position: False))
+        remove = QPushButton("Remove Checked from Playlist")
+        remove.clicked.connect(lambda: self.removeFromPlaylist.emit(self.checkedPaths()))
+        trash = QPushButton("Move Checked to Trash...")
+        trash.clicked.connect(self.trashChecked)
+        # QFile.moveToTrash is new in Qt 5.15
+        trash.setEnabled(hasattr(QFile, 'moveToTrash'))
+        close = QPushButton("Close")
+        close.clicked.connect(self.accept)
+        buttons = QHBoxLayout()
+        buttons.addWidget(keepFirst)
+        buttons.addWidget(uncheck)
+        buttons.addStretch()
+        buttons.addWidget(remove)
+        buttons.addWidget(trash)
+        buttons.addWidget(close)
+        layout = QVBoxLayout()
+        layout.addWidget(self.tree)
+        layout.addLayout(buttons)
+        self.setLayout(layout)
+
+    @staticmethod
+    def fileSize(path):
+        try:
+            return os.path.getsize(path)
+        except OSError:
+            return 0
+
+    def items(self):
+        for i in range(self.tree.topLevelItemCount()):
+            top = self.tree.topLevelItem(i)
+            for position in range(top.childCount()):
+                yield top, position, top.child(position)
+
+    def checkAll(self, checked):
+        for top, position, item in self.items():
+            item.setCheckState(0, Qt.Checked if checked(position) else Qt.Unchecked)
+
+    def checkedPaths(self):
+        return [item.data(0, Qt.UserRole) for top, position, item in self.items() if item.checkState(0) == Qt.Checked]
+
+    def trashChecked(self):
+        paths = self.checkedPaths()
+        if not paths:
+            return
+        # A group with every copy checked would lose the recording altogether
+        for i in range(self.tree.topLevelItemCount()):
+            top = self.tree.topLevelItem(i)
+            if all(top.child(position).checkState(0) == Qt.Checked for position in range(top.childCount())):
+                QMessageBox.warning(self, "Duplicates", "Keep at least one copy in each group.")
+                return
+        if QMessageBox.question(self, "Duplicates", "Move %d files to the trash?" % len(paths)) != QMessageBox.Yes:
+            return
+        trashed = [path for path in paths if QFile.moveToTrash(path)]
+        for top, position, item in list(self.items()):
+            if item.data(0, Qt.UserRole) in trashed:
+                top.removeChild(item)
+        self.filesTrashed.emit(trashed)
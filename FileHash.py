@@ -0,0 +1,54 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import hashlib
+import os
+
+PARTIAL_BYTES = 64 * 1024
+READ_CHUNK = 1024 * 1024
+
+
+def partialHash(path, size=None):
+    """ Hash of the size, the head and the tail of a file, cheap enough to compare whole libraries. """
+    if size is None:
+        size = os.path.getsize(path)
+    digest = hashlib.blake2b(str(size).encode('ascii'), digest_size=16)
+    with open(path, 'rb') as audioFile:
+        digest.update(audioFile.read(PARTIAL_BYTES))
+        if size > 2 * PARTIAL_BYTES:
+            audioFile.seek(-PARTIAL_BYTES, os.SEEK_END)
+            digest.update(audioFile.read(PARTIAL_BYTES))
+    return digest.hexdigest()
+
+
+def fullHash(path):
+    digest = hashlib.blake2b(digest_size=16)
+    with open(path, 'rb') as audioFile:
+        for chunk in iter(lambda: audioFile.read(READ_CHUNK), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def duplicateIndexes(paths):
+    """ Indexes of the paths whose content equals that of an earlier path.
+
+    Files are compared in tiers so that most are never read: only files of equal size get a partial
+    hash, and only files with equal partial hashes are hashed in full.
+    """
+    groups = splitBy(paths, range(len(paths)), os.path.getsize)
+    for digest in (partialHash, fullHash):
+        groups = [group for positions in groups for group in splitBy(paths, positions, digest)]
+    duplicates = []
+    for group in groups:
+        duplicates.extend(group[1:])
+    return sorted(duplicates)
+
+
+def splitBy(paths, positions, digest):
+    """ Groups of two or more positions whose paths have the same digest, in position order. """
+    groups = {}
+    for position in positions:
+        try:
+            groups.setdefault(digest(paths[position]), []).append(position)
+        except OSError:
+            continue
+    return [group for group in groups.values() if len(group) > 1]
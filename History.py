@@ -0,0 +1,209 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import sqlite3
+import threading
+import time
+from collections import namedtuple
+
+from Instrumentation import span
+
+START, COMPLETE, SKIP = 0, 1, 2
+KIND_NAMES = {START: 'start', COMPLETE: 'complete', SKIP: 'skip'}
+# Leaving a track after this much of it counts as a play, before that as a skip
+COMPLETE_FRACTION = 0.5
+FLUSH_COUNT = 256
+FLUSH_SECONDS = 10
+# Events kept while the database cannot be written, the oldest are dropped beyond this
+MAX_PENDING = 100000
+# Shuffle keeps drawing tracks that are always skipped, only less often
+MIN_WEIGHT = 0.2
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS paths (
+    id INTEGER PRIMARY KEY,
+    path TEXT NOT NULL UNIQUE
+);
+CREATE TABLE IF NOT EXISTS events (
+    time INTEGER NOT NULL,
+    track INTEGER NOT NULL,
+    kind INTEGER NOT NULL,
+    position INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS events_time ON events(time);
+CREATE INDEX IF NOT EXISTS events_track ON events(track, time);
+CREATE TABLE IF NOT EXISTS counters (
+    track INTEGER PRIMARY KEY,
+    plays INTEGER NOT NULL,
+    skips INTEGER NOT NULL,
+    lastPlayed INTEGER NOT NULL
+);
+"""
+
+STORE_COUNTER = """
+INSERT INTO counters (track, plays, skips, lastPlayed) VALUES (?, ?, ?, ?)
+ON CONFLICT(track) DO UPDATE SET plays = plays + excluded.plays, skips = skips + excluded.skips,
+    lastPlayed = MAX(lastPlayed, excluded.lastPlayed)
+"""
+
+# Times are milliseconds since the epoch, positions milliseconds into the track
+Event = namedtuple('Event', 'time path kind position')
+TrackStats = namedtuple('TrackStats', 'plays skips lastPlayed')
+
+
+class History(object):
+    """ Append-only log of playback events with per-track counters, kept in its own SQLite file.
+
+    record() only appends to a list, a writer thread stores the list in one transaction once it
+    holds FLUSH_COUNT events, every FLUSH_SECONDS and on close, so playback never waits on the disk.
+    onPlays(plays) is called on the writer thread with (path, time) pairs of the completed plays.
+    """
+
+    def __init__(self, path, onPlays=None, flushCount=FLUSH_COUNT, flushSeconds=FLUSH_SECONDS):
+        self.onPlays = onPlays
+        self.flushCount = flushCount
+        self.flushSeconds = flushSeconds
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('PRAGMA synchronous=NORMAL')
+        self.db.executescript(SCHEMA)
+        self.pending = []
+        self.condition = threading.Condition()
+        self.closed = False
+        self.pathIds = {}
+        # (plays, skips) by path for the shuffle weights, filled in by the writer thread
+        self.counts = {}
+        self.writer = threading.Thread(target=self.writeEvents, daemon=True)
+        self.writer.start()
+
+    def record(self, kind, path, position=0):
+        with self.condition:
+            self.pending.append(Event(int(time.time() * 1000), path, kind, int(position)))
+            if len(self.pending) >= self.flushCount:
+                self.condition.notify()
+
+    def flush(self):
+        """ Wake the writer thread to store the pending events now. """
+        with self.condition:
+            self.condition.notify()
+
+    def close(self):
+        with self.condition:
+            self.closed = True
+            self.condition.notify()
+        self.writer.join()
+        with self.lock:
+            self.db.close()
+
+    def writeEvents(self):
+        self.loadCounts()
+        failed = False
+        while True:
+            with self.condition:
+                # After a failed write the next try waits for the interval even with a full batch
+                if not self.closed and (failed or len(self.pending) < self.flushCount):
+                    self.condition.wait(self.flushSeconds)
+                events, self.pending = self.pending, []
+                closed = self.closed
+            failed = bool(events) and not self.store(events)
+            if failed:
+                with self.condition:
+                    self.pending[:0] = events
+                    del self.pending[:-MAX_PENDING]
+            if closed:
+                return
+
+    def loadCounts(self):
+        try:
+            with self.lock:
+                self.counts = {path: (plays, skips) for path, plays, skips in self.db.execute(
+                    'SELECT p.path, c.plays, c.skips FROM counters c JOIN paths p ON p.id = c.track')}
+        except sqlite3.Error:
+            # Shuffle weighs every track the same until the counters can be read
+            pass
+
+    def store(self, events):
+        """ Write a batch of events, returns False when the database could not take them. """
+        counters = {}
+        for event in events:
+            if event.kind != START:
+                plays, skips, last = counters.get(event.path, (0, 0, 0))
+                if event.kind == COMPLETE:
+                    counters[event.path] = (plays + 1, skips, max(last, event.time // 1000))
+                else:
+                    counters[event.path] = (plays, skips + 1, last)
+        try:
+            with span('write history') as io, self.lock, self.db:
+                ids = self.trackIds({event.path for event in events})
+                self.db.executemany('INSERT INTO events (time, track, kind, position) VALUES (?, ?, ?, ?)',
+                                    ((event.time, ids[event.path], event.kind, event.position) for event in events))
+                self.db.executemany(STORE_COUNTER, ((ids[path],) + counter for path, counter in counters.items()))
+                io.size = len(events)
+        except sqlite3.Error:
+            # A locked database or a full disk, the transaction was rolled back and with it any new path ids
+            self.pathIds.clear()
+            return False
+        for path, (plays, skips, last) in counters.items():
+            oldPlays, oldSkips = self.counts.get(path, (0, 0))
+            self.counts[path] = (oldPlays + plays, oldSkips + skips)
+        plays = [(event.path, event.time // 1000) for event in events if event.kind == COMPLETE]
+        if plays and self.onPlays is not None:
+            self.onPlays(plays)
+        return True
+
+    def trackIds(self, paths):
+        missing = [path for path in paths if path not in self.pathIds]
+        if missing:
+            self.db.executemany('INSERT OR IGNORE INTO paths (path) VALUES (?)', ((path,) for path in missing))
+            for start in range(0, len(missing), 500):
+                chunk = missing[start:start + 500]
+                self.pathIds.update(self.db.execute('SELECT path, id FROM paths WHERE path IN (%s)'
+                                                    % ','.join('?' * len(chunk)), chunk))
+        return self.pathIds
+
+    # Queries, events() and stats() include the events still waiting for the writer
+
+    def events(self, start=0, end=None, limit=1000):
+        """ The first events from start up to end, as Event tuples in time order. """
+        end = end if end is not None else 1 << 62
+        with self.lock:
+            rows = self.db.execute('SELECT e.time, p.path, e.kind, e.position FROM events e '
+                                   'JOIN paths p ON p.id = e.track WHERE e.time >= ? AND e.time < ? '
+                                   'ORDER BY e.time LIMIT ?', (start, end, limit)).fetchall()
+        events = [Event._make(row) for row in rows]
+        with self.condition:
+            events.extend(event for event in self.pending if start <= event.time < end)
+        return events[:limit]
+
+    def topTracks(self, start=None, end=None, limit=25):
+        """ (path, plays) of the most played tracks, over the whole history unless a range is given.
+        Only stored plays are counted. """
+        with self.lock:
+            if start is None and end is None:
+                rows = self.db.execute('SELECT p.path, c.plays FROM counters c JOIN paths p ON p.id = c.track '
+                                       'WHERE c.plays > 0 ORDER BY c.plays DESC, p.path LIMIT ?', (limit,))
+            else:
+                rows = self.db.execute('SELECT p.path, COUNT(*) AS plays FROM events e JOIN paths p ON p.id = e.track '
+                                       'WHERE e.time >= ? AND e.time < ? AND e.kind = ? GROUP BY e.track '
+                                       'ORDER BY plays DESC, p.path LIMIT ?',
+                                       (start or 0, end if end is not None else 1 << 62, COMPLETE, limit))
+            return rows.fetchall()
+
+    def stats(self, path):
+        with self.lock:
+            row = self.db.execute('SELECT c.plays, c.skips, c.lastPlayed FROM counters c JOIN paths p '
+                                  'ON p.id = c.track WHERE p.path = ?', (path,)).fetchone()
+        plays, skips, lastPlayed = row if row is not None else (0, 0, 0)
+        with self.condition:
+            for event in self.pending:
+                if event.path == path and event.kind == COMPLETE:
+                    plays += 1
+                    lastPlayed = max(lastPlayed, event.time // 1000)
+                elif event.path == path and event.kind == SKIP:
+                    skips += 1
+        return TrackStats(plays, skips, lastPlayed)
+
+    def weight(self, path):
+        """ Chance in [MIN_WEIGHT, 1] that shuffle keeps the track, lower for tracks skipped more than played. """
+        plays, skips = self.counts.get(path, (0, 0))
+        return max(MIN_WEIGHT, (plays + 1.0) / (plays + skips + 1.0))
@@ -0,0 +1,17 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import os
+
+from PyQt5.QtGui import QIcon
+
+IMAGES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'Images')
+
+icons = {}
+
+
+def icon(name):
+    """ Shared QIcon for a file in Images, each file is only read and decoded once per run. """
+    cached = icons.get(name)
+    if cached is None:
+        cached = icons[name] = QIcon(os.path.join(IMAGES_DIR, name))
+    return cached
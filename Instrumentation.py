@@ -0,0 +1,190 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import functools
+import json
+import os
+import threading
+from collections import deque
+from time import perf_counter_ns
+
+# Set to a file name to record from startup and write a Chrome trace there on exit
+TRACE_ENV = 'TRANQUILITY_TRACE'
+MAX_EVENTS = 200000
+BUCKETS = 32
+
+
+class Histogram(object):
+    """ Durations in power of two microsecond buckets, cheap to update and good enough for percentiles. """
+    __slots__ = ('counts', 'count', 'total', 'maximum', 'bytes')
+
+    def __init__(self):
+        self.counts = [0] * BUCKETS
+        self.count = 0
+        self.total = 0
+        self.maximum = 0
+        self.bytes = 0
+
+    def add(self, duration, size=0):
+        self.counts[min(BUCKETS - 1, (duration // 1000).bit_length())] += 1
+        self.count += 1
+        self.total += duration
+        self.maximum = max(self.maximum, duration)
+        self.bytes += size
+
+    def mean(self):
+        """ Mean duration in ms. """
+        return self.total / self.count / 1e6 if self.count else 0.0
+
+    def percentile(self, fraction):
+        """ Upper bound in ms of the bucket holding the given fraction of the durations. """
+        wanted = fraction * self.count
+        seen = 0
+        for bucket, count in enumerate(self.counts):
+            seen += count
+            if count and seen >= wanted:
+                return min((1 << bucket) / 1000, self.maximum / 1e6)
+        return self.maximum / 1e6
+
+
+class Recorder(object):
+    """ Timings, counters and trace events of the whole player, a no-op unless enabled.
+
+    Instrumented code only checks the enabled flag when recording is off. When it is on, each
+    measurement updates a histogram per (category, name) and appends a trace event to a bounded
+    buffer that can be exported in the Chrome trace event format.
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self.origin = perf_counter_ns()
+        self.lock = threading.Lock()
+        self.histograms = {}
+        self.counters = {}
+        self.gauges = {}
+        self.events = deque(maxlen=MAX_EVENTS)
+        self.threadNames = {}
+
+    def setEnabled(self, enabled):
+        self.enabled = enabled
+
+    def record(self, category, name, started, finished, size=0):
+        thread = threading.current_thread()
+        with self.lock:
+            histogram = self.histograms.get((category, name))
+            if histogram is None:
+                histogram = self.histograms[(category, name)] = Histogram()
+            histogram.add(finished - started, size)
+            self.events.append(('X', category, name, started, finished - started, thread.ident, size))
+            if thread.ident not in self.threadNames:
+                self.threadNames[thread.ident] = thread.name
+
+    def count(self, name, amount=1):
+        if not self.enabled:
+            return
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + amount
+
+    def sample(self, name, value):
+        """ A counter track in the trace, e.g. the event loop lag over time. """
+        if not self.enabled:
+            return
+        self.events.append(('C', 'sample', name, perf_counter_ns(), value, threading.get_ident(), 0))
+
+    def addGauge(self, name, function):
+        """ function returns the current value of name, it is only called when the values are shown. """
+        self.gauges[name] = function
+
+    def gaugeValues(self):
+        values = []
+        for name, function in sorted(self.gauges.items()):
+            try:
+                values.append((name, function()))
+            except Exception:
+                continue
+        return values
+
+    def snapshot(self):
+        """ ((category, name), Histogram) pairs sorted by total time, and the counters. """
+        with self.lock:
+            histograms = sorted(self.histograms.items(), key=lambda item: -item[1].total)
+            return histograms, dict(self.counters)
+
+    def reset(self):
+        with self.lock:
+            self.histograms = {}
+            self.counters = {}
+            self.events.clear()
+
+    def traceEvents(self):
+        pid = os.getpid()
+        with self.lock:
+            events = list(self.events)
+            threadNames = dict(self.threadNames)
+        trace = [{'name': 'thread_name', 'ph': 'M', 'pid': pid, 'tid': tid, 'args': {'name': name}}
+                 for tid, name in threadNames.items()]
+        for phase, category, name, started, value, tid, size in events:
+            event = {'name': name, 'cat': category, 'ph': phase, 'pid': pid, 'tid': tid,
+                     'ts': (started - self.origin) / 1000}
+            if phase == 'X':
+                event['dur'] = value / 1000
+                if size:
+                    event['args'] = {'bytes': size}
+            else:
+                event['args'] = {name: value}
+            trace.append(event)
+        return trace
+
+    def writeTrace(self, path):
+        """ Write the buffered events as a Chrome trace event file, for chrome://tracing or Perfetto. """
+        data = json.dumps({'traceEvents': self.traceEvents(), 'displayTimeUnit': 'ms',
+                           'otherData': {'counters': self.snapshot()[1]}})
+        temp = path + '.tmp'
+        with open(temp, 'w') as f:
+            f.write(data)
+        os.replace(temp, path)
+
+
+recorder = Recorder()
+
+
+def timed(category='slot', name=None):
+    """ Decorator recording the duration of every call while the recorder is enabled. """
+    def decorate(function):
+        label = name or function.__qualname__
+
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if not recorder.enabled:
+                return function(*args, **kwargs)
+            started = perf_counter_ns()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                recorder.record(category, label, started, perf_counter_ns())
+        return wrapper
+    return decorate
+
+
+class span(object):
+    """ Context manager timing an I/O operation, set size to the number of bytes it moved. """
+    __slots__ = ('name', 'started', 'size')
+
+    def __init__(self, name, size=0):
+        self.name = name
+        self.size = size
+        self.started = None
+
+    def __enter__(self):
+        if recorder.enabled:
+            self.started = perf_counter_ns()
+        return self
+
+    def __exit__(self, *exc):
+        if self.started is not None:
+            recorder.record('io', self.name, self.started, perf_counter_ns(), self.size)
+        return False
+
+
+def tracePath():
+    """ Where TRANQUILITY_TRACE asks for a trace to be written, or None. """
+    return os.environ.get(TRACE_ENV) or None
@@ -0,0 +1,396 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import os
+import json
+import sqlite3
+import threading
+import time
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+from Instrumentation import timed
+
+AUDIO_EXTENSIONS = frozenset(('.mp3', '.flac', '.ogg', '.oga', '.opus', '.m4a', '.mp4', '.aac', '.wav',
+                              '.wma', '.aif', '.aiff', '.ape', '.wv'))
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS directories (
+    path TEXT PRIMARY KEY,
+    parent TEXT,
+    mtime INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS directories_parent ON directories(parent);
+CREATE TABLE IF NOT EXISTS tracks (
+    path TEXT PRIMARY KEY,
+    directory TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    mtime INTEGER NOT NULL,
+    title TEXT NOT NULL DEFAULT '',
+    artist TEXT NOT NULL DEFAULT '',
+    album TEXT NOT NULL DEFAULT '',
+    duration INTEGER NOT NULL DEFAULT 0,
+    genre TEXT NOT NULL DEFAULT '',
+    added INTEGER NOT NULL DEFAULT 0,
+    rating INTEGER NOT NULL DEFAULT 0,
+    plays INTEGER NOT NULL DEFAULT 0,
+    lastPlayed INTEGER NOT NULL DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS tracks_directory ON tracks(directory);
+CREATE TABLE IF NOT EXISTS fingerprints (
+    path TEXT PRIMARY KEY,
+    size INTEGER NOT NULL,
+    mtime INTEGER NOT NULL,
+    partial TEXT,
+    full TEXT,
+    acoustic BLOB
+);
+CREATE TABLE IF NOT EXISTS smart_playlists (
+    playlist TEXT PRIMARY KEY,
+    version TEXT NOT NULL,
+    query TEXT NOT NULL,
+    params TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS smart_tracks (
+    playlist TEXT NOT NULL,
+    path TEXT NOT NULL,
+    PRIMARY KEY (playlist, path)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS smart_tracks_path ON smart_tracks(path);
+"""
+
+# Track columns added after the first release, an older index gets them on open
+ADDED_COLUMNS = (('genre', "TEXT NOT NULL DEFAULT ''"), ('added', 'INTEGER NOT NULL DEFAULT 0'),
+                 ('rating', 'INTEGER NOT NULL DEFAULT 0'), ('plays', 'INTEGER NOT NULL DEFAULT 0'),
+                 ('lastPlayed', 'INTEGER NOT NULL DEFAULT 0'))
+
+# Created once the added columns exist, smart playlist rules filter and sort on them
+INDEXES = """
+CREATE INDEX IF NOT EXISTS tracks_genre ON tracks(genre COLLATE NOCASE);
+CREATE INDEX IF NOT EXISTS tracks_added ON tracks(added);
+CREATE INDEX IF NOT EXISTS tracks_rating ON tracks(rating);
+CREATE INDEX IF NOT EXISTS tracks_plays ON tracks(plays);
+CREATE INDEX IF NOT EXISTS tracks_lastPlayed ON tracks(lastPlayed);
+"""
+
+TrackRecord = namedtuple('TrackRecord', 'path directory size mtime title artist album duration genre')
+TRACK_COLUMNS = ', '.join(TrackRecord._fields)
+# Scanned tracks keep the date they were first added, their plays and their rating
+STORE_TRACK = 'INSERT INTO tracks (%s, added) VALUES (%s) ON CONFLICT(path) DO UPDATE SET %s' % (
+    TRACK_COLUMNS, ', '.join('?' * (len(TrackRecord._fields) + 1)),
+    ', '.join('%s = excluded.%s' % (field, field) for field in TrackRecord._fields[1:]))
+DirectoryScan = namedtuple('DirectoryScan', 'path parent mtime unchanged subdirs records added removed')
+# A directory that exists but cannot be read now, its part of the index is kept until it can
+UnreadableDirectory = namedtuple('UnreadableDirectory', 'path')
+
+
+def trackColumns(records):
+    """ Transpose track records into the (paths, durations, titles, artists, albums) columns of a TrackStore. """
+    return ([record.path for record in records], [record.duration for record in records],
+            [record.title for record in records], [record.artist for record in records],
+            [record.album for record in records])
+
+
+def isAudioFile(name):
+    return os.path.splitext(name)[1].lower() in AUDIO_EXTENSIONS
+
+
+class LibraryIndex(object):
+    """ Persistent SQLite index of every audio file below the configured music roots. """
+
+    def __init__(self, path):
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('PRAGMA synchronous=NORMAL')
+        self.db.executescript(SCHEMA)
+        self.migrate()
+        self.db.executescript(INDEXES)
+        self.loadSmartQueries()
+
+    def loadSmartQueries(self):
+        # Another process sharing the index can define smart playlists, its indexer reloads them before a scan
+        with self.lock:
+            self.smartQueries = {playlist: (query, tuple(json.loads(params))) for playlist, query, params in
+                                 self.db.execute('SELECT playlist, query, params FROM smart_playlists')}
+
+    def migrate(self):
+        existing = {row[1] for row in self.db.execute('PRAGMA table_info(tracks)')}
+        missing = [(name, definition) for name, definition in ADDED_COLUMNS if name not in existing]
+        if not missing:
+            return
+        with self.db:
+            for name, definition in missing:
+                self.db.execute('ALTER TABLE tracks ADD COLUMN %s %s' % (name, definition))
+            # The file date is the best guess of when a track was added, and every file is read
+            # again by the next scan to pick up its genre
+            self.db.execute('UPDATE tracks SET added = mtime / 1000000000, mtime = 0')
+            self.db.execute('UPDATE directories SET mtime = 0')
+
+    def close(self):
+        with self.lock:
+            self.db.close()
+
+    def directories(self):
+        with self.lock:
+            return dict(self.db.execute('SELECT path, mtime FROM directories'))
+
+    def subdirectories(self, directory):
+        with self.lock:
+            return [row[0] for row in self.db.execute('SELECT path FROM directories WHERE parent = ?', (directory,))]
+
+    def filesIn(self, directory):
+        with self.lock:
+            return {row[0]: (row[1], row[2]) for row in
+                    self.db.execute('SELECT path, size, mtime FROM tracks WHERE directory = ?', (directory,))}
+
+    def storeDirectory(self, scan):
+        with self.lock, self.db:
+            self.db.execute('INSERT OR REPLACE INTO directories (path, parent, mtime) VALUES (?, ?, ?)',
+                            (scan.path, scan.parent, scan.mtime))
+            now = int(time.time())
+            self.db.executemany(STORE_TRACK, (record + (now,) for record in scan.records))
+            self.db.executemany('DELETE FROM tracks WHERE path = ?', ((path,) for path in scan.removed))
+            self.db.executemany('DELETE FROM fingerprints WHERE path = ?', ((path,) for path in scan.removed))
+            self.updateSmartTracks([record.path for record in scan.records] + list(scan.removed))
+
+    def removeDirectories(self, directories):
+        with self.lock, self.db:
+            for directory in directories:
+                self.db.execute('DELETE FROM directories WHERE path = ?', (directory,))
+                self.db.execute('DELETE FROM fingerprints WHERE path IN (SELECT path FROM tracks WHERE directory = ?)',
+                                (directory,))
+                self.db.execute('DELETE FROM smart_tracks WHERE path IN (SELECT path FROM tracks WHERE directory = ?)',
+                                (directory,))
+                self.db.execute('DELETE FROM tracks WHERE directory = ?', (directory,))
+
+    def count(self):
+        with self.lock:
+            return self.db.execute('SELECT COUNT(*) FROM tracks').fetchone()[0]
+
+    def tracks(self, roots=None):
+        with self.lock:
+            rows = self.db.execute('SELECT %s FROM tracks ORDER BY path' % TRACK_COLUMNS).fetchall()
+        if roots:
+            prefixes = tuple(os.path.join(root, '') for root in roots)
+            rows = [row for row in rows if row[0].startswith(prefixes)]
+        return trackColumns([TrackRecord._make(row) for row in rows])
+
+    def records(self):
+        with self.lock:
+            return [TrackRecord._make(row) for row in self.db.execute('SELECT %s FROM tracks' % TRACK_COLUMNS)]
+
+    def recordPlays(self, plays):
+        """ Count (path, time) plays, tracks outside the library are ignored. """
+        with self.lock, self.db:
+            self.db.executemany('UPDATE tracks SET plays = plays + 1, lastPlayed = MAX(lastPlayed, ?) WHERE path = ?',
+                                ((when, path) for path, when in plays))
+            self.updateSmartTracks(list({path for path, when in plays}))
+
+    def setRating(self, paths, rating):
+        with self.lock, self.db:
+            self.db.executemany('UPDATE tracks SET rating = ? WHERE path = ?', ((rating, path) for path in paths))
+            self.updateSmartTracks(list(paths))
+
+    # Smart playlists, their members are kept in smart_tracks and updated with every change to a track
+
+    def defineSmartPlaylist(self, playlist, version, query, params):
+        """ Make playlist the tracks matching the query, rebuilt only when the version changed.
+        Returns whether the members were rebuilt. """
+        with self.lock, self.db:
+            self.smartQueries[playlist] = (query, tuple(params))
+            row = self.db.execute('SELECT version FROM smart_playlists WHERE playlist = ?', (playlist,)).fetchone()
+            if row is not None and row[0] == version:
+                return False
+            self.db.execute('DELETE FROM smart_tracks WHERE playlist = ?', (playlist,))
+            self.db.execute('INSERT INTO smart_tracks (playlist, path) SELECT ?, path FROM tracks WHERE %s' % query,
+                            (playlist,) + tuple(params))
+            self.db.execute('INSERT OR REPLACE INTO smart_playlists (playlist, version, query, params) '
+                            'VALUES (?, ?, ?, ?)', (playlist, version, query, json.dumps(list(params))))
+            return True
+
+    def retainSmartPlaylists(self, playlists):
+        """ Forget the smart playlists whose rule files are gone. """
+        with self.lock, self.db:
+            for playlist in set(self.smartQueries) - set(playlists):
+                del self.smartQueries[playlist]
+                self.db.execute('DELETE FROM smart_playlists WHERE playlist = ?', (playlist,))
+                self.db.execute('DELETE FROM smart_tracks WHERE playlist = ?', (playlist,))
+
+    def smartTracks(self, playlist, order, limit=0):
+        """ Columns of the members of playlist in the given SQL order, at most limit unless it is 0. """
+        with self.lock:
+            rows = self.db.execute('SELECT %s FROM smart_tracks JOIN tracks USING (path) WHERE playlist = ? '
+                                   'ORDER BY %s LIMIT ?' % (TRACK_COLUMNS, order), (playlist, limit or -1)).fetchall()
+        return trackColumns([TrackRecord._make(row) for row in rows])
+
+    def updateSmartTracks(self, paths):
+        # Only the changed tracks are tested against each query, called with the lock held inside a transaction
+        for start in range(0, len(paths), 500):
+            chunk = paths[start:start + 500]
+            marks = ', '.join('?' * len(chunk))
+            self.db.execute('DELETE FROM smart_tracks WHERE path IN (%s)' % marks, chunk)
+            for playlist, (query, params) in self.smartQueries.items():
+                self.db.execute('INSERT INTO smart_tracks (playlist, path) SELECT ?, path FROM tracks '
+                                'WHERE path IN (%s) AND (%s)' % (marks, query), (playlist,) + tuple(chunk) + params)
+
+    def fingerprints(self, paths):
+        """ path: (size, mtime, partial, full) of the cached hashes, for the caller to check against the file. """
+        return self.selectChunked('SELECT path, size, mtime, partial, full FROM fingerprints WHERE path IN (%s)', paths)
+
+    def acousticFingerprints(self, paths):
+        return self.selectChunked('SELECT path, size, mtime, acoustic FROM fingerprints '
+                                  'WHERE acoustic IS NOT NULL AND path IN (%s)', paths)
+
+    def selectChunked(self, query, paths):
+        result = {}
+        with self.lock:
+            # Below SQLite's limit of bound parameters
+            for start in range(0, len(paths), 500):
+                chunk = paths[start:start + 500]
+                result.update((row[0], row[1:]) for row in self.db.execute(query % ', '.join('?' * len(chunk)), chunk))
+        return result
+
+    def storeFingerprints(self, rows):
+        """ (path, size, mtime, partial, full) rows, an acoustic fingerprint is kept while the file is unchanged. """
+        with self.lock, self.db:
+            self.db.executemany('INSERT INTO fingerprints (path, size, mtime, partial, full) VALUES (?, ?, ?, ?, ?) '
+                                'ON CONFLICT(path) DO UPDATE SET partial = excluded.partial, full = excluded.full, '
+                                'acoustic = CASE WHEN size = excluded.size AND mtime = excluded.mtime '
+                                'THEN acoustic END, size = excluded.size, mtime = excluded.mtime', rows)
+
+    def storeAcousticFingerprints(self, rows):
+        """ (path, size, mtime, acoustic) rows, hashes are kept while the file is unchanged. """
+        with self.lock, self.db:
+            self.db.executemany('INSERT INTO fingerprints (path, size, mtime, acoustic) VALUES (?, ?, ?, ?) '
+                                'ON CONFLICT(path) DO UPDATE SET acoustic = excluded.acoustic, '
+                                'partial = CASE WHEN size = excluded.size AND mtime = excluded.mtime THEN partial END, '
+                                'full = CASE WHEN size = excluded.size AND mtime = excluded.mtime THEN full END, '
+                                'size = excluded.size, mtime = excluded.mtime', rows)
+
+
+class LibraryScanner(object):
+    """ Walks the music roots in a thread pool, only listing directories whose mtime changed. """
+
+    def __init__(self, index, roots, onChunk=None, onRemoved=None, tagReader=None, workers=4, chunkSize=500,
+                 deep=False):
+        self.index = index
+        self.roots = [os.path.abspath(root) for root in roots]
+        self.onChunk = onChunk
+        self.onRemoved = onRemoved
+        self.tagReader = tagReader
+        self.workers = workers
+        self.chunkSize = chunkSize
+        self.deep = deep
+        self.cancelled = threading.Event()
+        # Directories found changed or gone, nothing to publish when it stays 0
+        self.changed = 0
+
+    def cancel(self):
+        self.cancelled.set()
+
+    def scan(self):
+        known = self.index.directories()
+        visited = set()
+        unreadable = []
+        pending = []
+        removed = []
+
+        with ThreadPoolExecutor(self.workers) as pool:
+            futures = {pool.submit(self.scanDirectory, root, None, known.get(root)) for root in self.roots}
+            while futures and not self.cancelled.is_set():
+                done, futures = wait(futures, return_when=FIRST_COMPLETED)
+                for future in done:
+                    scan = future.result()
+                    if scan is None:
+                        continue
+                    if isinstance(scan, UnreadableDirectory):
+                        unreadable.append(os.path.join(scan.path, ''))
+                        continue
+                    visited.add(scan.path)
+                    if not scan.unchanged:
+                        self.changed += 1
+                        self.index.storeDirectory(scan)
+                        removed.extend(scan.removed)
+                        pending.extend(record for record in scan.records if record.path in scan.added)
+                    for subdir in scan.subdirs:
+                        futures.add(pool.submit(self.scanDirectory, subdir, scan.path, known.get(subdir)))
+                    if len(pending) >= self.chunkSize:
+                        self.flush(pending)
+                        pending = []
+            for future in futures:
+                future.cancel()
+
+        self.flush(pending)
+        if self.cancelled.is_set():
+            return
+
+        # Directories that were indexed before but are gone now, below one of the scanned roots and not
+        # inside a directory that could not be read
+        prefixes = tuple(os.path.join(root, '') for root in self.roots)
+        unreadable = tuple(unreadable)
+        vanished = [path for path in known if path not in visited and (path in self.roots or path.startswith(prefixes))
+                    and not os.path.join(path, '').startswith(unreadable)]
+        if vanished:
+            self.changed += len(vanished)
+            for directory in vanished:
+                removed.extend(self.index.filesIn(directory))
+            self.index.removeDirectories(vanished)
+        if removed and self.onRemoved is not None:
+            self.onRemoved(removed)
+
+    def flush(self, records):
+        if records and self.onChunk is not None:
+            self.onChunk(trackColumns(records))
+
+    @timed('io')
+    def scanDirectory(self, path, parent, knownMtime):
+        if self.cancelled.is_set():
+            return None
+        try:
+            mtime = os.stat(path).st_mtime_ns
+        except FileNotFoundError:
+            # A root that is gone is more likely an unmounted share than a deleted library
+            return UnreadableDirectory(path) if parent is None else None
+        except OSError:
+            return UnreadableDirectory(path)
+
+        # An unchanged directory mtime means no entries were added, removed or renamed, a deep
+        # scan still stats the files to pick up tags edited in place
+        if knownMtime == mtime and not self.deep:
+            return DirectoryScan(path, parent, mtime, True, self.index.subdirectories(path), [], (), [])
+
+        known = self.index.filesIn(path)
+        subdirs = []
+        changed = []
+        added = set()
+        present = set()
+        try:
+            with os.scandir(path) as entries:
+                for entry in entries:
+                    try:
+                        if entry.is_dir(follow_symlinks=False):
+                            subdirs.append(entry.path)
+                        elif entry.is_file() and isAudioFile(entry.name):
+                            stat = entry.stat()
+                            present.add(entry.path)
+                            if known.get(entry.path) != (stat.st_size, stat.st_mtime_ns):
+                                changed.append((entry.path, stat.st_mtime_ns, stat.st_size))
+                                if entry.path not in known:
+                                    added.add(entry.path)
+                    except OSError:
+                        continue
+        except FileNotFoundError:
+            return None if parent is not None else UnreadableDirectory(path)
+        except OSError:
+            # EIO, EACCES or a share that dropped out, the tracks stay indexed until it reads again
+            return UnreadableDirectory(path)
+
+        removed = [name for name in known if name not in present]
+        return DirectoryScan(path, parent, mtime, False, subdirs, self.readRecords(path, changed), added, removed)
+
+    def readRecords(self, directory, changed):
+        # Tags of a whole directory are read as one batch so the reader can spread them over its pool
+        if self.tagReader is None or not changed:
+            return [TrackRecord(path, directory, size, mtime, '', '', '', 0, '') for path, mtime, size in changed]
+        return [TrackRecord(path, directory, size, mtime, tags['title'], tags['artist'], tags['album'], tags['duration'],
+                            tags.get('genre', '')) for (path, mtime, size), tags in zip(changed, self.tagReader(changed))]
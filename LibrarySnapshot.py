@@ -0,0 +1,314 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import mmap
+import os
+import re
+import struct
+import sys
+from array import array
+from bisect import bisect_left
+
+from PyQt5.QtCore import QObject, QFileSystemWatcher, QTimer, pyqtSignal
+
+from SessionStore import atomicWrite, littleEndian, readArray
+
+MAGIC = b'TQLS'
+VERSION = 1
+SECTIONS = ('paths', 'titles', 'durations', 'artists', 'albums', 'names', 'nameRanks', 'playlistNames',
+            'playlistPaths', 'roots')
+# magic, version, generation, tracks, then offset and size of each section
+HEADER = struct.Struct('<4sHIQ%dQ' % (2 * len(SECTIONS)))
+SNAPSHOT_FILE = 'library-%d.snapshot'
+SNAPSHOT_PATTERN = re.compile(r'^library-(\d+)\.snapshot$')
+# Older generations are deleted once a newer one exists, players still mapping them keep their copy
+KEEP_GENERATIONS = 2
+
+
+def encodeText(text):
+    return text.encode('utf-8', 'surrogateescape')
+
+
+def textSection(strings):
+    """ Count, count + 1 offsets and the UTF-8 data of a list of strings. """
+    data = [encodeText(text) for text in strings]
+    offsets = array('Q', [0]) * (len(data) + 1)
+    for index, encoded in enumerate(data):
+        offsets[index + 1] = offsets[index] + len(encoded)
+    return b''.join([struct.pack('<Q', len(data)), littleEndian(offsets).tobytes()] + data)
+
+
+def nativeArray(typecode, view):
+    # The mapping is used in place where the byte order allows it
+    if sys.byteorder == 'little':
+        return view.cast(typecode)
+    return readArray(typecode, view, 0, len(view) // array(typecode).itemsize)[0]
+
+
+class TextTable(object):
+    """ Strings of one snapshot section, decoded from the mapping each time they are read. """
+    __slots__ = ('offsets', 'data')
+
+    def __init__(self, view):
+        count = struct.unpack_from('<Q', view, 0)[0]
+        end = 8 + 8 * (count + 1)
+        self.offsets = nativeArray('Q', view[8:end])
+        self.data = view[end:]
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def get(self, index):
+        return str(self.data[self.offsets[index]:self.offsets[index + 1]], 'utf-8', 'surrogateescape')
+
+    def encoded(self, index):
+        return self.data[self.offsets[index]:self.offsets[index + 1]].tobytes()
+
+
+class TextColumn(object):
+    """ Read-only sequence of snapshot strings that a TrackStore uses in place of a list.
+
+    Removing and reordering rows only changes the row numbers kept here, the text stays shared.
+    """
+    __slots__ = ('table', 'rows')
+
+    def __init__(self, table, rows=None):
+        self.table = table
+        self.rows = rows
+
+    def __len__(self):
+        return len(self.table) if self.rows is None else len(self.rows)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return TextColumn(self.table, self.indexes()[index])
+        if self.rows is not None:
+            return self.table.get(self.rows[index])
+        return self.table.get(index + len(self.table) if index < 0 else index)
+
+    def __iter__(self):
+        return map(self.table.get, self.rows if self.rows is not None else range(len(self.table)))
+
+    def __iadd__(self, other):
+        if not isinstance(other, TextColumn) or other.table is not self.table:
+            return NotImplemented
+        self.rows = self.indexes()
+        self.rows += other.indexes()
+        return self
+
+    def __delitem__(self, index):
+        self.rows = self.indexes()
+        del self.rows[index]
+
+    def indexes(self):
+        return array('I', range(len(self.table))) if self.rows is None else self.rows
+
+    def select(self, order):
+        """ A column holding row order[i] of this one at row i. """
+        rows = order if self.rows is None else map(self.rows.__getitem__, order)
+        return TextColumn(self.table, array('I', rows))
+
+    def memoryUsage(self):
+        return self.rows.itemsize * len(self.rows) if self.rows is not None else 0
+
+
+class NamePool(object):
+    """ Artist and album names of a snapshot in place of a TrackStore's StringPool.
+
+    The shared names are sorted by their encoded bytes so add() finds them by bisection, names
+    that are not in the snapshot are kept in this instance only.
+    """
+
+    def __init__(self, table, ranks):
+        self.table = table
+        self.sharedRanks = ranks
+        self.added = []
+        self.lookup = {}
+
+    def __len__(self):
+        return len(self.table) + len(self.added)
+
+    @property
+    def strings(self):
+        return [self.table.get(index) for index in range(len(self.table))] + self.added
+
+    def add(self, text):
+        index = self.lookup.get(text)
+        if index is not None:
+            return index
+        key = encodeText(text)
+        low, high = 0, len(self.table)
+        while low < high:
+            middle = (low + high) // 2
+            if self.table.encoded(middle) < key:
+                low = middle + 1
+            else:
+                high = middle
+        if low < len(self.table) and self.table.encoded(low) == key:
+            index = low
+        else:
+            index = len(self.table) + len(self.added)
+            self.added.append(text)
+        self.lookup[text] = index
+        return index
+
+    def get(self, index):
+        count = len(self.table)
+        return self.table.get(index) if index < count else self.added[index - count]
+
+    def ranks(self):
+        if not self.added:
+            return self.sharedRanks
+        strings = self.strings
+        order = sorted(range(len(strings)), key=lambda index: strings[index].casefold())
+        ranks = array('I', [0]) * len(order)
+        for rank, index in enumerate(order):
+            ranks[index] = rank
+        return ranks
+
+    def memoryUsage(self):
+        return sys.getsizeof(self.added) + sys.getsizeof(self.lookup) + sum(sys.getsizeof(text) for text in self.added)
+
+
+class LibrarySnapshot(object):
+    """ One generation of the library and playlist index, published by an indexer process and mapped read-only.
+
+    Every player on the machine maps the same file, so the text of the library is held once in the page
+    cache however many players show it. Tracks are sorted by path.
+    """
+
+    def __init__(self, path):
+        with open(path, 'rb') as f:
+            self.mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        fields = HEADER.unpack_from(self.mapped, 0)
+        magic, version, self.generation, self.count = fields[:4]
+        if magic != MAGIC or version != VERSION:
+            raise ValueError("Not a library snapshot")
+        self.path = path
+        view = memoryview(self.mapped)
+        sections = {name: view[offset:offset + size]
+                    for name, offset, size in zip(SECTIONS, fields[4::2], fields[5::2])}
+        if any(len(sections[name]) < size for name, size in zip(SECTIONS, fields[5::2])):
+            raise ValueError("Truncated library snapshot")
+        self.sections = sections
+        self.paths = TextTable(sections['paths'])
+        self.titles = TextTable(sections['titles'])
+        self.names = TextTable(sections['names'])
+
+    def __len__(self):
+        return self.count
+
+    def tracks(self):
+        """ (paths, durations, titles, artists, albums, names) for TrackStore.append.
+
+        Paths, titles and names stay in the mapping, the numeric columns are copied since a player
+        changes them in place.
+        """
+        sections = self.sections
+        return (TextColumn(self.paths), readArray('i', sections['durations'], 0, self.count)[0],
+                TextColumn(self.titles), readArray('I', sections['artists'], 0, self.count)[0],
+                readArray('I', sections['albums'], 0, self.count)[0],
+                NamePool(self.names, nativeArray('I', sections['nameRanks'])))
+
+    def rowOf(self, path):
+        """ Row of a track path, or -1. """
+        paths = TextColumn(self.paths)
+        row = bisect_left(paths, path)
+        return row if row < len(paths) and paths[row] == path else -1
+
+    def playlists(self):
+        names = TextColumn(TextTable(self.sections['playlistNames']))
+        return dict(zip(names, TextColumn(TextTable(self.sections['playlistPaths']))))
+
+    def roots(self):
+        return list(TextColumn(TextTable(self.sections['roots'])))
+
+
+def snapshotGenerations(directory):
+    """ (generation, path) of the published snapshots, newest first. """
+    generations = []
+    try:
+        with os.scandir(directory) as entries:
+            for entry in entries:
+                match = SNAPSHOT_PATTERN.match(entry.name)
+                if match:
+                    generations.append((int(match.group(1)), entry.path))
+    except OSError:
+        pass
+    return sorted(generations, reverse=True)
+
+
+def publishSnapshot(directory, columns, playlists, roots):
+    """ Write (paths, durations, titles, artists, albums) sorted by path and name: path playlists
+    as the next generation, returns its number.
+
+    The file is complete before it gets its name, so a player never maps half a snapshot.
+    """
+    paths, durations, titles, artists, albums = columns
+    names = sorted(set(artists) | set(albums) | {''}, key=encodeText)
+    indexOf = {name: index for index, name in enumerate(names)}
+    ranks = array('I', [0]) * len(names)
+    for rank, index in enumerate(sorted(range(len(names)), key=lambda index: names[index].casefold())):
+        ranks[index] = rank
+    playlistNames = sorted(playlists)
+    sections = [textSection(paths), textSection(titles), littleEndian(array('i', durations)).tobytes(),
+                littleEndian(array('I', map(indexOf.__getitem__, artists))).tobytes(),
+                littleEndian(array('I', map(indexOf.__getitem__, albums))).tobytes(),
+                textSection(names), littleEndian(ranks).tobytes(), textSection(playlistNames),
+                textSection([playlists[name] for name in playlistNames]), textSection(roots)]
+    # Sections start on 8 byte boundaries so their arrays can be used from the mapping
+    layout = []
+    chunks = []
+    offset = HEADER.size
+    for section in sections:
+        padding = -offset % 8
+        chunks.append(b'\0' * padding + section)
+        offset += padding
+        layout.extend((offset, len(section)))
+        offset += len(section)
+    os.makedirs(directory, exist_ok=True)
+    existing = snapshotGenerations(directory)
+    generation = existing[0][0] + 1 if existing else 1
+    atomicWrite(os.path.join(directory, SNAPSHOT_FILE % generation),
+                [HEADER.pack(MAGIC, VERSION, generation, len(paths), *layout)] + chunks)
+    for old, path in existing[KEEP_GENERATIONS - 1:]:
+        try:
+            os.remove(path)
+        except OSError:
+            # Windows keeps a mapped file, it goes with a later generation
+            pass
+    return generation
+
+
+class SnapshotWatcher(QObject):
+    """ Maps the newest snapshot of a folder and each newer generation as it is published. """
+    snapshotChanged = pyqtSignal(object)
+
+    def __init__(self, directory, debounce=500, parent=None):
+        super(SnapshotWatcher, self).__init__(parent)
+        self.directory = directory
+        self.snapshot = None
+        os.makedirs(directory, exist_ok=True)
+        self.debounceTimer = QTimer(self)
+        self.debounceTimer.setSingleShot(True)
+        self.debounceTimer.setInterval(debounce)
+        self.debounceTimer.timeout.connect(self.check)
+        self.watcher = QFileSystemWatcher([directory], self)
+        self.watcher.directoryChanged.connect(lambda directory: self.debounceTimer.start())
+        self.load()
+
+    def load(self):
+        """ Map the newest generation if it is newer than the current one, returns whether it was. """
+        for generation, path in snapshotGenerations(self.directory):
+            if self.snapshot is not None and generation <= self.snapshot.generation:
+                return False
+            try:
+                self.snapshot = LibrarySnapshot(path)
+                return True
+            except (OSError, ValueError, struct.error):
+                # Deleted meanwhile or damaged, an older generation will do
+                continue
+        return False
+
+    def check(self):
+        if self.load():
+            self.snapshotChanged.emit(self.snapshot)
@@ -1,56 +1,126 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 import os
-from PyQt5.QtCore import Qt
-from PyQt5.QtGui import QIcon
-from PyQt5.QtWidgets import (QFileDialog, QAction, QMessageBox, QListWidget, QSlider, QLabel,
-                             QHBoxLayout, QVBoxLayout, QWidget, QSplitter)
 
+from PyQt5.QtCore import Qt, QSize
+from PyQt5.QtWidgets import (QFileDialog, QAction, QMessageBox, QListWidget, QLabel,
+                             QHBoxLayout, QVBoxLayout, QWidget, QSplitter, QTableView, QHeaderView,
+                             QAbstractItemView, QLineEdit, QMenu)
+
+from Artwork import ICON_SIZE
+from CoverView import CoverView
+from Icons import icon
 from PlaylistCtrl import PlaylistControls
+from PlaylistModel import TITLE_COLUMN, ARTIST_COLUMN, ALBUM_COLUMN, LENGTH_COLUMN
+from PositionThrottle import PositionThrottle
+from Settings import libraryRoots, setLibraryRoots, playlistRoots, setPlaylistRoots, musicDir
+from SmartPlaylists import isSmartPlaylistFile
+from WaveformSlider import WaveformSlider
+
+LIBRARY_ITEM = 'Library'
+RATING_LABELS = ('No Rating', '1 Star', '2 Stars', '3 Stars', '4 Stars', '5 Stars')
 
 
 class MainWindow(QWidget):
     def __init__(self, parent=None):
         super(MainWindow, self).__init__(parent)
         self.setWindowTitle("Tranquility Music Player")
-        self.setWindowIcon(QIcon('Images/music.ico'))
+        self.setWindowIcon(icon('music.ico'))
         self.setGeometry(300, 300, 500, 400)
 
         # Create the menubar
         mainMenu = self.menuBar()
         fileMenu = mainMenu.addMenu('File')
         playlistMenu = mainMenu.addMenu('Playlist')
+        libraryMenu = mainMenu.addMenu('Library')
+        playbackMenu = mainMenu.addMenu('Playback')
         viewMenu = mainMenu.addMenu('View')
         helpMenu = mainMenu.addMenu('Help')
 
         openFile = QAction('Open File', self)
         createPlaylist = QAction('Create Playlist', self)
+        createSmartPlaylist = QAction('Create Smart Playlist...', self)
         savePlaylist = QAction('Save Playlist', self)
+        removeDuplicates = QAction('Remove Duplicates', self)
+        removeDuplicateFiles = QAction('Remove Duplicate Files', self)
+        addPlaylistFolder = QAction('Add Playlist Folder', self)
+        addMusicFolder = QAction('Add Music Folder', self)
+        rescanLibrary = QAction('Rescan Library', self)
+        findDuplicates = QAction('Find Duplicates...', self)
+        # Loudness analysis needs ffmpeg and numpy, the actions are enabled once the core found them
+        self.analyzeAction = QAction('Analyze Loudness', self)
+        self.analyzeAction.setEnabled(False)
+        crossfade = QAction('Crossfade...', self)
+        self.normalizeAction = QAction('Normalize Loudness', self)
+        self.normalizeAction.setCheckable(True)
+        self.normalizeAction.setEnabled(False)
         toggleTheme = QAction('Toggle Black/White Theme', self)
         colorTheme = QAction('Toggle Red/ Purple Theme', self)
+        findTrack = QAction('Filter Playlist', self)
+        findTrack.setShortcut('Ctrl+F')
+        # Hidden unless asked for, recording only runs while the dock is open
+        self.diagnosticsAction = QAction('Diagnostics', self)
+        self.diagnosticsAction.setCheckable(True)
+        self.diagnosticsAction.setShortcut('Ctrl+Shift+D')
         about = QAction('About Tranquility MP', self)
 
         # Establish Context Menu actions
         self.playlistAdd = QAction('Add to Playlist', self)
         self.playlistDel = QAction('Remove from Playlist', self)
+        self.playlistUp = QAction('Move Up', self)
+        self.playlistDown = QAction('Move Down', self)
         self.delPlaylist = QAction('Delete Playlist', self)
+        self.editSmart = QAction('Edit Smart Playlist...', self)
+        # Ratings are kept in the library index for smart playlists to use
+        self.rateAction = QAction('Rate', self)
+        rateMenu = QMenu(self)
+        for stars, label in enumerate(RATING_LABELS):
+            rateMenu.addAction(label, lambda checked=False, stars=stars: self.rateSelection(stars))
+        self.rateAction.setMenu(rateMenu)
 
         fileMenu.addAction(openFile)
         playlistMenu.addAction(createPlaylist)
+        playlistMenu.addAction(createSmartPlaylist)
         playlistMenu.addAction(savePlaylist)
+        playlistMenu.addAction(removeDuplicates)
+        playlistMenu.addAction(removeDuplicateFiles)
+        playlistMenu.addAction(addPlaylistFolder)
+        libraryMenu.addAction(addMusicFolder)
+        libraryMenu.addAction(rescanLibrary)
+        libraryMenu.addAction(findDuplicates)
+        libraryMenu.addAction(self.analyzeAction)
+        playbackMenu.addAction(crossfade)
+        playbackMenu.addAction(self.normalizeAction)
         viewMenu.addAction(toggleTheme)
         viewMenu.addAction(colorTheme)
+        viewMenu.addAction(findTrack)
+        viewMenu.addAction(self.diagnosticsAction)
         helpMenu.addAction(about)
 
         openFile.triggered.connect(self.open_file)
         createPlaylist.triggered.connect(self.createPlaylist)
+        createSmartPlaylist.triggered.connect(self.createSmartPlaylist)
         savePlaylist.triggered.connect(self.savePlaylist)
+        removeDuplicates.triggered.connect(self.removeDuplicates)
+        removeDuplicateFiles.triggered.connect(self.removeDuplicateFiles)
+        addPlaylistFolder.triggered.connect(self.addPlaylistFolder)
+        addMusicFolder.triggered.connect(self.addMusicFolder)
+        rescanLibrary.triggered.connect(self.rescanLibrary)
+        findDuplicates.triggered.connect(self.findDuplicates)
+        crossfade.triggered.connect(self.setCrossfade)
+        self.analyzeAction.triggered.connect(self.analyzeLibrary)
+        self.normalizeAction.toggled.connect(lambda enabled: self.core.setNormalize(enabled))
         colorTheme.triggered.connect(self.toggleColor)
         toggleTheme.triggered.connect(self.toggleTheme)
+        findTrack.triggered.connect(self.focusFilter)
+        self.diagnosticsAction.toggled.connect(self.toggleDiagnostics)
         about.triggered.connect(self.about)
         self.playlistAdd.triggered.connect(self.open_file)
         self.playlistDel.triggered.connect(self.removeFromPlaylist)
+        self.playlistUp.triggered.connect(lambda: self.moveSelection(-1))
+        self.playlistDown.triggered.connect(lambda: self.moveSelection(1))
         self.delPlaylist.triggered.connect(self.deletePlaylist)
+        self.editSmart.triggered.connect(self.editSmartPlaylist)
 
         self.show()
 
@@ -58,58 +128,96 @@ class MainWindow(QWidget):
         cWid = QWidget()
         self.setCentralWidget(cWid)
 
-        self.currentPlaylist = QListWidget()
+        # The playlist is a virtualized table over a columnar track store, rows are only
+        # materialized for the visible part of the view
+        self.playlistModel = self.core.model
+        self.currentPlaylist = QTableView()
+        self.currentPlaylist.setModel(self.playlistModel)
         self.currentPlaylist.setFocusPolicy(Qt.NoFocus)
-        self.currentPlaylist.itemDoubleClicked.connect(self.currentSelection)
+        self.currentPlaylist.setSelectionBehavior(QAbstractItemView.SelectRows)
+        self.currentPlaylist.setSelectionMode(QAbstractItemView.ExtendedSelection)
+        self.currentPlaylist.setShowGrid(False)
+        self.currentPlaylist.setWordWrap(False)
+        self.currentPlaylist.verticalHeader().hide()
+        self.currentPlaylist.verticalHeader().setSectionResizeMode(QHeaderView.Fixed)
+        self.currentPlaylist.verticalHeader().setDefaultSectionSize(20)
+        self.currentPlaylist.setIconSize(QSize(ICON_SIZE, ICON_SIZE))
+        self.currentPlaylist.horizontalHeader().setSectionResizeMode(TITLE_COLUMN, QHeaderView.Stretch)
+        self.currentPlaylist.horizontalHeader().resizeSection(ARTIST_COLUMN, 120)
+        self.currentPlaylist.horizontalHeader().resizeSection(ALBUM_COLUMN, 120)
+        self.currentPlaylist.horizontalHeader().setSectionResizeMode(LENGTH_COLUMN, QHeaderView.Fixed)
+        self.currentPlaylist.horizontalHeader().resizeSection(LENGTH_COLUMN, 60)
+        # Clicking a header sorts by that column, the indicator starts cleared so nothing is sorted up front
+        self.currentPlaylist.horizontalHeader().setSectionsClickable(True)
+        self.currentPlaylist.horizontalHeader().setSortIndicatorShown(True)
+        self.currentPlaylist.horizontalHeader().setSortIndicator(-1, Qt.AscendingOrder)
+        self.currentPlaylist.horizontalHeader().sortIndicatorChanged.connect(self.sortPlaylist)
+        self.currentPlaylist.viewport().installEventFilter(self)
+        self.currentPlaylist.doubleClicked.connect(self.currentSelection)
         self.currentPlaylist.setContextMenuPolicy(Qt.ActionsContextMenu)
         self.currentPlaylist.addAction(self.playlistAdd)
         self.currentPlaylist.addAction(self.playlistDel)
+        self.currentPlaylist.addAction(self.playlistUp)
+        self.currentPlaylist.addAction(self.playlistDown)
+        self.currentPlaylist.addAction(self.rateAction)
+
+        # Narrows the table as the user types, backed by the model's search index
+        self.filterEdit = QLineEdit()
+        self.filterEdit.setPlaceholderText('Filter')
+        self.filterEdit.setClearButtonEnabled(True)
+        self.filterEdit.textChanged.connect(self.playlistModel.setFilterText)
+
+        playlistLayout = QVBoxLayout()
+        playlistLayout.setContentsMargins(0, 0, 0, 0)
+        playlistLayout.addWidget(self.filterEdit)
+        playlistLayout.addWidget(self.currentPlaylist)
+        playlistPane = QWidget()
+        playlistPane.setLayout(playlistLayout)
 
         self.playlistView = QListWidget()
         self.playlistView.adjustSize()
         self.playlistView.setMaximumWidth(100)
         self.playlistView.setContextMenuPolicy(Qt.ActionsContextMenu)
         self.playlistView.addAction(self.delPlaylist)
-        self.playlistView.itemDoubleClicked.connect(self.parsePlaylist)
-
-        self.seekSlider = QSlider(Qt.Horizontal)
+        self.playlistView.addAction(self.editSmart)
+        self.playlistView.addItem(LIBRARY_ITEM)
+        self.playlistView.itemDoubleClicked.connect(self.openPlaylistItem)
+        self.coverView = CoverView()
+
+        sideLayout = QVBoxLayout()
+        sideLayout.setContentsMargins(0, 0, 0, 0)
+        sideLayout.addWidget(self.playlistView)
+        sideLayout.addWidget(self.coverView)
+        sidePane = QWidget()
+        sidePane.setMaximumWidth(100)
+        sidePane.setLayout(sideLayout)
+
+        self.seekSlider = WaveformSlider(Qt.Horizontal)
         self.currentTimeLabel = QLabel('00:00')
         self.totalTimeLabel = QLabel('00:00')
-        self.seekSlider.setRange(0, self.mediaPlayer.duration() / 1000)
-        self.seekSlider.sliderMoved.connect(self.seek)
-        self.seekSlider.valueChanged.connect(self.mediaPlayer.setPosition)
+        self.positionThrottle = PositionThrottle(self.seekSlider, self.currentTimeLabel, parent=self)
+        self.positionThrottle.seekRequested.connect(self.core.seek)
 
         # Set up splitter layout to hold the display widgets
         displaySplitter = QSplitter()
-        displaySplitter.addWidget(self.playlistView)
-        displaySplitter.addWidget(self.currentPlaylist)
+        displaySplitter.addWidget(sidePane)
+        displaySplitter.addWidget(playlistPane)
 
         # Set up layout to hold the splitter layout
         displayLayout = QHBoxLayout()
         displayLayout.addWidget(displaySplitter)
 
-        # Set up layout for Playlist Controls
-        controls = PlaylistControls()
-        controls.setState(self.mediaPlayer.state())
-        controls.setVolume(self.mediaPlayer.volume())
-        controls.setMuted(self.mediaPlayer.isMuted())
-        controls.play.connect(self.mediaPlayer.play)
-        controls.pause.connect(self.mediaPlayer.pause)
-        controls.stop.connect(self.mediaPlayer.stop)
-        controls.next.connect(self.playlist.next)
-        controls.previous.connect(self.previousMedia)
-        controls.changeVolume.connect(self.mediaPlayer.setVolume)
-        controls.muteVolume.connect(self.mediaPlayer.setMuted)
-        controls.shuffle.connect(self.playlist.shuffle)
-        controls.repeatAll.connect(self.setRepeatAll)
-        controls.repeatOne.connect(self.setRepeatOne)
-
-        self.mediaPlayer.stateChanged.connect(controls.setState)
-        self.mediaPlayer.volumeChanged.connect(controls.setVolume)
-        self.mediaPlayer.mutedChanged.connect(controls.setMuted)
+        # Set up layout for Playlist Controls, they stay disabled until the engine is connected
+        self.controls = PlaylistControls()
+        self.controls.setEnabled(False)
+        self.controls.next.connect(self.core.next)
+        self.controls.previous.connect(self.core.previous)
+        self.controls.shuffle.connect(self.setShuffle)
+        self.controls.repeatAll.connect(self.setRepeatAll)
+        self.controls.repeatOne.connect(self.setRepeatOne)
 
         controlLayout = QHBoxLayout()
-        controlLayout.addWidget(controls)
+        controlLayout.addWidget(self.controls)
 
         # Set up layout for Seek controls
         seekLayout = QHBoxLayout()
@@ -123,50 +231,119 @@ class MainWindow(QWidget):
 
         self.setLayout(mainLayout)
         cWid.setLayout(mainLayout)
+        self.statusBar()
 
-        if not self.mediaPlayer.isAvailable():
+    def connectEngine(self):
+        """ Wire the controls to the core's engine, which is created after the window is first painted. """
+        controls = self.controls
+        engine = self.core.engine
+        self.seekSlider.setRange(0, engine.duration() // 1000)
+        controls.setState(engine.state())
+        controls.setVolume(engine.volume())
+        controls.setMuted(engine.isMuted())
+        controls.play.connect(self.core.play)
+        controls.pause.connect(self.core.pause)
+        controls.stop.connect(self.core.stop)
+        controls.changeVolume.connect(self.core.setVolume)
+        controls.muteVolume.connect(self.core.setMuted)
+
+        engine.durationChanged.connect(self.durationChanged)
+        engine.positionChanged.connect(self.positionChanged)
+        engine.metaDataChanged.connect(self.metaDataChanged)
+        engine.mediaStatusChanged.connect(self.statusChanged)
+        engine.stateChanged.connect(controls.setState)
+        engine.volumeChanged.connect(controls.setVolume)
+        engine.mutedChanged.connect(controls.setMuted)
+
+        if not engine.isAvailable():
             QMessageBox.warning(self, "Service not available")
 
-            controls.setEnabled(False)
             self.currentPlaylist.setEnabled(False)
+        else:
+            controls.setEnabled(True)
 
         self.metaDataChanged()
-        self.statusBar()
 
     def open_file(self):
-        fileNames, _ = QFileDialog.getOpenFileNames(self, "Open Files", "C:\\Users\\dchtk\\Music", 'All Files(*.*)')
+        fileNames, _ = QFileDialog.getOpenFileNames(self, "Open Files", musicDir(), 'All Files(*.*)')
         self.addToPlaylist(fileNames)
 
-    def currentSelection(self):
-        currentSelection = self.currentPlaylist.currentRow()
-        self.playlist.setCurrentIndex(currentSelection)
-        self.mediaPlayer.play()
+    def currentSelection(self, index):
+        self.core.playTrack(self.playlistModel.storeRow(index.row()))
+
+    def focusFilter(self):
+        self.filterEdit.setFocus()
+        self.filterEdit.selectAll()
+
+    def selectedRows(self):
+        rows = sorted(index.row() for index in self.currentPlaylist.selectionModel().selectedRows())
+        if not rows and self.currentPlaylist.currentIndex().isValid():
+            rows = [self.currentPlaylist.currentIndex().row()]
+        return rows
 
     def removeFromPlaylist(self):
-        selectedTrack = self.currentPlaylist.currentRow()
-        self.playlist.setCurrentIndex(selectedTrack)
-        self.currentPlaylist.takeItem(selectedTrack)
-        self.playlist.removeMedia(selectedTrack)
+        self.core.removeTracks([self.playlistModel.storeRow(row) for row in self.selectedRows()])
+
+    def moveSelection(self, offset):
+        rows = self.selectedRows()
+        if rows:
+            destination = rows[0] - 1 if offset < 0 else rows[-1] + 2
+            self.core.keepCurrentTrack(self.playlistModel.moveTracks, rows,
+                                  max(0, min(destination, self.playlistModel.rowCount())))
+
+    def sortPlaylist(self, column, order):
+        self.core.keepCurrentTrack(self.playlistModel.sort, column, order)
+
+    def removeDuplicates(self):
+        self.setStatusInfo("%d duplicates removed" % self.core.removeTracks(self.playlistModel.duplicateRows()))
+
+    def addMusicFolder(self):
+        folder = QFileDialog.getExistingDirectory(self, "Add Music Folder", os.path.expanduser('~'))
+        if folder:
+            roots = libraryRoots()
+            if folder not in roots:
+                setLibraryRoots(roots + [folder])
+            self.rescanLibrary()
+
+    def addPlaylistFolder(self):
+        folder = QFileDialog.getExistingDirectory(self, "Add Playlist Folder", os.path.expanduser('~'))
+        if folder:
+            roots = playlistRoots()
+            if folder not in roots:
+                setPlaylistRoots(roots + [folder])
+            self.registry.addRoot(folder)
+
+    def openPlaylistItem(self, item):
+        if item.text() == LIBRARY_ITEM:
+            self.showLibrary()
+        else:
+            self.parsePlaylist()
 
     def deletePlaylist(self):
         selectedPlaylist = self.playlistView.currentRow()
-        self.playlistView.takeItem(selectedPlaylist)
+        item = self.playlistView.item(selectedPlaylist)
+        if item is None or item.text() == LIBRARY_ITEM:
+            return
+        path = self.registry.path(item.text())
+        if path is None:
+            self.playlistView.takeItem(selectedPlaylist)
+            return
+        answer = QMessageBox.question(self, "Delete Playlist", "Delete the playlist file %s?" % path)
+        if answer == QMessageBox.Yes:
+            os.remove(path)
+            self.registry.refresh(os.path.dirname(path))
 
     def parsePlaylist(self, lines=None):
-        path = "C:\\Users\dchtk\\Music\\Playlists"
-        arr = os.listdir(path)
-        for x in arr:
-            xpath = os.path.join(path, x)
-            if self.playlistView.selectedItems()[0].text() in xpath:
-                item = xpath
-                plFile = open(item, 'r')
-                if plFile.mode == "r":
-                    songs = plFile.read()
-                    if self.currentPlaylist.count() > 0:
-                        self.currentPlaylist.clear()
-                        self.currentPlaylist.addItem(songs)
-                    else:
-                        self.currentPlaylist.addItem(songs)
+        # Contents are only read now that the playlist was picked, recent ones come from the cache
+        name = self.playlistView.selectedItems()[0].text()
+        path = self.registry.path(name)
+        if path is None:
+            return
+        if isSmartPlaylistFile(path):
+            self.openSmartPlaylist(path)
+            return
+        self.core.clear()
+        self.loadPlaylistBatches(self.registry.batches(name))
 
     def about(self):
         QMessageBox.information(self, "About Tranquility MP", "Tranquility Media Player Version 1.0,\n\n"
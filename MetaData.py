@@ -0,0 +1,486 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import io
+import os
+import pickle
+import struct
+import threading
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+
+from Instrumentation import recorder, span
+
+# Only the first few kilobytes of a file are ever needed to find the tags and stream header
+PROBE_SIZE = 64 * 1024
+MAX_FRAME_SIZE = 1024 * 1024
+
+TAG_FIELDS = ('title', 'artist', 'album', 'genre', 'duration')
+
+ID3_FRAMES = {
+    'TIT2': 'title', 'TPE1': 'artist', 'TPE2': 'albumartist', 'TALB': 'album', 'TCON': 'genre', 'TLEN': 'length',
+    'TT2': 'title', 'TP1': 'artist', 'TP2': 'albumartist', 'TAL': 'album', 'TCO': 'genre', 'TLE': 'length',
+}
+
+VORBIS_FIELDS = {'TITLE': 'title', 'ARTIST': 'artist', 'ALBUMARTIST': 'albumartist', 'ALBUM': 'album',
+                 'GENRE': 'genre'}
+
+MP4_ATOMS = {b'\xa9nam': 'title', b'\xa9ART': 'artist', b'aART': 'albumartist', b'\xa9alb': 'album',
+             b'\xa9gen': 'genre'}
+
+MP3_BITRATES = {
+    (1, 1): (0, 32, 64, 96, 128, 160, 192, 224, 256, 288, 320, 352, 384, 416, 448),
+    (1, 2): (0, 32, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320, 384),
+    (1, 3): (0, 32, 40, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320),
+    (2, 1): (0, 32, 48, 56, 64, 80, 96, 112, 128, 144, 160, 176, 192, 224, 256),
+    (2, 2): (0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160),
+    (2, 3): (0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160),
+}
+MP3_SAMPLE_RATES = {1: (44100, 48000, 32000), 2: (22050, 24000, 16000), 2.5: (11025, 12000, 8000)}
+
+
+def readTags(path):
+    """ Parse the tags and duration of an audio file, returns a dict with TAG_FIELDS keys. """
+    tags = {}
+    try:
+        with open(path, 'rb') as f:
+            magic = f.read(12)
+            f.seek(0)
+            if magic.startswith(b'fLaC') or (magic.startswith(b'ID3') and path.lower().endswith('.flac')):
+                readFlac(f, tags)
+            elif magic.startswith(b'OggS'):
+                readOgg(f, tags)
+            elif magic[4:8] == b'ftyp':
+                readMp4(f, tags)
+            else:
+                readMp3(f, tags)
+    except (OSError, struct.error, ValueError, IndexError):
+        pass
+    return normalizeTags(tags)
+
+
+def normalizeTags(tags):
+    result = {'title': tags.get('title', ''), 'artist': tags.get('artist') or tags.get('albumartist', ''),
+              'album': tags.get('album', ''), 'genre': tags.get('genre', ''), 'duration': tags.get('duration', 0)}
+    if not result['duration'] and tags.get('length', '').isdigit():
+        result['duration'] = int(tags['length'])
+    return result
+
+
+def syncsafe(data):
+    return (data[0] << 21) | (data[1] << 14) | (data[2] << 7) | data[3]
+
+
+def decodeText(data):
+    if not data:
+        return ''
+    encoding = data[0]
+    data = data[1:]
+    if encoding == 1:
+        text = data.decode('utf-16', 'replace')
+    elif encoding == 2:
+        text = data.decode('utf-16-be', 'replace')
+    elif encoding == 3:
+        text = data.decode('utf-8', 'replace')
+    else:
+        text = data.decode('latin-1')
+    # ID3v2.4 separates multiple values with a null character
+    return '; '.join(value for value in text.split('\x00') if value)
+
+
+def readId3(f, tags):
+    """ Read an ID3v2 tag at the current position and return the offset of the audio data. """
+    start = f.tell()
+    header = f.read(10)
+    if len(header) < 10 or not header.startswith(b'ID3'):
+        f.seek(start)
+        return start
+    major = header[3]
+    flags = header[5]
+    size = syncsafe(header[6:10])
+    end = start + 10 + size + (10 if flags & 0x10 else 0)
+
+    if flags & 0x80 and major < 4:
+        # Tag level unsynchronisation has to be undone before the frames can be walked
+        f = io.BytesIO(f.read(min(size, MAX_FRAME_SIZE)).replace(b'\xff\x00', b'\xff'))
+        limit = size
+    else:
+        limit = start + 10 + size
+    if flags & 0x40:
+        extended = f.read(4)
+        f.seek(syncsafe(extended) - 4 if major == 4 else struct.unpack('>I', extended)[0], 1)
+
+    headerSize = 6 if major == 2 else 10
+    while f.tell() + headerSize <= limit:
+        frame = f.read(headerSize)
+        if len(frame) < headerSize or frame[0] == 0:
+            break
+        if major == 2:
+            frameId = frame[:3].decode('latin-1')
+            frameSize = int.from_bytes(frame[3:6], 'big')
+            frameFlags = 0
+        else:
+            frameId = frame[:4].decode('latin-1')
+            frameSize = syncsafe(frame[4:8]) if major == 4 else struct.unpack('>I', frame[4:8])[0]
+            frameFlags = struct.unpack('>H', frame[8:10])[0]
+        field = ID3_FRAMES.get(frameId)
+        compressed = frameFlags & (0x000c if major == 4 else 0x00c0)
+        if field is None or field in tags or frameSize > MAX_FRAME_SIZE or compressed:
+            f.seek(frameSize, 1)
+            continue
+        data = f.read(frameSize)
+        if major == 4 and frameFlags & 0x0001:
+            data = data[4:]
+        if major == 4 and frameFlags & 0x0002:
+            data = data.replace(b'\xff\x00', b'\xff')
+        tags[field] = decodeText(data).strip()
+    if 'genre' in tags:
+        tags['genre'] = id3Genre(tags['genre'])
+    return end
+
+
+def id3Genre(genre):
+    # Old taggers store the ID3v1 genre number as "(17)"
+    if genre.startswith('(') and ')' in genre:
+        number = genre[1:genre.index(')')]
+        rest = genre[genre.index(')') + 1:]
+        if rest:
+            return rest
+        if number.isdigit() and int(number) < len(ID3V1_GENRES):
+            return ID3V1_GENRES[int(number)]
+    elif genre.isdigit() and int(genre) < len(ID3V1_GENRES):
+        return ID3V1_GENRES[int(genre)]
+    return genre
+
+
+def readId3v1(f, tags):
+    f.seek(-128, os.SEEK_END)
+    data = f.read(128)
+    if not data.startswith(b'TAG'):
+        return False
+    for field, start, end in (('title', 3, 33), ('artist', 33, 63), ('album', 63, 93)):
+        if field not in tags:
+            tags[field] = data[start:end].split(b'\x00')[0].decode('latin-1').strip()
+    if 'genre' not in tags and data[127] < len(ID3V1_GENRES):
+        tags['genre'] = ID3V1_GENRES[data[127]]
+    return True
+
+
+def readMp3(f, tags):
+    audioStart = readId3(f, tags)
+    fileSize = os.fstat(f.fileno()).st_size
+    hasV1 = readId3v1(f, tags) if fileSize >= 128 else False
+    if tags.get('length', '').isdigit():
+        return
+
+    f.seek(audioStart)
+    data = f.read(PROBE_SIZE)
+    offset = findMp3Frame(data)
+    if offset < 0:
+        return
+    header = struct.unpack('>I', data[offset:offset + 4])[0]
+    versionBits = (header >> 19) & 3
+    version = {0: 2.5, 2: 2, 3: 1}[versionBits]
+    layer = 4 - ((header >> 17) & 3)
+    bitrate = MP3_BITRATES[(1 if version == 1 else 2, layer)][(header >> 12) & 15] * 1000
+    sampleRate = MP3_SAMPLE_RATES[version][(header >> 10) & 3]
+    mono = ((header >> 6) & 3) == 3
+    if layer == 1:
+        samplesPerFrame = 384
+    elif layer == 3 and version != 1:
+        samplesPerFrame = 576
+    else:
+        samplesPerFrame = 1152
+
+    # A Xing/Info or VBRI header carries the exact frame count of VBR files
+    if version == 1:
+        xingOffset = offset + (21 if mono else 36)
+    else:
+        xingOffset = offset + (13 if mono else 21)
+    frames = 0
+    if data[xingOffset:xingOffset + 4] in (b'Xing', b'Info'):
+        flags = struct.unpack('>I', data[xingOffset + 4:xingOffset + 8])[0]
+        if flags & 1:
+            frames = struct.unpack('>I', data[xingOffset + 8:xingOffset + 12])[0]
+    elif data[offset + 36:offset + 40] == b'VBRI':
+        frames = struct.unpack('>I', data[offset + 50:offset + 54])[0]
+
+    if frames:
+        tags['duration'] = frames * samplesPerFrame * 1000 // sampleRate
+    elif bitrate:
+        audioSize = fileSize - audioStart - offset - (128 if hasV1 else 0)
+        tags['duration'] = audioSize * 8 * 1000 // bitrate
+
+
+def findMp3Frame(data):
+    offset = data.find(b'\xff')
+    while 0 <= offset < len(data) - 4:
+        second = data[offset + 1]
+        if second & 0xe0 == 0xe0 and (second >> 3) & 3 != 1 and (second >> 1) & 3 != 0:
+            third = data[offset + 2]
+            if third >> 4 not in (0, 15) and (third >> 2) & 3 != 3:
+                return offset
+        offset = data.find(b'\xff', offset + 1)
+    return -1
+
+
+def readVorbisComment(data, tags):
+    vendorLength = struct.unpack_from('<I', data, 0)[0]
+    offset = 4 + vendorLength
+    count = struct.unpack_from('<I', data, offset)[0]
+    offset += 4
+    for _ in range(count):
+        length = struct.unpack_from('<I', data, offset)[0]
+        offset += 4
+        comment = data[offset:offset + length].decode('utf-8', 'replace')
+        offset += length
+        key, _, value = comment.partition('=')
+        field = VORBIS_FIELDS.get(key.upper())
+        if field is not None and field not in tags:
+            tags[field] = value.strip()
+
+
+def readFlac(f, tags):
+    if f.read(3) == b'ID3':
+        f.seek(0)
+        f.seek(readId3(f, {}))
+    else:
+        f.seek(0)
+    if f.read(4) != b'fLaC':
+        return
+    last = False
+    while not last:
+        header = f.read(4)
+        if len(header) < 4:
+            break
+        last = bool(header[0] & 0x80)
+        blockType = header[0] & 0x7f
+        length = int.from_bytes(header[1:4], 'big')
+        if blockType == 0:
+            info = f.read(length)
+            sampleRate = int.from_bytes(info[10:13], 'big') >> 4
+            totalSamples = int.from_bytes(info[13:18], 'big') & 0xfffffffff
+            if sampleRate:
+                tags['duration'] = totalSamples * 1000 // sampleRate
+        elif blockType == 4 and length <= MAX_FRAME_SIZE:
+            readVorbisComment(f.read(length), tags)
+        else:
+            f.seek(length, 1)
+
+
+def oggPackets(f, limit):
+    """ Reassemble the first logical packets of an Ogg stream, reading at most limit bytes. """
+    packet = b''
+    read = 0
+    while read < limit:
+        header = f.read(27)
+        if len(header) < 27 or not header.startswith(b'OggS'):
+            return
+        segments = f.read(header[26])
+        body = f.read(sum(segments))
+        read += 27 + len(segments) + len(body)
+        offset = 0
+        for size in segments:
+            packet += body[offset:offset + size]
+            offset += size
+            if size < 255:
+                yield packet
+                packet = b''
+
+
+def readOgg(f, tags):
+    packets = oggPackets(f, MAX_FRAME_SIZE)
+    ident = next(packets, b'')
+    comment = next(packets, b'')
+    if ident.startswith(b'\x01vorbis'):
+        sampleRate = struct.unpack_from('<I', ident, 12)[0]
+        preSkip = 0
+        if comment.startswith(b'\x03vorbis'):
+            readVorbisComment(comment[7:], tags)
+    elif ident.startswith(b'OpusHead'):
+        sampleRate = 48000
+        preSkip = struct.unpack_from('<H', ident, 10)[0]
+        if comment.startswith(b'OpusTags'):
+            readVorbisComment(comment[8:], tags)
+    else:
+        return
+
+    # The granule position of the last page is the total sample count
+    fileSize = os.fstat(f.fileno()).st_size
+    f.seek(max(0, fileSize - PROBE_SIZE))
+    tail = f.read(PROBE_SIZE)
+    last = tail.rfind(b'OggS')
+    if last >= 0 and last + 14 <= len(tail) and sampleRate:
+        granule = struct.unpack_from('<q', tail, last + 6)[0]
+        if granule > 0:
+            tags['duration'] = max(0, granule - preSkip) * 1000 // sampleRate
+
+
+def mp4Boxes(f, end):
+    while f.tell() + 8 <= end:
+        start = f.tell()
+        size, kind = struct.unpack('>I4s', f.read(8))
+        headerSize = 8
+        if size == 1:
+            size = struct.unpack('>Q', f.read(8))[0]
+            headerSize = 16
+        elif size == 0:
+            size = end - start
+        if size < headerSize:
+            return
+        yield kind, start + headerSize, start + size
+        f.seek(start + size)
+
+
+def readMp4(f, tags):
+    fileSize = os.fstat(f.fileno()).st_size
+    for kind, start, end in mp4Boxes(f, fileSize):
+        if kind == b'moov':
+            readMp4Container(f, start, end, tags)
+            return
+
+
+def readMp4Container(f, start, end, tags):
+    f.seek(start)
+    for kind, childStart, childEnd in mp4Boxes(f, end):
+        if kind == b'mvhd':
+            f.seek(childStart)
+            data = f.read(32)
+            if len(data) < 32:
+                continue
+            if data[0] == 1:
+                timescale, duration = struct.unpack_from('>IQ', data, 20)
+            else:
+                timescale, duration = struct.unpack_from('>II', data, 12)
+            if timescale:
+                tags['duration'] = duration * 1000 // timescale
+        elif kind in (b'udta', b'ilst'):
+            readMp4Container(f, childStart, childEnd, tags)
+        elif kind == b'meta':
+            # meta is a full box, its children start after the version and flags
+            readMp4Container(f, childStart + 4, childEnd, tags)
+        elif kind in MP4_ATOMS and childEnd - childStart <= MAX_FRAME_SIZE:
+            f.seek(childStart)
+            data = f.read(childEnd - childStart)
+            if data[4:8] == b'data':
+                tags[MP4_ATOMS[kind]] = data[16:struct.unpack_from('>I', data, 0)[0]].decode('utf-8', 'replace')
+        f.seek(childEnd)
+
+
+class TagCache(object):
+    """ Size bounded LRU of parsed tags keyed by (path, mtime, size), persisted between runs. """
+
+    def __init__(self, path=None, maxEntries=250000):
+        self.path = path
+        self.maxEntries = maxEntries
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.dirty = False
+        if path is not None:
+            self.load()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, path, mtime, size):
+        key = (path, mtime, size)
+        with self.lock:
+            values = self.entries.get(key)
+            if values is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.entries.move_to_end(key)
+        return dict(zip(TAG_FIELDS, values))
+
+    def put(self, path, mtime, size, tags):
+        with self.lock:
+            self.entries[(path, mtime, size)] = tuple(tags[field] for field in TAG_FIELDS)
+            self.entries.move_to_end((path, mtime, size))
+            while len(self.entries) > self.maxEntries:
+                self.entries.popitem(last=False)
+            self.dirty = True
+
+    def load(self):
+        try:
+            with span('read tags.cache') as io, open(self.path, 'rb') as f:
+                io.size = os.fstat(f.fileno()).st_size
+                self.entries = pickle.load(f)
+        except (OSError, EOFError, pickle.UnpicklingError, AttributeError, ValueError):
+            self.entries = OrderedDict()
+
+    def save(self):
+        if self.path is None or not self.dirty:
+            return
+        with self.lock:
+            data = pickle.dumps(self.entries, pickle.HIGHEST_PROTOCOL)
+            self.dirty = False
+        temp = self.path + '.tmp'
+        with span('write tags.cache', len(data)), open(temp, 'wb') as f:
+            f.write(data)
+        os.replace(temp, self.path)
+
+
+class TagReader(object):
+    """ Reads tags for batches of files in a process pool, answering from the cache where possible. """
+
+    def __init__(self, cache, workers=None, chunkSize=64):
+        self.cache = cache
+        self.workers = workers
+        self.chunkSize = chunkSize
+        self.pool = None
+        self.lock = threading.Lock()
+
+    def executor(self):
+        with self.lock:
+            if self.pool is None:
+                self.pool = ProcessPoolExecutor(self.workers)
+            return self.pool
+
+    def readMany(self, entries):
+        """ entries is a sequence of (path, mtime, size), returns the tags in the same order. """
+        results = [self.cache.get(path, mtime, size) for path, mtime, size in entries]
+        missing = [i for i, tags in enumerate(results) if tags is None]
+        if not missing:
+            return results
+        recorder.count('tags parsed', len(missing))
+        if len(missing) < 4:
+            parsed = [readTags(entries[i][0]) for i in missing]
+        else:
+            parsed = self.executor().map(readTags, [entries[i][0] for i in missing], chunksize=self.chunkSize)
+        for i, tags in zip(missing, parsed):
+            path, mtime, size = entries[i]
+            self.cache.put(path, mtime, size, tags)
+            results[i] = tags
+        return results
+
+    def readPaths(self, paths):
+        entries = []
+        for path in paths:
+            try:
+                stat = os.stat(path)
+                entries.append((path, stat.st_mtime_ns, stat.st_size))
+            except OSError:
+                entries.append((path, 0, 0))
+        return self.readMany(entries)
+
+    def close(self):
+        with self.lock:
+            if self.pool is not None:
+                self.pool.shutdown(wait=False)
+                self.pool = None
+        self.cache.save()
+
+
+ID3V1_GENRES = (
+    'Blues', 'Classic Rock', 'Country', 'Dance', 'Disco', 'Funk', 'Grunge', 'Hip-Hop', 'Jazz', 'Metal', 'New Age',
+    'Oldies', 'Other', 'Pop', 'R&B', 'Rap', 'Reggae', 'Rock', 'Techno', 'Industrial', 'Alternative', 'Ska',
+    'Death Metal', 'Pranks', 'Soundtrack', 'Euro-Techno', 'Ambient', 'Trip-Hop', 'Vocal', 'Jazz+Funk', 'Fusion',
+    'Trance', 'Classical', 'Instrumental', 'Acid', 'House', 'Game', 'Sound Clip', 'Gospel', 'Noise', 'AlternRock',
+    'Bass', 'Soul', 'Punk', 'Space', 'Meditative', 'Instrumental Pop', 'Instrumental Rock', 'Ethnic', 'Gothic',
+    'Darkwave', 'Techno-Industrial', 'Electronic', 'Pop-Folk', 'Eurodance', 'Dream', 'Southern Rock', 'Comedy',
+    'Cult', 'Gangsta', 'Top 40', 'Christian Rap', 'Pop/Funk', 'Jungle', 'Native American', 'Cabaret', 'New Wave',
+    'Psychadelic', 'Rave', 'Showtunes', 'Trailer', 'Lo-Fi', 'Tribal', 'Acid Punk', 'Acid Jazz', 'Polka', 'Retro',
+    'Musical', 'Rock & Roll', 'Hard Rock',
+)
@@ -0,0 +1,128 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import random
+from array import array
+
+
+class ShuffleOrder(object):
+    """ Shuffled play order over track ids with a back-history, drawn lazily one track at a time.
+
+    The permutation is a Fisher–Yates shuffle that only performs the swap for the next position when
+    that track is needed, and only remembers positions that differ from the identity, so starting a
+    shuffle is O(1) and each step is O(1) however long the playlist is. The table is never reordered.
+    """
+
+    def __init__(self, seed=None, noRepeat=0, isPlayable=None, weight=None):
+        self.random = random.Random(seed)
+        # When a new cycle starts, the last noRepeat tracks played are not drawn again right away
+        self.noRepeat = noRepeat
+        self.isPlayable = isPlayable
+        # weight(trackId) in [0, 1], tracks are kept with that probability when drawn
+        self.weight = weight
+        self.reset(0, 0)
+
+    def reset(self, baseId, nextId):
+        self.baseId = baseId
+        self.size = nextId - baseId
+        self.history = array('I')
+        self.position = -1
+        self.newCycle()
+
+    def restore(self, baseId, nextId, history, position):
+        """ Start over from a saved history, its tracks count as drawn in the current cycle. """
+        self.reset(baseId, nextId)
+        for trackId in history:
+            self.played(trackId)
+        self.position = min(position, len(self.history) - 1)
+
+    def newCycle(self):
+        self.swaps = {}
+        self.where = {}
+        self.drawn = 0
+        self.avoid = set(self.history[-self.noRepeat:]) if self.noRepeat and self.history else set()
+
+    def grow(self, nextId):
+        # New tracks join the part of the permutation that has not been drawn yet
+        self.size = nextId - self.baseId
+
+    def valueAt(self, position):
+        return self.swaps.get(position, position)
+
+    def positionOf(self, value):
+        return self.where.get(value, value)
+
+    def place(self, position, value):
+        if value == position:
+            self.swaps.pop(position, None)
+            self.where.pop(value, None)
+        else:
+            self.swaps[position] = value
+            self.where[value] = position
+
+    def swap(self, first, second):
+        firstValue = self.valueAt(first)
+        secondValue = self.valueAt(second)
+        self.place(first, secondValue)
+        self.place(second, firstValue)
+
+    def take(self, position):
+        """ Move the value at position to the front of the undrawn part and draw it. """
+        self.swap(self.drawn, position)
+        value = self.valueAt(self.drawn)
+        # Drawn positions are never read again, forget them so only undrawn swaps are kept
+        self.swaps.pop(self.drawn, None)
+        self.where.pop(value, None)
+        self.drawn += 1
+        if self.avoid and self.drawn >= self.noRepeat:
+            self.avoid = set()
+        return value
+
+    def draw(self, attempts=32):
+        """ Next track id of the permutation, or None once every track was drawn this cycle. """
+        while self.drawn < self.size:
+            for attempt in range(attempts):
+                position = self.random.randrange(self.drawn, self.size)
+                trackId = self.baseId + self.valueAt(position)
+                if trackId in self.avoid and len(self.avoid) < self.size - self.drawn:
+                    continue
+                if (self.weight is not None and attempt < attempts - 1
+                        and self.random.random() >= self.weight(trackId)):
+                    continue
+                break
+            self.take(position)
+            if self.isPlayable is None or self.isPlayable(trackId):
+                return trackId
+        return None
+
+    def peek(self, loop=True):
+        """ Track id that plays next, drawing it if needed, or None when the order is exhausted. """
+        if self.position + 1 < len(self.history):
+            return self.history[self.position + 1]
+        trackId = self.draw()
+        if trackId is None and loop and self.size:
+            self.newCycle()
+            trackId = self.draw()
+        if trackId is not None:
+            self.history.append(trackId)
+        return trackId
+
+    def previous(self):
+        if self.position <= 0:
+            return None
+        self.position -= 1
+        return self.history[self.position]
+
+    def played(self, trackId):
+        """ Record that trackId is playing, whether it came from the order or was picked by the user. """
+        if 0 <= self.position < len(self.history) and self.history[self.position] == trackId:
+            return
+        if self.position + 1 < len(self.history) and self.history[self.position + 1] == trackId:
+            self.position += 1
+            return
+        # A picked track is drawn too so the shuffle does not play it again this cycle
+        offset = trackId - self.baseId
+        position = self.positionOf(offset)
+        if 0 <= offset < self.size and self.drawn <= position < self.size and self.valueAt(position) == offset:
+            self.take(position)
+        self.history.insert(self.position + 1, trackId)
+        self.position += 1
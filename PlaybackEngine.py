@@ -0,0 +1,269 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import time
+from functools import partial
+
+from PyQt5.QtCore import QObject, QTimer, pyqtSignal
+from PyQt5.QtMultimedia import QMediaContent, QMediaPlayer
+
+
+class PlaybackEngine(QObject):
+    """ QMediaPlayer look-alike that keeps a second player warm with the next track for gapless playback.
+
+    The window talks to the engine exactly like it talked to QMediaPlayer. Near the end of a track the
+    engine asks nextProvider() for the upcoming (index, url), preloads it on the standby player and swaps
+    players at end of media, or fades between them when a crossfade is set.
+    """
+    durationChanged = pyqtSignal('qint64')
+    positionChanged = pyqtSignal('qint64')
+    metaDataChanged = pyqtSignal()
+    mediaStatusChanged = pyqtSignal(int)
+    stateChanged = pyqtSignal(int)
+    volumeChanged = pyqtSignal(int)
+    mutedChanged = pyqtSignal(bool)
+    trackAdvanced = pyqtSignal(int)
+    transitionMeasured = pyqtSignal(float)
+
+    def __init__(self, preloadTime=10000, crossfade=0, parent=None):
+        super(PlaybackEngine, self).__init__(parent)
+        self.preloadTime = preloadTime
+        self.crossfade = crossfade
+        self.nextProvider = None
+        self.gainProvider = None
+        self.preloaded = None
+        self.userVolume = 45
+        # Loudness correction of the track on each player, multiplied into the volume it is given
+        self.gains = [1.0, 1.0]
+        self.transitionStarted = None
+        self.lastTransition = 0.0
+        self.transitions = 0
+
+        self.players = [QMediaPlayer(self), QMediaPlayer(self)]
+        self.active = 0
+        for player in self.players:
+            player.setNotifyInterval(100)
+            player.setVolume(self.userVolume)
+            player.durationChanged.connect(partial(self.forward, player, self.durationChanged))
+            player.positionChanged.connect(partial(self.playerPosition, player))
+            player.metaDataChanged.connect(partial(self.forward, player, self.metaDataChanged))
+            player.mediaStatusChanged.connect(partial(self.playerStatus, player))
+            player.stateChanged.connect(partial(self.forward, player, self.stateChanged))
+            player.mutedChanged.connect(partial(self.forward, player, self.mutedChanged))
+
+        self.fadeTimer = QTimer(self)
+        self.fadeTimer.setInterval(50)
+        self.fadeTimer.timeout.connect(self.fadeStep)
+        self.fadeStarted = 0.0
+
+    def player(self):
+        return self.players[self.active]
+
+    def standby(self):
+        return self.players[1 - self.active]
+
+    def forward(self, player, signal, *args):
+        if player is self.player():
+            signal.emit(*args)
+
+    # QMediaPlayer interface used by the window
+
+    def setMedia(self, content):
+        self.cancelFade()
+        self.clearPreload()
+        self.player().setMedia(content)
+
+    def play(self):
+        self.player().play()
+
+    def pause(self):
+        self.player().pause()
+
+    def stop(self):
+        self.cancelFade()
+        self.player().stop()
+
+    def state(self):
+        return self.player().state()
+
+    def mediaStatus(self):
+        return self.player().mediaStatus()
+
+    def position(self):
+        return self.player().position()
+
+    def setPosition(self, position):
+        self.player().setPosition(position)
+
+    def duration(self):
+        return self.player().duration()
+
+    def isSeekable(self):
+        return self.player().isSeekable()
+
+    def isAvailable(self):
+        return self.player().isAvailable()
+
+    def isMetaDataAvailable(self):
+        return self.player().isMetaDataAvailable()
+
+    def metaData(self, key):
+        return self.player().metaData(key)
+
+    def errorString(self):
+        return self.player().errorString()
+
+    def volume(self):
+        return self.userVolume
+
+    def setVolume(self, volume):
+        if volume != self.userVolume:
+            self.userVolume = volume
+            if not self.fadeTimer.isActive():
+                self.player().setVolume(self.playerVolume(self.active))
+            self.volumeChanged.emit(volume)
+
+    def playerVolume(self, index, volume=None):
+        volume = self.userVolume if volume is None else volume
+        return max(0, min(100, int(round(volume * self.gains[index]))))
+
+    def setGain(self, gain):
+        """ Loudness correction of the current track, 1.0 plays it at the volume the user set. """
+        self.gains[self.active] = gain
+        if not self.fadeTimer.isActive():
+            self.player().setVolume(self.playerVolume(self.active))
+
+    def isMuted(self):
+        return self.player().isMuted()
+
+    def setMuted(self, muted):
+        for player in self.players:
+            player.setMuted(muted)
+
+    # Preloading and transitions
+
+    def setCrossfade(self, crossfade):
+        self.crossfade = max(0, crossfade)
+
+    def hasPreload(self):
+        return self.preloaded is not None and self.preloaded[1] is not None
+
+    def clearPreload(self):
+        self.preloaded = None
+        self.standby().setMedia(QMediaContent())
+
+    def invalidatePreload(self):
+        # The queue changed, so the preloaded track may no longer be the next one
+        if self.preloaded is not None and not self.fadeTimer.isActive():
+            self.clearPreload()
+
+    def updatePreload(self):
+        """ The queue changed, drop the preloaded track unless it is still the one that comes next. """
+        if self.preloaded is None or self.fadeTimer.isActive():
+            return
+        upcoming = self.nextProvider() if self.nextProvider is not None else None
+        if upcoming is None and not self.hasPreload():
+            return
+        if upcoming is not None and self.hasPreload() and upcoming[1] == self.preloaded[1]:
+            # Sorting can move the same track to another row
+            self.preloaded = upcoming
+            return
+        self.clearPreload()
+
+    def playerPosition(self, player, position):
+        if player is not self.player():
+            return
+        if self.transitionStarted is not None and position > 0:
+            self.finishTransition()
+        self.positionChanged.emit(position)
+
+        duration = player.duration()
+        if duration <= 0 or player.state() != QMediaPlayer.PlayingState:
+            return
+        remaining = duration - position
+        if self.preloaded is None and remaining <= max(self.preloadTime, self.crossfade * 2):
+            self.preload()
+        if self.crossfade and self.hasPreload() and remaining <= self.crossfade and not self.fadeTimer.isActive():
+            self.startFade()
+
+    def preload(self):
+        upcoming = self.nextProvider() if self.nextProvider is not None else None
+        if upcoming is None:
+            # Remember that there is nothing to preload so the provider is not asked on every tick
+            self.preloaded = (-1, None)
+            return
+        index, url = upcoming
+        self.preloaded = (index, url)
+        standby = self.standby()
+        self.gains[1 - self.active] = self.gainProvider(index) if self.gainProvider is not None else 1.0
+        standby.setVolume(self.playerVolume(1 - self.active))
+        standby.setMedia(QMediaContent(url))
+        # Pausing prerolls the pipeline so the first buffer is decoded before it is needed
+        standby.pause()
+
+    def playerStatus(self, player, status):
+        if player is not self.player():
+            if status == QMediaPlayer.InvalidMedia:
+                self.preloaded = (-1, None)
+            return
+        if status == QMediaPlayer.EndOfMedia:
+            self.transitionStarted = time.perf_counter()
+            if self.fadeTimer.isActive():
+                return
+            if self.hasPreload():
+                self.swap()
+                return
+            self.mediaStatusChanged.emit(status)
+            # Nothing was queued by the receivers, so there is no transition to time
+            if self.player().mediaStatus() == QMediaPlayer.EndOfMedia:
+                self.transitionStarted = None
+            return
+        elif status in (QMediaPlayer.BufferedMedia, QMediaPlayer.LoadedMedia) and self.transitionStarted is not None:
+            if player.state() == QMediaPlayer.PlayingState:
+                self.finishTransition()
+        self.mediaStatusChanged.emit(status)
+
+    def swap(self):
+        index = self.preloaded[0]
+        previous = self.player()
+        self.active = 1 - self.active
+        self.preloaded = None
+        current = self.player()
+        current.setVolume(self.playerVolume(self.active))
+        if current.state() != QMediaPlayer.PlayingState:
+            current.play()
+        previous.stop()
+        previous.setMedia(QMediaContent())
+        self.trackAdvanced.emit(index)
+        self.stateChanged.emit(current.state())
+        self.durationChanged.emit(current.duration())
+        self.metaDataChanged.emit()
+        self.mediaStatusChanged.emit(current.mediaStatus())
+
+    def startFade(self):
+        self.fadeStarted = time.perf_counter()
+        standby = self.standby()
+        standby.setVolume(0)
+        standby.play()
+        self.fadeTimer.start()
+
+    def fadeStep(self):
+        progress = min(1.0, (time.perf_counter() - self.fadeStarted) * 1000 / max(1, self.crossfade))
+        self.player().setVolume(self.playerVolume(self.active, self.userVolume * (1.0 - progress)))
+        self.standby().setVolume(self.playerVolume(1 - self.active, self.userVolume * progress))
+        if progress >= 1.0:
+            self.fadeTimer.stop()
+            # Overlapping playback leaves no gap to measure
+            self.transitionStarted = time.perf_counter()
+            self.swap()
+
+    def cancelFade(self):
+        if self.fadeTimer.isActive():
+            self.fadeTimer.stop()
+            self.standby().stop()
+            self.player().setVolume(self.playerVolume(self.active))
+
+    def finishTransition(self):
+        self.lastTransition = (time.perf_counter() - self.transitionStarted) * 1000
+        self.transitionStarted = None
+        self.transitions += 1
+        self.transitionMeasured.emit(self.lastTransition)
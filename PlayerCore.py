@@ -0,0 +1,545 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import os
+import queue
+import threading
+from bisect import bisect_right
+from collections import OrderedDict
+
+from PyQt5.QtCore import QObject, QTimer, QUrl, pyqtSignal
+from PyQt5.QtMultimedia import QMediaPlayer, QMediaPlaylist, QMediaContent, QMediaMetaData
+
+from Analysis import Analyzer, analysisAvailable, replayGain
+from History import History, START, COMPLETE, SKIP, COMPLETE_FRACTION
+from Instrumentation import timed
+from MetaData import TagCache, TagReader
+from PlayOrder import ShuffleOrder
+from PlaylistIO import isPlaylistFile, iterPlaylists
+from PlaylistModel import PlaylistModel, PlaylistLoader
+from ReadAheadCache import ReadAheadCache
+from SessionStore import SessionStore, SessionState, missingPaths, MAX_HISTORY
+from Settings import (dataDir, dataFile, crossfadeTime, readAheadSize, readAheadCount, shuffleSeed, shuffleNoRepeat,
+                      sessionSaveInterval, loudnessNormalization, setLoudnessNormalization, shuffleFavorsPlayed)
+
+MODES = {'sequential': QMediaPlaylist.Sequential, 'repeat-one': QMediaPlaylist.CurrentItemInLoop,
+         'repeat-all': QMediaPlaylist.Loop, 'shuffle': QMediaPlaylist.Random}
+MODE_NAMES = {mode: name for name, mode in MODES.items()}
+STATES = {QMediaPlayer.StoppedState: 'stopped', QMediaPlayer.PlayingState: 'playing',
+          QMediaPlayer.PausedState: 'paused'}
+# Loudness known later than this into a track is kept for the next time it plays
+LATE_GAIN_MS = 1500
+
+
+class PlayerCore(QObject):
+    """ The queue, playback modes and engine without any widget, runs under QCoreApplication.
+
+    The window and the control socket are both clients: they call the methods below and follow the
+    signals, neither reaches into the other. Rows are store rows of the model.
+    """
+    started = pyqtSignal()
+    currentChanged = pyqtSignal(int)
+    modeChanged = pyqtSignal(int)
+    tracksAdded = pyqtSignal(int, int)
+    tracksLoaded = pyqtSignal(int)
+    tagsReady = pyqtSignal(list, list)
+    missingTracksFound = pyqtSignal(list)
+    appearanceRestored = pyqtSignal(str, int, int)
+    message = pyqtSignal(str)
+    analysisReady = pyqtSignal(str, object)
+    analysisProgress = pyqtSignal(int, int)
+
+    def __init__(self, parent=None):
+        super(PlayerCore, self).__init__(parent)
+        self.model = PlaylistModel(parent=self)
+        self.engine = None
+        self.currentIndex = -1
+        # Once the playing track is removed its row is gone, next continues after this row
+        self.resumeIndex = -1
+        self.resumePosition = None
+        self.playbackMode = QMediaPlaylist.Sequential
+        self.history = History(dataFile('history.db'))
+        # Path and duration of the track whose play is being logged, until it ends or is left
+        self.playing = None
+        self.shuffleOrder = ShuffleOrder(shuffleSeed(), shuffleNoRepeat(), isPlayable=self.hasTrack,
+                                         weight=self.shuffleWeight if shuffleFavorsPlayed() else None)
+        self.showingLibrary = False
+        self.tagReader = None
+        self.tagQueue = queue.Queue()
+        self.playlistLoader = None
+        self.readAhead = ReadAheadCache(dataFile('readahead'), readAheadSize())
+        self.analyzer = None
+        self.loudness = OrderedDict()
+        self.normalize = loudnessNormalization()
+        # Theme of the window that owns this core, kept here so it is saved with the session
+        self.appearance = ('dark', 1, 0)
+        self.session = SessionStore(dataDir())
+        self.sessionDirty = False
+        self.sessionTimer = QTimer(self)
+        self.sessionTimer.setInterval(sessionSaveInterval() * 1000)
+        self.sessionTimer.timeout.connect(self.saveSession)
+        self.model.tracksChanged.connect(self.syncShuffleOrder)
+        self.model.tracksChanged.connect(self.markSessionDirty)
+        self.tagsReady.connect(self.model.setTags)
+        self.analysisReady.connect(self.analysisArrived)
+        self.tagsReady.connect(self.markSessionDirty)
+        self.missingTracksFound.connect(self.removeMissingTracks)
+
+    def start(self, libraryTracks=None):
+        """ Create the engine, restore the last session and start reading tags. """
+        # Imported here, creating the players loads the multimedia backend which is the slowest part of startup
+        from PlaybackEngine import PlaybackEngine
+        self.engine = PlaybackEngine(crossfade=crossfadeTime(), parent=self)
+        self.engine.nextProvider = self.upcomingTrack
+        self.engine.gainProvider = lambda row: self.trackGain(self.model.path(row))
+        self.engine.durationChanged.connect(self.durationChanged)
+        self.engine.mediaStatusChanged.connect(self.statusChanged)
+        self.engine.trackAdvanced.connect(self.trackAdvanced)
+        self.engine.transitionMeasured.connect(self.transitionMeasured)
+        # Streaming a playlist in and sorting change the queue often, gapless playback survives them
+        self.model.tracksChanged.connect(self.engine.updatePreload)
+        if analysisAvailable():
+            self.analyzer = Analyzer(dataFile('analysis.cache'), self.analysisReady.emit, self.analysisProgress.emit)
+        self.restoreSession(libraryTracks)
+        self.sessionTimer.start()
+        # One reader and one thread for the lifetime of the core, the library scanner shares the reader
+        self.tagReader = TagReader(TagCache(dataFile('tags.cache')))
+        threading.Thread(target=self.readQueuedTags, daemon=True).start()
+        self.started.emit()
+
+    def close(self):
+        if self.tagReader is not None:
+            self.tagReader.close()
+        if self.analyzer is not None:
+            self.analyzer.close()
+        self.readAhead.close()
+        self.saveSession(wait=True)
+        self.session.close()
+        self.history.close()
+
+    # Queue
+
+    def addTracks(self, fileNames):
+        """ Append files, urls and the contents of playlist files, returns the number of tracks added now. """
+        # Collect everything first so the model sees a single batched insert
+        paths = []
+        playlists = []
+        for name in fileNames:
+            if os.path.exists(name):
+                path = os.path.abspath(name)
+                if isPlaylistFile(path):
+                    playlists.append(path)
+                else:
+                    paths.append(path)
+            elif QUrl(name).isValid():
+                paths.append(name)
+        if paths:
+            first = self.model.trackCount()
+            self.model.appendTracks(paths)
+            self.loadTags(first, first + len(paths) - 1)
+        if playlists:
+            self.loadPlaylistBatches(iterPlaylists(playlists))
+        return len(paths)
+
+    def setTracks(self, columns, library=False):
+        """ Replace the queue with (paths, durations, titles, artists, albums) columns, or the columns of
+        a library snapshot which add the pool of names that artists and albums index. """
+        self.clear()
+        self.showingLibrary = library
+        self.model.appendTracks(*columns)
+
+    def clear(self):
+        if self.playlistLoader is not None:
+            self.playlistLoader.cancel()
+            self.playlistLoader = None
+        self.model.clear()
+        self.currentIndex = -1
+        self.resumeIndex = -1
+        self.showingLibrary = False
+
+    def loadPlaylistBatches(self, batches):
+        if self.playlistLoader is not None:
+            self.playlistLoader.cancel()
+        self.playlistLoader = PlaylistLoader(self.model, batches, self)
+        self.playlistLoader.batchLoaded.connect(self.loadTags)
+        self.playlistLoader.finished.connect(self.playlistLoaded)
+        self.playlistLoader.start()
+
+    def playlistLoaded(self, count):
+        self.playlistLoader = None
+        self.tracksLoaded.emit(count)
+
+    def loadTags(self, first, last):
+        self.tracksAdded.emit(first, last)
+        self.tagQueue.put((self.model.trackIds(first, last), [self.model.path(row) for row in range(first, last + 1)]))
+
+    def readQueuedTags(self):
+        # Tags are parsed off the GUI thread and applied by track id once each chunk is ready
+        while True:
+            trackIds, paths = self.tagQueue.get()
+            for start in range(0, len(paths), 1000):
+                try:
+                    tags = self.tagReader.readPaths(paths[start:start + 1000])
+                except Exception as error:
+                    # A file that breaks the reader costs its chunk its tags, not the rest of the session
+                    self.message.emit("Reading tags failed: %s" % error)
+                    continue
+                self.tagsReady.emit(trackIds[start:start + 1000], tags)
+
+    def followTrack(self, row):
+        """ Mark row as the playing track after the queue was replaced under it, playback goes on. """
+        if not 0 <= row < self.model.trackCount():
+            return
+        self.currentIndex = row
+        self.resumeIndex = -1
+        self.model.setCurrentRow(row)
+        if self.playbackMode == QMediaPlaylist.Random:
+            self.shuffleOrder.played(self.model.trackId(row))
+
+    def removeTracks(self, rows):
+        """ Remove store rows, the playing track keeps playing. Returns the number of rows removed. """
+        rows = sorted(set(rows))
+        cursor = self.currentIndex if self.currentIndex >= 0 else self.resumeIndex
+        if cursor >= 0:
+            # The row before a removed current track, next continues from there
+            cursor -= bisect_right(rows, cursor)
+        self.keepCurrentTrack(self.model.removeStoreRows, rows)
+        if self.currentIndex < 0:
+            self.resumeIndex = cursor
+        return len(rows)
+
+    def removeTrackIds(self, trackIds):
+        return self.removeTracks([row for row in map(self.model.rowOfTrack, trackIds) if row >= 0])
+
+    def keepCurrentTrack(self, change, *args):
+        # Reordering moves the playing track to another row, follow it by id
+        trackId = self.model.trackId(self.currentIndex) if self.currentIndex >= 0 else None
+        change(*args)
+        if trackId is not None:
+            self.currentIndex = self.model.rowOfTrack(trackId)
+
+    def validateTracks(self, trackIds, paths):
+        threading.Thread(target=lambda: self.missingTracksFound.emit(
+            [trackIds[position] for position in missingPaths(paths)]), daemon=True).start()
+
+    def removeMissingTracks(self, trackIds):
+        count = self.removeTrackIds(trackIds)
+        if count:
+            self.message.emit("%d missing tracks removed" % count)
+
+    # Playback
+
+    def play(self):
+        # With nothing picked yet play starts the queue
+        if self.currentIndex < 0 and self.playing is None:
+            self.playTrack(self.nextRow())
+        else:
+            self.engine.play()
+            if self.playing is None and self.currentIndex >= 0:
+                self.startPlaying(self.currentIndex)
+
+    def pause(self):
+        self.engine.pause()
+
+    def stop(self):
+        self.finishPlaying(self.engine.position())
+        self.engine.stop()
+
+    def seek(self, position):
+        if self.engine.isSeekable():
+            self.engine.setPosition(position)
+
+    def setVolume(self, volume):
+        self.engine.setVolume(max(0, min(100, int(volume))))
+
+    def setMuted(self, muted):
+        self.engine.setMuted(bool(muted))
+
+    @timed()
+    def playTrack(self, row):
+        if not 0 <= row < self.model.trackCount():
+            return
+        self.finishPlaying(self.engine.position())
+        self.setCurrentTrack(row)
+        self.resumePosition = None
+        self.engine.setMedia(QMediaContent(mediaUrl(self.readAhead.resolve(self.model.path(row)))))
+        self.engine.play()
+        self.readAheadFrom(row)
+        self.startPlaying(row)
+
+    def setCurrentTrack(self, row):
+        self.currentIndex = row
+        self.resumeIndex = -1
+        self.model.setCurrentRow(row)
+        if self.playbackMode == QMediaPlaylist.Random:
+            self.shuffleOrder.played(self.model.trackId(row))
+        self.currentChanged.emit(row)
+        self.applyTrackGain()
+        self.requestAnalysis(row)
+
+    def readAheadFrom(self, row):
+        # Copy the tracks that will most likely play next off the network share while this one plays
+        if self.playbackMode == QMediaPlaylist.Random:
+            rows = [nextRow for nextRow in (self.nextRow(automatic=True),) if nextRow >= 0]
+        else:
+            count = self.model.trackCount()
+            rows = range(row + 1, min(count, row + 1 + readAheadCount()))
+        self.readAhead.prefetch([self.model.path(nextRow) for nextRow in rows])
+        # The next track's loudness is needed when it is preloaded
+        for nextRow in list(rows)[:1]:
+            self.requestAnalysis(nextRow)
+
+    def nextRow(self, automatic=False):
+        count = self.model.trackCount()
+        if count == 0:
+            return -1
+        if self.playbackMode == QMediaPlaylist.CurrentItemInLoop and automatic and self.currentIndex >= 0:
+            return self.currentIndex
+        if self.playbackMode == QMediaPlaylist.Random:
+            # Peeking draws the next shuffled track once, preloading and playing then agree on it
+            trackId = self.shuffleOrder.peek()
+            return self.model.rowOfTrack(trackId) if trackId is not None else -1
+        row = (self.currentIndex if self.currentIndex >= 0 else self.resumeIndex) + 1
+        if row >= count:
+            return 0 if self.playbackMode == QMediaPlaylist.Loop else -1
+        return row
+
+    def next(self):
+        self.playTrack(self.nextRow())
+
+    def previous(self):
+        if self.engine.position() <= 5000:
+            if self.playbackMode == QMediaPlaylist.Random:
+                trackId = self.shuffleOrder.previous()
+                if trackId is not None:
+                    self.playTrack(self.model.rowOfTrack(trackId))
+            elif self.currentIndex > 0:
+                self.playTrack(self.currentIndex - 1)
+            elif self.currentIndex < 0 and self.resumeIndex >= 0:
+                self.playTrack(self.resumeIndex)
+            elif self.playbackMode == QMediaPlaylist.Loop:
+                self.playTrack(self.model.trackCount() - 1)
+        else:
+            self.engine.setPosition(0)
+
+    def upcomingTrack(self):
+        row = self.nextRow(automatic=True)
+        if row < 0:
+            return None
+        return row, mediaUrl(self.readAhead.resolve(self.model.path(row)))
+
+    @timed()
+    def trackAdvanced(self, row):
+        # The engine already switched to the preloaded track
+        self.finishPlaying(ended=True)
+        self.setCurrentTrack(row)
+        self.readAheadFrom(row)
+        self.startPlaying(row)
+
+    def hasTrack(self, trackId):
+        return self.model.rowOfTrack(trackId) >= 0
+
+    # Listening history
+
+    def startPlaying(self, row):
+        path = self.model.path(row)
+        self.playing = (path, self.model.store.duration(row))
+        self.history.record(START, path)
+
+    def finishPlaying(self, position=0, ended=False):
+        # Leaving a track past COMPLETE_FRACTION of it counts as a play, before that as a skip
+        if self.playing is None:
+            return
+        path, duration = self.playing
+        self.playing = None
+        if ended:
+            self.history.record(COMPLETE, path, duration)
+        else:
+            self.history.record(COMPLETE if 0 < duration * COMPLETE_FRACTION <= position else SKIP, path, position)
+
+    def shuffleWeight(self, trackId):
+        row = self.model.rowOfTrack(trackId)
+        return self.history.weight(self.model.path(row)) if row >= 0 else 1.0
+
+    def syncShuffleOrder(self):
+        first, nextId = self.model.trackIdRange()
+        if first != self.shuffleOrder.baseId:
+            self.shuffleOrder.reset(first, nextId)
+        else:
+            self.shuffleOrder.grow(nextId)
+
+    def setPlaybackMode(self, mode):
+        if mode == self.playbackMode:
+            return
+        self.playbackMode = mode
+        if mode == QMediaPlaylist.Random:
+            # A fresh shuffle starting from the track that is playing, the table keeps its order
+            self.shuffleOrder.reset(*self.model.trackIdRange())
+            if self.currentIndex >= 0:
+                self.shuffleOrder.played(self.model.trackId(self.currentIndex))
+        self.engine.invalidatePreload()
+        self.modeChanged.emit(mode)
+
+    def togglePlaybackMode(self, mode):
+        self.setPlaybackMode(QMediaPlaylist.Sequential if self.playbackMode == mode else mode)
+
+    @timed()
+    def durationChanged(self, duration):
+        # A removed track that is still playing has no row to take its duration
+        if self.currentIndex >= 0:
+            self.model.setDuration(self.currentIndex, duration)
+        if self.playing is not None and self.playing[0] == self.currentPath():
+            self.playing = (self.playing[0], duration)
+
+    @timed()
+    def statusChanged(self, status):
+        if status == QMediaPlayer.LoadedMedia:
+            if self.resumePosition is not None:
+                self.engine.setPosition(self.resumePosition)
+                self.resumePosition = None
+            else:
+                self.engine.play()
+        elif status == QMediaPlayer.EndOfMedia:
+            self.finishPlaying(ended=True)
+            self.playTrack(self.nextRow(automatic=True))
+
+    # Loudness
+
+    def requestAnalysis(self, row):
+        if self.analyzer is not None and 0 <= row < self.model.trackCount():
+            self.analyzer.request(self.model.path(row))
+
+    def analysisArrived(self, path, analysis):
+        self.loudness[path] = analysis.loudness
+        while len(self.loudness) > 256:
+            self.loudness.popitem(last=False)
+        # A track already playing audibly is left alone, a jump in volume is worse than none
+        if path == self.currentPath() and self.engine.position() < LATE_GAIN_MS:
+            self.applyTrackGain()
+
+    def trackGain(self, path):
+        return replayGain(self.loudness.get(path)) if self.normalize else 1.0
+
+    def applyTrackGain(self):
+        path = self.currentPath()
+        self.engine.setGain(self.trackGain(path) if path is not None else 1.0)
+
+    def setNormalize(self, enabled):
+        self.normalize = bool(enabled)
+        setLoudnessNormalization(self.normalize)
+        self.applyTrackGain()
+
+    def analyzeLibrary(self, paths):
+        """ Queue paths for background analysis, returns False when analysis is not available. """
+        if self.analyzer is None:
+            return False
+        self.analyzer.analyzeAll([path for path in paths if '://' not in path])
+        return True
+
+    def currentPath(self):
+        if 0 <= self.currentIndex < self.model.trackCount():
+            return self.model.path(self.currentIndex)
+        return None
+
+    def transitionMeasured(self, latency):
+        self.message.emit("Transition %.0f ms" % latency)
+
+    def status(self):
+        """ Snapshot of the player for clients that do not follow the signals. """
+        row = self.currentIndex
+        engine = self.engine
+        return {'state': STATES.get(engine.state(), 'stopped') if engine is not None else 'stopped',
+                'mode': MODE_NAMES.get(self.playbackMode, 'sequential'), 'current': row,
+                'track': self.trackInfo(row) if 0 <= row < self.model.trackCount() else None,
+                'position': engine.position() if engine is not None else 0,
+                'duration': engine.duration() if engine is not None else 0,
+                'volume': engine.volume() if engine is not None else 0,
+                'muted': engine.isMuted() if engine is not None else False,
+                'tracks': self.model.trackCount()}
+
+    def trackInfo(self, row):
+        store = self.model.store
+        return {'row': row, 'path': store.path(row), 'title': store.title(row), 'artist': store.artist(row),
+                'album': store.album(row), 'duration': store.duration(row)}
+
+    def metaDataText(self):
+        if self.engine is None or not self.engine.isMetaDataAvailable():
+            return None
+        return "%s - %s" % (self.engine.metaData(QMediaMetaData.AlbumArtist),
+                            self.engine.metaData(QMediaMetaData.Title))
+
+    # Session
+
+    def restoreSession(self, libraryTracks=None):
+        """ Bring back the queue and player state of the last run from the session snapshot.
+
+        The saved tags and durations are used as they are, whether the files still exist is checked
+        afterwards on a background thread. libraryTracks() gives the library columns when the library
+        was showing.
+        """
+        state = self.session.loadState()
+        if state is not None and state.showingLibrary and libraryTracks is not None:
+            self.setTracks(libraryTracks(), library=True)
+        elif state is None or not state.showingLibrary:
+            columns = self.session.loadTracks()
+            if columns is not None and columns[0]:
+                first = self.model.trackCount()
+                self.model.appendTracks(*columns)
+                self.validateTracks(self.model.trackIds(first, first + len(columns[0]) - 1), columns[0])
+        self.sessionDirty = False
+        if state is None:
+            return
+        self.engine.setVolume(state.volume)
+        self.engine.setMuted(state.muted)
+        self.appearance = (state.palette, state.theme, state.colorTheme)
+        self.appearanceRestored.emit(*self.appearance)
+        # Rows only mean something for the queue the state was saved with
+        if state.showingLibrary != self.showingLibrary or (
+                not state.showingLibrary and state.generation != self.session.generation):
+            return
+        count = self.model.trackCount()
+        if state.playbackMode in MODE_NAMES:
+            self.playbackMode = state.playbackMode
+            self.modeChanged.emit(self.playbackMode)
+        if self.playbackMode == QMediaPlaylist.Random:
+            self.shuffleOrder.restore(*self.model.trackIdRange(),
+                                      [self.model.trackId(row) for row in state.history if row < count],
+                                      state.shufflePosition)
+        if 0 <= state.currentRow < count:
+            # Load the track paused at the saved position, statusChanged seeks once it is loaded
+            self.setCurrentTrack(state.currentRow)
+            self.resumePosition = state.position
+            path = self.readAhead.resolve(self.model.path(state.currentRow))
+            self.engine.setMedia(QMediaContent(mediaUrl(path)))
+
+    def markSessionDirty(self, *args):
+        self.sessionDirty = True
+
+    def saveSession(self, wait=False):
+        if self.engine is None:
+            return
+        if self.sessionDirty and not self.showingLibrary:
+            self.session.saveTracks(self.model.store, wait)
+            self.sessionDirty = False
+        # The recent shuffle history is saved as rows, tracks removed since they played are left out
+        history = []
+        start = max(0, len(self.shuffleOrder.history) - MAX_HISTORY)
+        shufflePosition = self.shuffleOrder.position - start
+        for index, trackId in enumerate(self.shuffleOrder.history[start:], start):
+            row = self.model.rowOfTrack(trackId)
+            if row >= 0:
+                history.append(row)
+            elif index <= self.shuffleOrder.position:
+                shufflePosition -= 1
+        position = self.engine.position() if self.currentIndex >= 0 else 0
+        paletteName, theme, colorTheme = self.appearance
+        self.session.saveState(SessionState(0, self.currentIndex, position, self.engine.volume(),
+                                            self.engine.isMuted(), self.playbackMode, paletteName, theme,
+                                            colorTheme, self.showingLibrary, shufflePosition, history), wait)
+
+
+def mediaUrl(path):
+    url = QUrl(path)
+    # Single letter schemes are Windows drive letters, not URLs
+    if len(url.scheme()) > 1 and url.isValid():
+        return url
+    return QUrl.fromLocalFile(path)
@@ -1,7 +1,8 @@
-from PyQt5.QtMultimedia import QMediaContent, QMediaPlayer, QMediaMetaData, QMediaPlaylist
+from PyQt5.QtMultimedia import QMediaPlayer
 from PyQt5.QtWidgets import QHBoxLayout, QToolButton, QSlider, QWidget, QSpacerItem
 from PyQt5.QtCore import pyqtSignal, Qt, QSize
-from PyQt5.QtGui import QIcon
+
+from Icons import icon
 
 
 class PlaylistControls(QWidget):
@@ -26,34 +27,34 @@ class PlaylistControls(QWidget):
 
         # Establish the Playlist Ctrl Buttons
         self.playButton = QToolButton(clicked=self.playPause)
-        self.playButton.setIcon(QIcon('Images/001-play.png'))
+        self.playButton.setIcon(icon('001-play.png'))
         self.playButton.setFixedSize(32, 32)
         self.playButton.setIconSize(QSize(32, 32))
 
         self.stopButton = QToolButton(clicked=self.stop)
-        self.stopButton.setIcon(QIcon('Images/002-stop.png'))
+        self.stopButton.setIcon(icon('002-stop.png'))
 
         self.nextButton = QToolButton(clicked=self.next)
-        self.nextButton.setIcon(QIcon('Images/005-forward.png'))
+        self.nextButton.setIcon(icon('005-forward.png'))
         self.nextButton.setFixedSize(24, 24)
         self.nextButton.setIconSize(QSize(24, 24))
 
         self.previousButton = QToolButton(clicked=self.previous)
-        self.previousButton.setIcon(QIcon('Images/004-rewind.png'))
+        self.previousButton.setIcon(icon('004-rewind.png'))
         self.previousButton.setFixedSize(24, 24)
         self.previousButton.setIconSize(QSize(24, 24))
 
         self.muteButton = QToolButton(clicked=self.muteMedia)
-        self.muteButton.setIcon(QIcon('Images/002-speaker.png'))
+        self.muteButton.setIcon(icon('002-speaker.png'))
 
         self.shuffleButton = QToolButton(clicked=self.shuffleMedia)
-        self.shuffleButton.setIcon(QIcon('Images/001-change.png'))
+        self.shuffleButton.setIcon(icon('001-change.png'))
 
         self.repeatAllButton = QToolButton(clicked=self.repeatAllMedia)
-        self.repeatAllButton.setIcon(QIcon('Images/media-repeat(all).png'))
+        self.repeatAllButton.setIcon(icon('media-repeat(all).png'))
 
         self.repeatOneButton = QToolButton(clicked=self.repeatOneMedia)
-        self.repeatOneButton.setIcon(QIcon('Images/media-repeat(1).png'))
+        self.repeatOneButton.setIcon(icon('media-repeat(1).png'))
 
         self.volumeSlider = QSlider(Qt.Horizontal, sliderMoved=self.changeVolume)
         self.volumeSlider.setRange(0, 100)
@@ -77,13 +78,13 @@ class PlaylistControls(QWidget):
 
             if state == QMediaPlayer.StoppedState:
                 self.stopButton.setEnabled(False)
-                self.playButton.setIcon(QIcon('Images/001-play.png'))
+                self.playButton.setIcon(icon('001-play.png'))
             elif state == QMediaPlayer.PlayingState:
                 self.stopButton.setEnabled(True)
-                self.playButton.setIcon(QIcon('Images/003-pause.png'))
+                self.playButton.setIcon(icon('003-pause.png'))
             elif state == QMediaPlayer.PausedState:
                 self.stopButton.setEnabled(True)
-                self.playButton.setIcon(QIcon('Images/001-play.png'))
+                self.playButton.setIcon(icon('001-play.png'))
 
     def volume(self):
         return self.volumeSlider.value()
@@ -99,10 +100,10 @@ class PlaylistControls(QWidget):
             self.playerMuted = muted
 
             if muted:
-                self.muteButton.setIcon(QIcon('Images/001-mute.png'))
+                self.muteButton.setIcon(icon('001-mute.png'))
                 self.volumeSlider.setValue(0)
             else:
-                self.muteButton.setIcon(QIcon('Images/002-speaker.png'))
+                self.muteButton.setIcon(icon('002-speaker.png'))
                 self.volumeSlider.setValue(45)
 
     def playPause(self):
@@ -0,0 +1,198 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import os
+import re
+import tempfile
+from collections import namedtuple
+from urllib.parse import unquote, urlparse, quote
+from xml.etree import ElementTree
+from xml.sax.saxutils import escape
+
+from Instrumentation import span
+
+PlaylistEntry = namedtuple('PlaylistEntry', 'path title duration')
+
+PLAYLIST_EXTENSIONS = ('.m3u', '.m3u8', '.pls', '.xspf')
+XSPF_NAMESPACE = '{http://xspf.org/ns/0/}'
+PLS_KEY = re.compile(r'^(File|Title|Length)(\d+)$', re.IGNORECASE)
+URL_SCHEME = re.compile(r'^[A-Za-z][A-Za-z0-9+.-]+://')
+DRIVE_PATH = re.compile(r'^/?[A-Za-z]:')
+
+
+def isPlaylistFile(path):
+    return path.lower().endswith(PLAYLIST_EXTENSIONS)
+
+
+def iterPlaylist(path, batchSize=2000):
+    """ Yield the entries of a playlist file in lists of at most batchSize, reading it as a stream. """
+    parser = PARSERS.get(os.path.splitext(path)[1].lower(), parseM3u)
+    batch = []
+    for entry in parser(path):
+        batch.append(entry)
+        if len(batch) >= batchSize:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def iterPlaylists(paths, batchSize=2000):
+    for path in paths:
+        for batch in iterPlaylist(path, batchSize):
+            yield batch
+
+
+def resolveLocation(base, location):
+    location = location.strip()
+    if location.lower().startswith('file:'):
+        parsed = urlparse(location)
+        location = unquote(parsed.path)
+        # file:///C:/Music becomes /C:/Music
+        if DRIVE_PATH.match(location) and location.startswith('/'):
+            location = location[1:]
+        return os.path.normpath(location)
+    if URL_SCHEME.match(location):
+        return location
+    if os.sep == '/' and '\\' in location and not DRIVE_PATH.match(location):
+        location = location.replace('\\', '/')
+    return os.path.normpath(os.path.join(base, location))
+
+
+def parseM3u(path):
+    base = os.path.dirname(os.path.abspath(path))
+    title = ''
+    duration = 0
+    with open(path, 'r', encoding='utf-8-sig', errors='replace') as plFile:
+        for line in plFile:
+            line = line.strip()
+            if not line:
+                continue
+            if line.startswith('#'):
+                if line.upper().startswith('#EXTINF:'):
+                    info, _, title = line[8:].partition(',')
+                    seconds = info.split()[0] if info.split() else ''
+                    try:
+                        duration = max(0, int(float(seconds) * 1000))
+                    except ValueError:
+                        duration = 0
+                continue
+            yield PlaylistEntry(resolveLocation(base, line), title.strip(), duration)
+            title = ''
+            duration = 0
+
+
+def parsePls(path):
+    base = os.path.dirname(os.path.abspath(path))
+    current = None
+    fields = {}
+    with open(path, 'r', encoding='utf-8-sig', errors='replace') as plFile:
+        for line in plFile:
+            key, _, value = line.strip().partition('=')
+            match = PLS_KEY.match(key)
+            if match is None:
+                continue
+            number = int(match.group(2))
+            # Entries are grouped by number, so an entry is complete once the next number shows up
+            if number != current:
+                if current is not None and 'file' in fields:
+                    yield plsEntry(base, fields)
+                current = number
+                fields = {}
+            fields[match.group(1).lower()] = value
+    if 'file' in fields:
+        yield plsEntry(base, fields)
+
+
+def plsEntry(base, fields):
+    try:
+        duration = max(0, int(fields.get('length', '0')) * 1000)
+    except ValueError:
+        duration = 0
+    return PlaylistEntry(resolveLocation(base, fields['file']), fields.get('title', ''), duration)
+
+
+def parseXspf(path):
+    base = os.path.dirname(os.path.abspath(path))
+    parent = None
+    for event, element in ElementTree.iterparse(path, events=('start', 'end')):
+        tag = element.tag.replace(XSPF_NAMESPACE, '')
+        if event == 'start':
+            if tag == 'trackList':
+                parent = element
+            continue
+        if tag != 'track':
+            continue
+        location = element.findtext(XSPF_NAMESPACE + 'location') or element.findtext('location')
+        if location:
+            if '://' not in location:
+                location = unquote(location)
+            title = element.findtext(XSPF_NAMESPACE + 'title') or element.findtext('title') or ''
+            duration = element.findtext(XSPF_NAMESPACE + 'duration') or element.findtext('duration') or '0'
+            yield PlaylistEntry(resolveLocation(base, location), title,
+                                int(duration) if duration.strip().isdigit() else 0)
+        # Drop parsed tracks so memory stays flat however long the list is
+        if parent is not None:
+            parent.clear()
+
+
+def relativeLocation(base, path):
+    if '://' in path:
+        return path
+    try:
+        return os.path.relpath(path, base)
+    except ValueError:
+        # Different drive on Windows
+        return path
+
+
+def writePlaylist(path, entries):
+    """ Write entries to path atomically, the format follows the file extension. """
+    directory = os.path.dirname(os.path.abspath(path))
+    extension = os.path.splitext(path)[1].lower()
+    writer = WRITERS.get(extension, writeM3u)
+    handle, temp = tempfile.mkstemp(prefix='.playlist-', suffix='.tmp', dir=directory)
+    try:
+        with span('write playlist'), os.fdopen(handle, 'w', encoding='utf-8', newline='\n') as plFile:
+            writer(plFile, directory, entries)
+        os.chmod(temp, 0o644)
+        os.replace(temp, path)
+    except BaseException:
+        os.unlink(temp)
+        raise
+
+
+def writeM3u(plFile, base, entries):
+    plFile.write('#EXTM3U\n')
+    for entry in entries:
+        title = entry.title or os.path.basename(entry.path)
+        seconds = entry.duration // 1000 if entry.duration else -1
+        plFile.write('#EXTINF:%d,%s\n%s\n' % (seconds, title, relativeLocation(base, entry.path)))
+
+
+def writePls(plFile, base, entries):
+    plFile.write('[playlist]\n')
+    count = 0
+    for count, entry in enumerate(entries, 1):
+        plFile.write('File%d=%s\n' % (count, relativeLocation(base, entry.path)))
+        if entry.title:
+            plFile.write('Title%d=%s\n' % (count, entry.title))
+        plFile.write('Length%d=%d\n' % (count, entry.duration // 1000 if entry.duration else -1))
+    plFile.write('NumberOfEntries=%d\nVersion=2\n' % count)
+
+
+def writeXspf(plFile, base, entries):
+    plFile.write('<?xml version="1.0" encoding="UTF-8"?>\n'
+                 '<playlist version="1" xmlns="http://xspf.org/ns/0/">\n  <trackList>\n')
+    for entry in entries:
+        location = entry.path if '://' in entry.path else quote(relativeLocation(base, entry.path).replace(os.sep, '/'))
+        plFile.write('    <track>\n      <location>%s</location>\n' % escape(location))
+        if entry.title:
+            plFile.write('      <title>%s</title>\n' % escape(entry.title))
+        if entry.duration:
+            plFile.write('      <duration>%d</duration>\n' % entry.duration)
+        plFile.write('    </track>\n')
+    plFile.write('  </trackList>\n</playlist>\n')
+
+
+PARSERS = {'.m3u': parseM3u, '.m3u8': parseM3u, '.pls': parsePls, '.xspf': parseXspf}
+WRITERS = {'.m3u': writeM3u, '.m3u8': writeM3u, '.pls': writePls, '.xspf': writeXspf}
@@ -0,0 +1,435 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import os
+from array import array
+from bisect import bisect_left, bisect_right
+from itertools import compress
+
+from PyQt5.QtCore import Qt, QAbstractTableModel, QModelIndex, QVariant, QObject, QTimer, pyqtSignal
+from PyQt5.QtGui import QFont
+
+from Instrumentation import timed
+from PlaylistIO import PlaylistEntry
+from SearchIndex import SearchIndex
+from TrackStore import TrackStore
+
+TITLE_COLUMN, ARTIST_COLUMN, ALBUM_COLUMN, LENGTH_COLUMN = range(4)
+# More separate ranges than this are removed with a model reset
+MAX_REMOVE_SIGNALS = 16
+
+
+class PlaylistModel(QAbstractTableModel):
+    """ Table over a TrackStore, optionally showing only the tracks matching a filter.
+
+    Qt model indexes address the rows that are shown, everything else (path, setCurrentRow, ...)
+    takes store rows, which playback keeps using while a filter is set.
+    """
+    columns = ('Title', 'Artist', 'Album', 'Length')
+    tracksChanged = pyqtSignal()
+
+    def __init__(self, indexChunk=5000, parent=None):
+        super(PlaylistModel, self).__init__(parent)
+        self.store = TrackStore()
+        self.currentRow = -1
+        self.currentFont = QFont()
+        self.currentFont.setBold(True)
+
+        # The search index is only built once the filter is used, then kept up to date
+        self.searchIndex = None
+        self.indexedRows = 0
+        self.indexChunk = indexChunk
+        self.filterText = ''
+        self.visible = None
+        self.indexTimer = QTimer(self)
+        self.indexTimer.setInterval(0)
+        self.indexTimer.timeout.connect(self.indexChunkOfRows)
+
+        # Cover icons are asked for by painted rows only, arrivals are coalesced into one repaint
+        self.artwork = None
+        self.artworkTimer = QTimer(self)
+        self.artworkTimer.setSingleShot(True)
+        self.artworkTimer.setInterval(50)
+        self.artworkTimer.timeout.connect(self.artworkArrived)
+
+    def setArtwork(self, artwork):
+        self.artwork = artwork
+        artwork.artworkReady.connect(self.scheduleArtwork)
+
+    def scheduleArtwork(self, path):
+        # A steady stream of arrivals still repaints every interval
+        if not self.artworkTimer.isActive():
+            self.artworkTimer.start()
+
+    def artworkArrived(self):
+        if self.rowCount():
+            self.dataChanged.emit(self.index(0, TITLE_COLUMN), self.index(self.rowCount() - 1, TITLE_COLUMN),
+                                  [Qt.DecorationRole])
+
+    def rowCount(self, parent=QModelIndex()):
+        if parent.isValid():
+            return 0
+        if self.visible is not None:
+            return len(self.visible)
+        return len(self.store)
+
+    def trackCount(self):
+        return len(self.store)
+
+    def storeRow(self, row):
+        return self.visible[row] if self.visible is not None else row
+
+    def viewRow(self, row):
+        """ Shown row of a store row, or -1 when the filter hides it. """
+        if self.visible is None:
+            return row
+        position = bisect_left(self.visible, row)
+        if position < len(self.visible) and self.visible[position] == row:
+            return position
+        return -1
+
+    def viewRange(self, first, last):
+        if self.visible is None:
+            return first, last
+        return bisect_left(self.visible, first), bisect_right(self.visible, last) - 1
+
+    def columnCount(self, parent=QModelIndex()):
+        if parent.isValid():
+            return 0
+        return len(self.columns)
+
+    def data(self, index, role=Qt.DisplayRole):
+        if not index.isValid():
+            return QVariant()
+        row = self.storeRow(index.row())
+        column = index.column()
+        if role == Qt.DisplayRole:
+            if column == TITLE_COLUMN:
+                return self.store.title(row)
+            elif column == ARTIST_COLUMN:
+                return self.store.artist(row)
+            elif column == ALBUM_COLUMN:
+                return self.store.album(row)
+            elif column == LENGTH_COLUMN:
+                duration = self.store.duration(row)
+                return configureTime(duration) if duration > 0 else ''
+        elif role == Qt.DecorationRole and column == TITLE_COLUMN and self.artwork is not None:
+            icon = self.artwork.icon(self.store.path(row))
+            return icon if icon is not None else QVariant()
+        elif role == Qt.ToolTipRole:
+            return self.store.path(row)
+        elif role == Qt.FontRole and row == self.currentRow:
+            return self.currentFont
+        elif role == Qt.TextAlignmentRole and column == LENGTH_COLUMN:
+            return Qt.AlignRight | Qt.AlignVCenter
+        return QVariant()
+
+    def headerData(self, section, orientation, role=Qt.DisplayRole):
+        if role == Qt.DisplayRole and orientation == Qt.Horizontal:
+            return self.columns[section]
+        return QVariant()
+
+    def appendTracks(self, paths, durations=None, titles=None, artists=None, albums=None, names=None):
+        if not paths:
+            return
+        if self.visible is not None:
+            # Hidden until they are indexed and the filter is applied to them
+            self.store.append(paths, durations, titles, artists, albums, names)
+        else:
+            first = len(self.store)
+            self.beginInsertRows(QModelIndex(), first, first + len(paths) - 1)
+            self.store.append(paths, durations, titles, artists, albums, names)
+            self.endInsertRows()
+        if self.searchIndex is not None:
+            self.indexTimer.start()
+        self.tracksChanged.emit()
+
+    def removeRows(self, row, count, parent=QModelIndex()):
+        if parent.isValid() or count <= 0 or row < 0 or row + count > self.rowCount():
+            return False
+        self.removeTracks(range(row, row + count))
+        return True
+
+    def removeTracks(self, rows):
+        """ Remove shown rows, in any order and with gaps, as one model transaction. """
+        self.removeStoreRows([self.storeRow(row) for row in rows])
+
+    def removeStoreRows(self, rows):
+        removed = sorted(set(rows))
+        if not removed:
+            return
+        ranges = rowRanges(removed)
+        if self.visible is None and len(ranges) <= MAX_REMOVE_SIGNALS:
+            # Last range first so the rows of the others stay valid
+            for first, last in reversed(ranges):
+                self.beginRemoveRows(QModelIndex(), first, last)
+                self.dropStoreRows(list(range(first, last + 1)))
+                self.endRemoveRows()
+        else:
+            # One reset is far cheaper for the view than thousands of remove notifications
+            self.beginResetModel()
+            self.dropStoreRows(removed)
+            self.endResetModel()
+        self.tracksChanged.emit()
+
+    def dropStoreRows(self, removed):
+        self.store.removeRows(removed)
+        if self.visible is not None:
+            # Rows after the removed ones move up by the number of removed rows before them
+            gone = set(removed)
+            self.visible = array('I', (row - bisect_left(removed, row) for row in self.visible if row not in gone))
+        self.indexedRows -= bisect_left(removed, self.indexedRows)
+        if self.currentRow >= 0:
+            position = bisect_left(removed, self.currentRow)
+            if position < len(removed) and removed[position] == self.currentRow:
+                self.currentRow = -1
+            else:
+                self.currentRow -= position
+
+    def moveTracks(self, rows, destination):
+        """ Move shown rows as one block in front of shown row destination, rowCount() moves to the end. """
+        moving = sorted({self.storeRow(row) for row in rows})
+        if not moving:
+            return
+        target = self.storeRow(destination) if destination < self.rowCount() else len(self.store)
+        keep = bytearray(b'\x01') * len(self.store)
+        for row in moving:
+            keep[row] = 0
+        order = array('I', compress(range(len(self.store)), keep))
+        position = target - bisect_left(moving, target)
+        order[position:position] = array('I', moving)
+        self.rearrange(order)
+
+    def sort(self, column, order=Qt.AscendingOrder):
+        store = self.store
+        if not 0 <= column < len(self.columns) or len(store) < 2:
+            return
+        if column == TITLE_COLUMN:
+            keys = [store.title(row).casefold() for row in range(len(store))]
+        elif column in (ARTIST_COLUMN, ALBUM_COLUMN):
+            # Sort by the rank of each distinct name instead of comparing strings per row
+            names = store.artists if column == ARTIST_COLUMN else store.albums
+            keys = list(map(store.names.ranks().__getitem__, names))
+        else:
+            keys = store.durations
+        # sorted() is stable, also in reverse, so equal rows keep their relative order
+        self.rearrange(array('I', sorted(range(len(store)), key=keys.__getitem__,
+                                         reverse=order == Qt.DescendingOrder)))
+
+    def rearrange(self, order):
+        """ Apply a new row order, order[new row] being the old store row, as a single layout change. """
+        self.finishIndexing()
+        self.layoutAboutToBeChanged.emit()
+        newRows = array('I', [0]) * len(order)
+        for newRow, oldRow in enumerate(order):
+            newRows[oldRow] = newRow
+        persistent = self.persistentIndexList()
+        moved = [(newRows[self.storeRow(index.row())], index.column()) for index in persistent]
+        self.store.reorder(order)
+        if self.currentRow >= 0:
+            self.currentRow = newRows[self.currentRow]
+        if self.visible is not None:
+            self.visible = array('I', sorted(map(newRows.__getitem__, self.visible)))
+        self.changePersistentIndexList(persistent, [self.index(self.viewRow(row), column) for row, column in moved])
+        self.layoutChanged.emit()
+        self.tracksChanged.emit()
+
+    def duplicateRows(self, keys=None):
+        """ Store rows whose key, the path unless keys are given per row, already appeared on an earlier row. """
+        seen = set()
+        duplicates = []
+        for row, key in enumerate(keys if keys is not None else self.store.paths):
+            if key in seen:
+                duplicates.append(row)
+            else:
+                seen.add(key)
+        return duplicates
+
+    def clear(self):
+        self.beginResetModel()
+        self.store.clear()
+        self.currentRow = -1
+        if self.searchIndex is not None:
+            self.searchIndex.clear()
+        self.indexedRows = 0
+        if self.visible is not None:
+            self.visible = array('I')
+        self.endResetModel()
+        self.tracksChanged.emit()
+
+    def setFilterText(self, text):
+        self.filterText = text
+        if self.searchIndex is None:
+            self.searchIndex = SearchIndex()
+        if self.indexedRows < len(self.store):
+            # The filter is applied once the index caught up
+            self.indexTimer.start()
+        else:
+            self.applyFilter()
+
+    @timed()
+    def applyFilter(self):
+        matches = self.searchIndex.search(self.filterText)
+        if matches is None:
+            visible = None
+        elif self.searchIndex.unchanged and self.visible is not None:
+            return
+        else:
+            visible = self.store.rowsOf(matches)
+        if visible is None and self.visible is None:
+            return
+        self.beginResetModel()
+        self.visible = visible
+        self.endResetModel()
+
+    def indexChunkOfRows(self):
+        self.indexRows(min(len(self.store), self.indexedRows + self.indexChunk))
+        if self.indexedRows >= len(self.store):
+            self.indexTimer.stop()
+            if self.filterText:
+                self.applyFilter()
+
+    def indexRows(self, last):
+        store = self.store
+        first = self.indexedRows
+        rows = range(first, last)
+        self.searchIndex.add(store.ids[first:last], [self.searchText(row) for row in rows],
+                             ([store.artist(row) for row in rows], [store.album(row) for row in rows]))
+        self.indexedRows = last
+
+    def finishIndexing(self):
+        # Indexing works through the leading rows, which a new order would scramble
+        if self.searchIndex is not None and self.indexedRows < len(self.store):
+            self.indexTimer.stop()
+            self.indexRows(len(self.store))
+
+    def searchText(self, row):
+        return '%s %s' % (self.store.titles[row], os.path.basename(self.store.path(row)))
+
+    def path(self, row):
+        return self.store.path(row)
+
+    def entries(self):
+        store = self.store
+        for row in range(len(store)):
+            yield PlaylistEntry(store.path(row), store.titles[row], store.duration(row))
+
+    def setDuration(self, row, duration):
+        if 0 <= row < len(self.store) and self.store.duration(row) != duration:
+            self.store.setDuration(row, duration)
+            shown = self.viewRow(row)
+            if shown >= 0:
+                cell = self.index(shown, LENGTH_COLUMN)
+                self.dataChanged.emit(cell, cell, [Qt.DisplayRole])
+
+    @timed()
+    def setTags(self, trackIds, tags):
+        # Rows may have moved or gone since the lookup started, so results are matched by track id
+        first = last = -1
+        for trackId, values in zip(trackIds, tags):
+            row = self.store.rowOf(trackId)
+            if row < 0:
+                continue
+            if row < self.indexedRows:
+                self.reindex(row, values)
+            self.store.setTags(row, values['title'], values['artist'], values['album'], values['duration'])
+            first = row if first < 0 else min(first, row)
+            last = max(last, row)
+        if first >= 0:
+            first, last = self.viewRange(first, last)
+            if first <= last:
+                self.dataChanged.emit(self.index(first, 0), self.index(last, len(self.columns) - 1),
+                                      [Qt.DisplayRole])
+
+    def reindex(self, row, values):
+        store = self.store
+        texts = ['%s %s' % (values['title'], os.path.basename(store.path(row)))]
+        names = ([values['artist']], [values['album']])
+        if store.titles[row] or store.artists[row] or store.albums[row]:
+            self.searchIndex.update(store.trackId(row), texts, [values['artist'], values['album']])
+        else:
+            # Only the file name was indexed so far, the tags just add words
+            self.searchIndex.add([store.trackId(row)], texts, names)
+
+    def trackId(self, row):
+        return self.store.trackId(row)
+
+    def rowOfTrack(self, trackId):
+        return self.store.rowOf(trackId)
+
+    def trackIdRange(self):
+        """ (first, next) ids handed out since the last clear, removed tracks included. """
+        return self.store.baseId, self.store.nextId
+
+    def trackIds(self, first, last):
+        return [self.store.trackId(row) for row in range(first, last + 1)]
+
+    def setCurrentRow(self, row):
+        previous = self.currentRow
+        self.currentRow = row
+        for changed in (previous, row):
+            changed = self.viewRow(changed) if 0 <= changed < len(self.store) else -1
+            if changed >= 0:
+                self.dataChanged.emit(self.index(changed, 0), self.index(changed, len(self.columns) - 1),
+                                      [Qt.FontRole])
+
+    def bytesPerTrack(self):
+        if not len(self.store):
+            return 0
+        return self.store.memoryUsage() // len(self.store)
+
+
+class PlaylistLoader(QObject):
+    """ Feeds playlist batches into the model one per event loop pass so the UI stays responsive. """
+    batchLoaded = pyqtSignal(int, int)
+    finished = pyqtSignal(int)
+
+    def __init__(self, model, batches, parent=None):
+        super(PlaylistLoader, self).__init__(parent)
+        self.model = model
+        self.batches = batches
+        self.count = 0
+        self.timer = QTimer(self)
+        self.timer.setInterval(0)
+        self.timer.timeout.connect(self.loadBatch)
+
+    def start(self):
+        self.timer.start()
+
+    def cancel(self):
+        self.timer.stop()
+        self.batches.close()
+
+    @timed()
+    def loadBatch(self):
+        try:
+            batch = next(self.batches, None)
+        except (OSError, ValueError, SyntaxError):
+            batch = None
+        if batch is None:
+            self.timer.stop()
+            self.finished.emit(self.count)
+            return
+        first = self.model.trackCount()
+        self.model.appendTracks([entry.path for entry in batch], [entry.duration for entry in batch],
+                                [entry.title for entry in batch])
+        self.count += len(batch)
+        self.batchLoaded.emit(first, first + len(batch) - 1)
+
+
+def rowRanges(rows):
+    """ (first, last) of each run of consecutive rows in a sorted list. """
+    ranges = []
+    for row in rows:
+        if ranges and ranges[-1][1] == row - 1:
+            ranges[-1][1] = row
+        else:
+            ranges.append([row, row])
+    return ranges
+
+
+def configureTime(ms):
+    s = round(ms / 1000)
+    m, s = divmod(s, 60)
+    h, m = divmod(m, 60)
+
+    return ("%d:%02d:%02d" % (h, m, s)) if h else ("%02d:%02d" % (m, s))
@@ -0,0 +1,179 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import os
+from collections import OrderedDict
+
+from PyQt5.QtCore import QObject, QFileSystemWatcher, QTimer, pyqtSignal
+
+from PlaylistIO import isPlaylistFile, iterPlaylist
+from SmartPlaylists import isSmartPlaylistFile
+
+
+def playlistFiles(root):
+    """ name: path of the playlists and smart playlists directly in root. """
+    found = {}
+    try:
+        with os.scandir(root) as entries:
+            for entry in entries:
+                if (isPlaylistFile(entry.name) or isSmartPlaylistFile(entry.name)) and entry.is_file():
+                    found[os.path.splitext(entry.name)[0]] = entry.path
+    except OSError:
+        pass
+    return found
+
+
+def listPlaylists(roots):
+    """ name: path over several roots, a name in an earlier root hides the same name in later ones. """
+    playlists = {}
+    for root in roots:
+        for name, path in playlistFiles(os.path.abspath(root)).items():
+            playlists.setdefault(name, path)
+    return playlists
+
+
+class PlaylistRegistry(QObject):
+    """ Name to path index of the playlist folders, kept current by a debounced file system watcher.
+
+    Smart playlist rule files are listed like playlists, their tracks come from the library index.
+    """
+    playlistAdded = pyqtSignal(str)
+    playlistRemoved = pyqtSignal(str)
+
+    def __init__(self, roots, cacheSize=8, debounce=300, parent=None):
+        super(PlaylistRegistry, self).__init__(parent)
+        self.roots = []
+        self.playlists = {}
+        self.directories = {}
+        self.parsed = OrderedDict()
+        self.cacheSize = cacheSize
+        self.pending = set()
+
+        self.watcher = QFileSystemWatcher(self)
+        self.watcher.directoryChanged.connect(self.directoryChanged)
+        self.debounceTimer = QTimer(self)
+        self.debounceTimer.setSingleShot(True)
+        self.debounceTimer.setInterval(debounce)
+        self.debounceTimer.timeout.connect(self.applyPending)
+
+        for root in roots:
+            self.addRoot(root)
+
+    def addRoot(self, root, watch=True):
+        """ Add a playlist folder, without watch it is only listed by refresh() or setPlaylists(). """
+        root = os.path.abspath(root)
+        if root in self.roots:
+            return
+        self.roots.append(root)
+        self.directories[root] = {}
+        if not watch:
+            return
+        if os.path.isdir(root):
+            self.watcher.addPath(root)
+        self.refresh(root)
+
+    def defaultRoot(self):
+        root = self.roots[0]
+        if not os.path.isdir(root):
+            os.makedirs(root, exist_ok=True)
+            self.watcher.addPath(root)
+        return root
+
+    def names(self):
+        return sorted(self.playlists, key=str.lower)
+
+    def path(self, name):
+        return self.playlists.get(name)
+
+    def pathFor(self, name, extension='.m3u'):
+        return self.playlists.get(name) or os.path.join(self.defaultRoot(), name + extension)
+
+    def directoryChanged(self, directory):
+        # Editors and sync tools touch a folder many times in a row, coalesce into one refresh
+        self.pending.add(directory)
+        self.debounceTimer.start()
+
+    def applyPending(self):
+        pending, self.pending = self.pending, set()
+        for directory in pending:
+            self.refresh(directory)
+
+    def refresh(self, root):
+        """ Re-list a single playlist folder and apply the difference to the index. """
+        root = os.path.abspath(root)
+        if root not in self.directories:
+            return
+        found = playlistFiles(root)
+        known = self.directories[root]
+        self.directories[root] = found
+        for name in set(known) | set(found):
+            self.resolve(name)
+        if os.path.isdir(root) and root not in self.watcher.directories():
+            self.watcher.addPath(root)
+
+    def resolve(self, name):
+        """ Point name at its file in the earliest root that has one, a later root's copy takes over
+        when the earlier one is deleted. """
+        path = next((self.directories[root][name] for root in self.roots if name in self.directories[root]), None)
+        current = self.playlists.get(name)
+        if path == current:
+            return
+        if current is not None:
+            self.parsed.pop(current, None)
+        if path is None:
+            del self.playlists[name]
+            self.playlistRemoved.emit(name)
+        else:
+            self.playlists[name] = path
+            if current is None:
+                self.playlistAdded.emit(name)
+
+    def setPlaylists(self, playlists):
+        """ Apply name: path pairs listed by another process, such as the library indexer. """
+        for name in [name for name in self.playlists if name not in playlists]:
+            path = self.playlists[name]
+            # Saved here after the listing was made
+            if os.path.exists(path):
+                continue
+            self.directories.get(os.path.dirname(path), {}).pop(name, None)
+            del self.playlists[name]
+            self.parsed.pop(path, None)
+            self.playlistRemoved.emit(name)
+        for name, path in playlists.items():
+            known = self.directories.get(os.path.dirname(path))
+            if known is not None:
+                known[name] = path
+            current = self.playlists.get(name)
+            if current != path:
+                self.parsed.pop(current, None)
+                self.playlists[name] = path
+                if current is None:
+                    self.playlistAdded.emit(name)
+
+    def batches(self, name, batchSize=2000):
+        """ Yield the entries of a playlist in batches, from the parsed cache when the file is unchanged. """
+        path = self.playlists.get(name)
+        if path is None or isSmartPlaylistFile(path):
+            return
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return
+        key = (stat.st_mtime_ns, stat.st_size)
+        cached = self.parsed.get(path)
+        if cached is not None and cached[0] == key:
+            self.parsed.move_to_end(path)
+            for batch in cached[1]:
+                yield batch
+            return
+
+        loaded = []
+        for batch in iterPlaylist(path, batchSize):
+            loaded.append(batch)
+            yield batch
+        self.parsed[path] = (key, loaded)
+        self.parsed.move_to_end(path)
+        while len(self.parsed) > self.cacheSize:
+            self.parsed.popitem(last=False)
+
+    def invalidate(self, path):
+        self.parsed.pop(path, None)
@@ -0,0 +1,99 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import time
+
+from PyQt5.QtCore import QObject, QTimer, pyqtSignal
+from PyQt5.QtWidgets import QAbstractSlider
+
+from Instrumentation import timed
+from PlaylistModel import configureTime
+
+
+class PositionThrottle(QObject):
+    """ Coalesces backend position ticks into capped-rate seek bar updates and debounces user seeks. """
+    seekRequested = pyqtSignal(int)
+
+    def __init__(self, slider, timeLabel, maxFps=10, seekDelay=150, parent=None):
+        super(PositionThrottle, self).__init__(parent)
+        self.slider = slider
+        self.timeLabel = timeLabel
+        self.interval = 1.0 / maxFps
+        self.position = 0
+        self.shownPosition = -1
+        self.shownSecond = -1
+        self.lastUpdate = 0.0
+        self.pendingSeek = None
+
+        # Counters, so the cost of the pipeline can be checked on the target hardware
+        self.received = 0
+        self.applied = 0
+        self.skipped = 0
+
+        self.updateTimer = QTimer(self)
+        self.updateTimer.setSingleShot(True)
+        self.updateTimer.timeout.connect(self.apply)
+
+        self.seekTimer = QTimer(self)
+        self.seekTimer.setSingleShot(True)
+        self.seekTimer.setInterval(seekDelay)
+        self.seekTimer.timeout.connect(self.flushSeek)
+
+        # Only user interaction seeks, programmatic setValue calls never reach the backend
+        slider.sliderMoved.connect(self.sliderMoved)
+        slider.sliderReleased.connect(self.flushSeek)
+        slider.actionTriggered.connect(self.sliderAction)
+
+    def setPosition(self, position):
+        self.received += 1
+        self.position = position
+        if self.updateTimer.isActive():
+            self.skipped += 1
+            return
+        wait = self.lastUpdate + self.interval - time.monotonic()
+        if wait > 0:
+            self.updateTimer.start(int(wait * 1000) + 1)
+        else:
+            self.apply()
+
+    def setDuration(self, duration):
+        self.slider.setMaximum(duration)
+
+    @timed()
+    def apply(self):
+        self.lastUpdate = time.monotonic()
+        if self.slider.isSliderDown() or self.position == self.shownPosition:
+            self.skipped += 1
+            return
+        self.applied += 1
+        self.shownPosition = self.position
+        self.slider.setValue(self.position)
+        self.showTime(self.position)
+
+    def showTime(self, position):
+        # The label only shows whole seconds, regenerate the text when that second changes
+        second = round(position / 1000)
+        if second != self.shownSecond:
+            self.shownSecond = second
+            self.timeLabel.setText(configureTime(position))
+        else:
+            self.skipped += 1
+
+    def sliderMoved(self, position):
+        self.pendingSeek = position
+        self.showTime(position)
+        self.seekTimer.start()
+
+    def sliderAction(self, action):
+        if action not in (QAbstractSlider.SliderMove, QAbstractSlider.SliderNoAction):
+            self.pendingSeek = self.slider.sliderPosition()
+            self.flushSeek()
+
+    def flushSeek(self):
+        self.seekTimer.stop()
+        if self.pendingSeek is not None:
+            position, self.pendingSeek = self.pendingSeek, None
+            self.shownPosition = position
+            self.seekRequested.emit(position)
+
+    def stats(self):
+        return {'received': self.received, 'applied': self.applied, 'skipped': self.skipped}
@@ -0,0 +1,207 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import hashlib
+import os
+import sys
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+from Instrumentation import span
+
+REMOTE_FILESYSTEMS = frozenset(('nfs', 'nfs4', 'cifs', 'smb3', 'smbfs', 'afs', '9p', 'ceph', 'glusterfs', 'davfs',
+                                'fuse.sshfs', 'fuse.rclone', 'fuse.glusterfs'))
+COPY_CHUNK = 8 * 1024 * 1024
+
+
+def mountTable():
+    """ (mount point, file system type) pairs, longest mount point first. """
+    mounts = []
+    try:
+        with open('/proc/mounts', 'r') as mountsFile:
+            for line in mountsFile:
+                fields = line.split()
+                if len(fields) >= 3:
+                    mounts.append((fields[1].replace('\\040', ' '), fields[2]))
+    except OSError:
+        pass
+    return sorted(mounts, key=lambda mount: len(mount[0]), reverse=True)
+
+
+class ReadAheadCache(object):
+    """ Bounded on-disk LRU of local copies of tracks that live on network shares. """
+
+    def __init__(self, directory, maxBytes=2 * 1024 ** 3, workers=2, remoteOnly=True):
+        self.directory = directory
+        self.maxBytes = maxBytes
+        self.remoteOnly = remoteOnly
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+        self.pending = {}
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.bytesSaved = 0
+        self.bytesCopied = 0
+        self.mounts = mountTable() if sys.platform.startswith('linux') else []
+        self.pool = ThreadPoolExecutor(workers)
+        self.closed = False
+        os.makedirs(directory, exist_ok=True)
+        self.loadEntries()
+
+    def loadEntries(self):
+        # The least recently used copies have the oldest mtime, hits touch the file
+        files = []
+        with os.scandir(self.directory) as entries:
+            for entry in entries:
+                if entry.is_file() and not entry.name.endswith('.part'):
+                    stat = entry.stat()
+                    files.append((stat.st_mtime, os.path.splitext(entry.name)[0], entry.path, stat.st_size))
+                elif entry.name.endswith('.part'):
+                    os.unlink(entry.path)
+        for _, key, path, size in sorted(files):
+            self.entries[key] = (path, size)
+            self.size += size
+
+    def isRemote(self, path):
+        if not self.remoteOnly:
+            return True
+        if sys.platform == 'win32':
+            return isRemoteWindowsPath(path)
+        for mountPoint, fsType in self.mounts:
+            if path == mountPoint or path.startswith(mountPoint.rstrip('/') + '/'):
+                return fsType in REMOTE_FILESYSTEMS
+        return False
+
+    def key(self, path, stat):
+        return hashlib.sha1(('%s|%d|%d' % (path, stat.st_mtime_ns, stat.st_size)).encode('utf-8')).hexdigest()
+
+    def resolve(self, path):
+        """ Return the local copy of path when it is cached, otherwise path itself and start caching it. """
+        if '://' in path or not self.isRemote(path):
+            return path
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return path
+        key = self.key(path, stat)
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                self.bytesSaved += entry[1]
+            else:
+                self.misses += 1
+        if entry is not None:
+            try:
+                os.utime(entry[0])
+            except OSError:
+                pass
+            return entry[0]
+        self.schedule(path, key, stat.st_size)
+        return path
+
+    def prefetch(self, paths):
+        for path in paths:
+            if '://' in path or not self.isRemote(path):
+                continue
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            self.schedule(path, self.key(path, stat), stat.st_size)
+
+    def schedule(self, path, key, size):
+        if size > self.maxBytes:
+            return
+        with self.lock:
+            if self.closed or key in self.entries or key in self.pending:
+                return
+            self.pending[key] = self.pool.submit(self.copy, path, key, size)
+
+    def copy(self, path, key, size):
+        target = os.path.join(self.directory, key + os.path.splitext(path)[1].lower())
+        temp = target + '.part'
+        try:
+            with span('read-ahead copy', size):
+                copied = copyFile(path, temp, lambda: self.closed)
+            # A copy cut short, or of a file that changed meanwhile, must never be played as the whole track
+            if self.closed or copied != size:
+                os.unlink(temp)
+                return
+            os.replace(temp, target)
+        except OSError:
+            if os.path.exists(temp):
+                os.unlink(temp)
+            return
+        finally:
+            with self.lock:
+                self.pending.pop(key, None)
+        with self.lock:
+            self.entries[key] = (target, size)
+            self.size += size
+            self.bytesCopied += size
+            self.evict()
+
+    def evict(self):
+        while self.size > self.maxBytes and len(self.entries) > 1:
+            key, (path, size) = self.entries.popitem(last=False)
+            try:
+                os.unlink(path)
+            except OSError:
+                # Still open by the player on Windows, try again on the next eviction
+                self.entries[key] = (path, size)
+                self.entries.move_to_end(key, last=False)
+                break
+            self.size -= size
+
+    def hitRate(self):
+        with self.lock:
+            requests = self.hits + self.misses
+            return self.hits / requests if requests else 0.0
+
+    def close(self):
+        with self.lock:
+            self.closed = True
+            for future in self.pending.values():
+                future.cancel()
+        self.pool.shutdown(wait=False)
+
+
+def copyFile(source, target, cancelled):
+    """ Copy in large chunks, with sendfile the data never passes through user space. Returns the bytes written. """
+    written = 0
+    with open(source, 'rb') as src, open(target, 'wb') as dst:
+        if hasattr(os, 'sendfile') and sys.platform.startswith('linux'):
+            size = os.fstat(src.fileno()).st_size
+            while written < size and not cancelled():
+                sent = os.sendfile(dst.fileno(), src.fileno(), written, min(COPY_CHUNK, size - written))
+                if sent == 0:
+                    break
+                written += sent
+        else:
+            while not cancelled():
+                chunk = src.read(COPY_CHUNK)
+                if not chunk:
+                    break
+                dst.write(chunk)
+                written += len(chunk)
+    return written
+
+
+def isRemoteWindowsPath(path):
+    if path.startswith('\\\\') or path.startswith('//'):
+        return True
+    drive = os.path.splitdrive(os.path.abspath(path))[0]
+    if not drive:
+        return False
+    import ctypes
+    return ctypes.windll.kernel32.GetDriveTypeW(drive + '\\') == 4
+
+
+def formatBytes(size):
+    for unit in ('B', 'KB', 'MB', 'GB'):
+        if size < 1024 or unit == 'GB':
+            return ('%d %s' % (size, unit)) if unit == 'B' else ('%.1f %s' % (size, unit))
+        size /= 1024.0
@@ -0,0 +1,221 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import re
+import unicodedata
+from array import array
+from bisect import bisect_left
+from collections import OrderedDict
+
+WORD = re.compile(r'\w+')
+SHORT_TOKEN = 3
+MIN_TOKEN = 2
+CACHED_TOKENS = 64
+
+
+def normalize(text):
+    """ Casefolded text without accents, so 'Beyoncé' and 'beyonce' match. """
+    if text.isascii():
+        return text.lower()
+    decomposed = unicodedata.normalize('NFKD', text.casefold())
+    return ''.join(char for char in decomposed if not unicodedata.combining(char))
+
+
+def tokenize(text):
+    return WORD.findall(normalize(text))
+
+
+def queryTokens(query):
+    # A single letter matches a large part of any library, it only narrows once a second one is typed
+    return [token for token in tokenize(query) if len(token) >= MIN_TOKEN]
+
+
+class SearchIndex(object):
+    """ Inverted index from normalized words to track ids, with prefix and trigram lookups over the words.
+
+    Tracks are only ever looked up through their words. The vocabulary is far smaller than the
+    track list, so a query scans a few thousand words instead of every row. Tokens shorter than
+    three characters match the start of a word, longer ones match anywhere inside a word.
+    """
+
+    def __init__(self):
+        self.postings = {}
+        self.vocabulary = []
+        self.vocabularySorted = True
+        self.trigrams = {}
+        self.names = {}
+        self.retagged = {}
+        self.tokenIds = OrderedDict()
+        self.lastQuery = None
+        self.lastMatches = None
+        self.lastResult = None
+        self.unchanged = False
+
+    def __len__(self):
+        return len(self.postings)
+
+    def clear(self):
+        self.__init__()
+
+    def add(self, trackIds, texts, names=()):
+        """ Index tracks: texts are per track strings such as titles, names repeat (artists, albums). """
+        postings = self.postings
+        for position, trackId in enumerate(trackIds):
+            words = set(tokenize(texts[position]))
+            for column in names:
+                words.update(self.nameTokens(column[position]))
+            for word in words:
+                posting = postings.get(word)
+                if posting is None:
+                    posting = postings[word] = array('I')
+                    self.addWord(word)
+                posting.append(trackId)
+        self.forget()
+
+    def update(self, trackId, texts, names=()):
+        """ Re-index a retagged track, words it no longer has are filtered out at query time. """
+        words = set(tokenize(' '.join(texts)))
+        for name in names:
+            words.update(self.nameTokens(name))
+        self.retagged[trackId] = words
+        for word in words:
+            posting = self.postings.get(word)
+            if posting is None:
+                posting = self.postings[word] = array('I')
+                self.addWord(word)
+            posting.append(trackId)
+        self.forget()
+
+    def forget(self):
+        self.tokenIds.clear()
+        self.lastQuery = None
+
+    def nameTokens(self, name):
+        tokens = self.names.get(name)
+        if tokens is None:
+            tokens = self.names[name] = tokenize(name)
+        return tokens
+
+    def addWord(self, word):
+        self.vocabulary.append(word)
+        self.vocabularySorted = False
+        for start in range(len(word) - SHORT_TOKEN + 1):
+            gram = word[start:start + SHORT_TOKEN]
+            words = self.trigrams.get(gram)
+            if words is None:
+                self.trigrams[gram] = [word]
+            else:
+                words.append(word)
+
+    def wordsMatching(self, token, candidates=None):
+        if candidates is not None:
+            # Typing extended the token, so only words that matched before can still match
+            if len(token) < SHORT_TOKEN:
+                return [word for word in candidates if word.startswith(token)]
+            return [word for word in candidates if token in word]
+        if len(token) < SHORT_TOKEN:
+            if not self.vocabularySorted:
+                self.vocabulary.sort()
+                self.vocabularySorted = True
+            words = []
+            position = bisect_left(self.vocabulary, token)
+            while position < len(self.vocabulary) and self.vocabulary[position].startswith(token):
+                words.append(self.vocabulary[position])
+                position += 1
+            return words
+        # The rarest trigram of the token gives the smallest set of words to check
+        grams = [token[start:start + SHORT_TOKEN] for start in range(len(token) - SHORT_TOKEN + 1)]
+        rarest = min((self.trigrams.get(gram, ()) for gram in grams), key=len)
+        return [word for word in rarest if token in word]
+
+    def search(self, query):
+        """ Set of track ids matching every token of query, or None when the query is empty.
+
+        Afterwards unchanged tells whether the result is the one of the previous query, so callers can
+        keep the rows they already have.
+        """
+        tokens = queryTokens(query)
+        previous = self.lastQuery
+        self.lastQuery = None
+        self.unchanged = False
+        if not tokens:
+            return None
+        matches = []
+        result = None
+        for position, token in enumerate(tokens):
+            narrowing = None
+            if previous is not None and position < len(previous) and canNarrow(previous[position], token):
+                narrowing = self.lastMatches[position]
+            match = self.tokenMatches(token, narrowing)
+            matches.append(match)
+            result = match[1] if result is None else result & match[1]
+            if not result:
+                return set()
+        if (previous is not None and len(matches) == len(self.lastMatches)
+                and all(new[1] is old[1] for new, old in zip(matches, self.lastMatches))):
+            self.unchanged = True
+            result = self.lastResult
+        elif self.retagged:
+            result = {trackId for trackId in result
+                      if trackId not in self.retagged or self.matchesWords(self.retagged[trackId], tokens)}
+        self.lastQuery = tokens
+        self.lastMatches = matches
+        self.lastResult = result
+        return result
+
+    def tokenMatches(self, token, narrowing=None):
+        """ Words matching token and the ids of the tracks holding them.
+
+        narrowing is the match of a shorter token this one extends, typing usually drops only a few
+        rare words, so removing their tracks is cheaper than collecting the tracks of the kept words.
+        """
+        # Earlier tokens of the query come back on every keystroke, so their matches are kept
+        cached = self.tokenIds.get(token)
+        if cached is not None:
+            self.tokenIds.move_to_end(token)
+            return cached
+        postings = self.postings
+        ids = None
+        if narrowing is None:
+            words = self.wordsMatching(token)
+        else:
+            oldWords, oldIds = narrowing
+            words = self.wordsMatching(token, oldWords)
+            if len(words) == len(oldWords):
+                ids = oldIds
+            else:
+                kept = set(words)
+                dropped = [word for word in oldWords if word not in kept]
+                if sum(len(postings[word]) for word in dropped) < sum(len(postings[word]) for word in words):
+                    lost = set()
+                    for word in dropped:
+                        lost.update(postings[word])
+                    # Tracks that also hold a kept word stay
+                    for word in words:
+                        if not lost:
+                            break
+                        lost.difference_update(postings[word])
+                    ids = oldIds - lost
+        if ids is None:
+            ids = set()
+            for word in words:
+                ids.update(postings[word])
+        self.tokenIds[token] = (words, ids)
+        if len(self.tokenIds) > CACHED_TOKENS:
+            self.tokenIds.popitem(last=False)
+        return words, ids
+
+    def matchesWords(self, words, tokens):
+        for token in tokens:
+            if len(token) < SHORT_TOKEN:
+                if not any(word.startswith(token) for word in words):
+                    return False
+            elif not any(token in word for word in words):
+                return False
+        return True
+
+
+def canNarrow(previous, token):
+    # A token that grows to three characters switches from prefix to substring matching
+    if not token.startswith(previous):
+        return False
+    return len(previous) >= SHORT_TOKEN or len(token) < SHORT_TOKEN
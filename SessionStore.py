@@ -0,0 +1,202 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import mmap
+import os
+import struct
+import sys
+from array import array
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from itertools import accumulate
+
+from Instrumentation import span
+
+TRACKS_MAGIC = b'TQST'
+STATE_MAGIC = b'TQSS'
+VERSION = 1
+# Strings were NUL separated in version 1, tags may hold NUL so they are length prefixed now
+TRACKS_VERSION = 2
+# magic, version, generation, tracks, names, path bytes, title bytes, name bytes
+TRACKS_HEADER = struct.Struct('<4sHIIIIII')
+# magic, version, tracks generation, current row, position, volume, muted, mode, palette, theme, color theme,
+# library, shuffle position, shuffle history length
+STATE_HEADER = struct.Struct('<4sHIiqBBBBBBBiI')
+MAX_HISTORY = 1000
+PALETTES = ('light', 'dark', 'red', 'purple')
+
+SessionState = namedtuple('SessionState', 'generation currentRow position volume muted playbackMode palette theme '
+                                          'colorTheme showingLibrary shufflePosition history')
+
+
+def encodeStrings(strings):
+    """ Byte length of each string followed by the strings, any character may appear in them. """
+    # Paths can hold undecodable bytes from the file system, surrogateescape keeps them intact
+    data = [text.encode('utf-8', 'surrogateescape') for text in strings]
+    return littleEndian(array('I', map(len, data))).tobytes() + b''.join(data)
+
+
+def decodeStrings(data, count):
+    lengths, offset = readArray('I', data, 0, count)
+    ends = list(accumulate(lengths, initial=offset))
+    if len(lengths) != count or ends[-1] != len(data):
+        raise ValueError("Damaged string table")
+    return [str(data[start:end], 'utf-8', 'surrogateescape') for start, end in zip(ends, ends[1:])]
+
+
+def littleEndian(values):
+    if sys.byteorder != 'little':
+        values = array(values.typecode, values)
+        values.byteswap()
+    return values
+
+
+def readArray(typecode, view, offset, count):
+    values = array(typecode)
+    values.frombytes(view[offset:offset + count * values.itemsize])
+    if sys.byteorder != 'little':
+        values.byteswap()
+    return values, offset + count * values.itemsize
+
+
+def atomicWrite(path, chunks):
+    """ Write to a temporary file and rename it over path, readers see the old file or the new one. """
+    temp = path + '.tmp'
+    with span('write ' + os.path.basename(path)) as io, open(temp, 'wb') as f:
+        for chunk in chunks:
+            io.size += f.write(chunk)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(temp, path)
+
+
+class SessionStore(object):
+    """ Binary snapshot of the playing queue and player state, restored at startup without touching the tracks.
+
+    The queue (paths, durations, tags) and the small state (current track, position, volume, modes,
+    shuffle history) live in separate files. The queue is only rewritten when it changes, the state
+    names the queue generation it belongs to so a stale state never points into a different queue.
+    Writes happen on a background thread, in the order they were requested.
+    """
+
+    def __init__(self, directory):
+        self.tracksPath = os.path.join(directory, 'session.tracks')
+        self.statePath = os.path.join(directory, 'session.state')
+        self.generation = 0
+        self.lastState = None
+        self.pool = ThreadPoolExecutor(1)
+
+    def loadTracks(self):
+        """ (paths, durations, titles, artists, albums) columns of the saved queue, or None. """
+        try:
+            with span('read session.tracks') as io, open(self.tracksPath, 'rb') as f:
+                io.size = os.fstat(f.fileno()).st_size
+                if io.size < TRACKS_HEADER.size:
+                    return None
+                with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                    return self.readTracks(mapped)
+        except (OSError, ValueError, struct.error, UnicodeError):
+            return None
+
+    def readTracks(self, mapped):
+        magic, version, generation, count, nameCount, pathBytes, titleBytes, nameBytes = \
+            TRACKS_HEADER.unpack_from(mapped, 0)
+        if magic != TRACKS_MAGIC or version != TRACKS_VERSION:
+            return None
+        view = memoryview(mapped)
+        try:
+            offset = TRACKS_HEADER.size
+            durations, offset = readArray('i', view, offset, count)
+            artists, offset = readArray('I', view, offset, count)
+            albums, offset = readArray('I', view, offset, count)
+            paths = decodeStrings(view[offset:offset + pathBytes].tobytes(), count)
+            offset += pathBytes
+            titles = decodeStrings(view[offset:offset + titleBytes].tobytes(), count)
+            offset += titleBytes
+            names = decodeStrings(view[offset:offset + nameBytes].tobytes(), nameCount)
+        finally:
+            view.release()
+        if not len(paths) == len(titles) == count or len(names) != nameCount:
+            return None
+        self.generation = generation
+        return (paths, durations, titles, [names[index] for index in artists],
+                [names[index] for index in albums])
+
+    def loadState(self):
+        try:
+            with open(self.statePath, 'rb') as f:
+                data = f.read()
+            fields = STATE_HEADER.unpack_from(data, 0)
+        except (OSError, struct.error):
+            return None
+        if fields[0] != STATE_MAGIC or fields[1] != VERSION:
+            return None
+        history, _ = readArray('I', memoryview(data), STATE_HEADER.size, fields[-1])
+        generation, currentRow, position, volume, muted, mode, paletteIndex, theme, colorTheme, library, \
+            shufflePosition = fields[2:-1]
+        state = SessionState(generation, currentRow, position, volume, bool(muted), mode,
+                             PALETTES[paletteIndex % len(PALETTES)], theme, colorTheme, bool(library),
+                             shufflePosition, history)
+        self.lastState = state
+        return state
+
+    def saveTracks(self, store, wait=False):
+        """ Snapshot the columns of a TrackStore now and write them in the background, returns the generation. """
+        self.generation += 1
+        columns = (self.generation, list(store.paths), array('i', store.durations), list(store.titles),
+                   array('I', store.artists), array('I', store.albums), list(store.names.strings))
+        return self.submit(self.writeTracks, columns, wait)
+
+    def writeTracks(self, columns):
+        generation, paths, durations, titles, artists, albums, names = columns
+        pathData = encodeStrings(paths)
+        titleData = encodeStrings(titles)
+        nameData = encodeStrings(names)
+        header = TRACKS_HEADER.pack(TRACKS_MAGIC, TRACKS_VERSION, generation, len(paths), len(names),
+                                    len(pathData), len(titleData), len(nameData))
+        atomicWrite(self.tracksPath, (header, littleEndian(durations).tobytes(), littleEndian(artists).tobytes(),
+                                      littleEndian(albums).tobytes(), pathData, titleData, nameData))
+        return generation
+
+    def saveState(self, state, wait=False):
+        """ Write state unless it equals the last one written, the generation is filled in here. """
+        state = state._replace(generation=self.generation, history=array('I', state.history))
+        if state == self.lastState:
+            return None
+        self.lastState = state
+        return self.submit(self.writeState, state, wait)
+
+    def writeState(self, state):
+        header = STATE_HEADER.pack(STATE_MAGIC, VERSION, state.generation, state.currentRow, state.position,
+                                   state.volume, state.muted, state.playbackMode, PALETTES.index(state.palette),
+                                   state.theme, state.colorTheme, state.showingLibrary, state.shufflePosition,
+                                   len(state.history))
+        atomicWrite(self.statePath, (header, littleEndian(state.history).tobytes()))
+        return state.generation
+
+    def submit(self, write, data, wait):
+        future = self.pool.submit(write, data)
+        if wait:
+            try:
+                return future.result()
+            except OSError:
+                return None
+        return future
+
+    def close(self):
+        self.pool.shutdown(wait=True)
+
+
+def missingPaths(paths):
+    """ Indexes of paths that are gone, files below a folder that is missing too (an unmounted share) are kept. """
+    missing = []
+    folders = {}
+    for position, path in enumerate(paths):
+        if '://' in path or os.path.exists(path):
+            continue
+        folder = os.path.dirname(path)
+        present = folders.get(folder)
+        if present is None:
+            present = folders[folder] = os.path.isdir(folder)
+        if present:
+            missing.append(position)
+    return missing
@@ -0,0 +1,132 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import os
+
+from PyQt5.QtCore import QSettings, QStandardPaths
+
+PROFILE_ENV = 'TRANQUILITY_PROFILE'
+
+
+def settings():
+    return QSettings('Tranquility', 'TranquilityMP')
+
+
+def profile():
+    """ Name of this player instance, empty for the default one. Players on one machine each need their own. """
+    return os.environ.get(PROFILE_ENV, '')
+
+
+def setProfile(name):
+    if not name or name in ('.', '..') or '/' in name or os.sep in name:
+        raise ValueError('Invalid profile name: %r' % name)
+    # Kept in the environment so helper processes started by the player see it too
+    os.environ[PROFILE_ENV] = name
+
+
+def takeProfileArgument(argv):
+    """ Apply a leading --profile NAME and return the remaining arguments. """
+    if argv and argv[0] == '--profile':
+        if len(argv) < 2:
+            raise ValueError('--profile needs a name')
+        setProfile(argv[1])
+        return argv[2:]
+    if argv and argv[0].startswith('--profile='):
+        setProfile(argv[0].partition('=')[2])
+        return argv[1:]
+    return argv
+
+
+def dataDir():
+    """ Data folder of this player, its session, history and caches. """
+    path = os.path.join(QStandardPaths.writableLocation(QStandardPaths.GenericDataLocation), 'TranquilityMP')
+    if profile():
+        path = os.path.join(path, 'profiles', profile())
+    os.makedirs(path, exist_ok=True)
+    return path
+
+
+def dataFile(name):
+    return os.path.join(dataDir(), name)
+
+
+def libraryRoots():
+    return [root for root in settings().value('library/roots', [], type=list) if root]
+
+
+def setLibraryRoots(roots):
+    settings().setValue('library/roots', list(roots))
+
+
+def sharedLibraryDir():
+    # Players given the same folder show the library published there by TranquilityCLI.py index
+    return settings().value('library/sharedDir', '', type=str)
+
+
+def crossfadeTime():
+    return settings().value('playback/crossfade', 0, type=int)
+
+
+def setCrossfadeTime(crossfade):
+    settings().setValue('playback/crossfade', crossfade)
+
+
+def loudnessNormalization():
+    return settings().value('playback/normalizeLoudness', False, type=bool)
+
+
+def setLoudnessNormalization(enabled):
+    settings().setValue('playback/normalizeLoudness', enabled)
+
+
+def musicDir():
+    return QStandardPaths.writableLocation(QStandardPaths.MusicLocation)
+
+
+def defaultPlaylistRoot():
+    return os.path.join(musicDir(), 'Playlists')
+
+
+def playlistRoots():
+    roots = [root for root in settings().value('playlists/roots', [], type=list) if root]
+    return roots or [defaultPlaylistRoot()]
+
+
+def setPlaylistRoots(roots):
+    settings().setValue('playlists/roots', list(roots))
+
+
+def readAheadSize():
+    return settings().value('cache/readAheadMegabytes', 2048, type=int) * 1024 * 1024
+
+
+def readAheadCount():
+    return settings().value('cache/readAheadTracks', 3, type=int)
+
+
+def controlSocketPath():
+    # A configured path is the default player's, each profile listens on a socket of its own
+    path = settings().value('control/socket', '') if not profile() else ''
+    if path:
+        return path
+    runtime = QStandardPaths.writableLocation(QStandardPaths.RuntimeLocation)
+    name = 'tranquility-%s.sock' % profile() if profile() else 'tranquility.sock'
+    return os.path.join(runtime or dataDir(), name)
+
+
+def sessionSaveInterval():
+    return settings().value('session/saveSeconds', 30, type=int)
+
+
+def shuffleSeed():
+    # Empty for a new order every time, a number to replay the same shuffle
+    seed = settings().value('playback/shuffleSeed', '')
+    return int(seed) if str(seed).strip().lstrip('-').isdigit() else None
+
+
+def shuffleNoRepeat():
+    return settings().value('playback/shuffleNoRepeat', 50, type=int)
+
+
+def shuffleFavorsPlayed():
+    # Tracks that are usually skipped come up less often in shuffle
+    return settings().value('playback/shuffleFavorsPlayed', True, type=bool)
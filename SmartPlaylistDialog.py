@@ -0,0 +1,123 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+from PyQt5.QtWidgets import (QCheckBox, QComboBox, QDialog, QDialogButtonBox, QDoubleSpinBox, QFormLayout,
+                             QHBoxLayout, QLineEdit, QMessageBox, QPushButton, QSpinBox, QVBoxLayout, QWidget)
+
+from SmartPlaylists import FIELDS, OPERATORS, SORT_FIELDS, SmartPlaylist
+
+FIELD_LABELS = {'title': "Title", 'artist': "Artist", 'album': "Album", 'genre': "Genre", 'path': "Path",
+                'duration': "Length (s)", 'rating': "Rating", 'plays': "Play count", 'added': "Added",
+                'lastPlayed': "Last played", 'random': "Random"}
+
+
+class RuleRow(QWidget):
+    """ Field, operator and value of one rule, the value editor follows the field's kind. """
+
+    def __init__(self, rule=None, parent=None):
+        super(RuleRow, self).__init__(parent)
+        self.field = QComboBox()
+        for field in FIELDS:
+            self.field.addItem(FIELD_LABELS[field], field)
+        self.operator = QComboBox()
+        self.text = QLineEdit()
+        self.number = QDoubleSpinBox()
+        self.number.setRange(0, 1000000)
+        self.number.setDecimals(0)
+        self.remove = QPushButton("-")
+        self.remove.setFixedWidth(28)
+        layout = QHBoxLayout()
+        layout.setContentsMargins(0, 0, 0, 0)
+        for widget in (self.field, self.operator, self.text, self.number, self.remove):
+            layout.addWidget(widget)
+        self.setLayout(layout)
+        self.field.currentIndexChanged.connect(self.fieldChanged)
+        if rule is not None:
+            self.field.setCurrentIndex(self.field.findData(rule.field))
+        self.fieldChanged()
+        if rule is not None:
+            self.operator.setCurrentText(rule.operator)
+            if FIELDS[rule.field] == 'text':
+                self.text.setText(rule.value)
+            else:
+                self.number.setValue(rule.value)
+
+    def fieldChanged(self):
+        kind = FIELDS[self.field.currentData()]
+        self.operator.clear()
+        self.operator.addItems(OPERATORS[kind])
+        self.text.setVisible(kind == 'text')
+        self.number.setVisible(kind != 'text')
+
+    def rule(self):
+        field = self.field.currentData()
+        value = self.text.text() if FIELDS[field] == 'text' else int(self.number.value())
+        return field, self.operator.currentText(), value
+
+
+class SmartPlaylistDialog(QDialog):
+    """ Edits the rules of a smart playlist, and its name unless an existing one is edited. """
+
+    def __init__(self, name='', playlist=None, editing=False, parent=None):
+        super(SmartPlaylistDialog, self).__init__(parent)
+        self.setWindowTitle("Smart Playlist")
+        playlist = playlist or SmartPlaylist([('genre', 'is', '')])
+        self.name = QLineEdit(name)
+        self.name.setEnabled(not editing)
+        self.match = QComboBox()
+        self.match.addItems(("all", "any"))
+        self.match.setCurrentIndex(0 if playlist.matchAll else 1)
+        self.rulesLayout = QVBoxLayout()
+        self.rows = []
+        for rule in playlist.rules:
+            self.addRule(rule)
+        add = QPushButton("Add Rule")
+        add.clicked.connect(lambda: self.addRule())
+        self.sort = QComboBox()
+        self.sort.addItem("Artist and album", '')
+        for field in SORT_FIELDS:
+            self.sort.addItem(FIELD_LABELS[field], field)
+        self.sort.setCurrentIndex(max(0, self.sort.findData(playlist.sort)))
+        self.descending = QCheckBox("Descending")
+        self.descending.setChecked(playlist.descending)
+        self.limit = QSpinBox()
+        self.limit.setRange(0, 1000000)
+        self.limit.setSpecialValueText("No limit")
+        self.limit.setValue(playlist.limit)
+
+        sortLayout = QHBoxLayout()
+        sortLayout.addWidget(self.sort)
+        sortLayout.addWidget(self.descending)
+        form = QFormLayout()
+        form.addRow("Name:", self.name)
+        form.addRow("Match:", self.match)
+        form.addRow("Sort by:", sortLayout)
+        form.addRow("Limit:", self.limit)
+        buttons = QDialogButtonBox(QDialogButtonBox.Ok | QDialogButtonBox.Cancel)
+        buttons.accepted.connect(self.accept)
+        buttons.rejected.connect(self.reject)
+        layout = QVBoxLayout()
+        layout.addLayout(form)
+        layout.addLayout(self.rulesLayout)
+        layout.addWidget(add)
+        layout.addWidget(buttons)
+        self.setLayout(layout)
+
+    def addRule(self, rule=None):
+        row = RuleRow(rule)
+        row.remove.clicked.connect(lambda: self.removeRule(row))
+        self.rows.append(row)
+        self.rulesLayout.addWidget(row)
+
+    def removeRule(self, row):
+        self.rows.remove(row)
+        row.deleteLater()
+
+    def playlist(self):
+        return SmartPlaylist([row.rule() for row in self.rows], self.match.currentIndex() == 0,
+                             self.sort.currentData(), self.descending.isChecked(), self.limit.value())
+
+    def accept(self):
+        if self.name.isEnabled() and not self.name.text().strip():
+            QMessageBox.warning(self, "Smart Playlist", "The playlist needs a name.")
+            return
+        super(SmartPlaylistDialog, self).accept()
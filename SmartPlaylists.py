@@ -0,0 +1,131 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import json
+import os
+import tempfile
+from collections import namedtuple
+
+SMART_EXTENSION = '.smart'
+DAY = 86400
+
+# Rule fields and the kind of value they compare, durations are given in seconds
+FIELDS = {'title': 'text', 'artist': 'text', 'album': 'text', 'genre': 'text', 'path': 'text',
+          'duration': 'number', 'rating': 'number', 'plays': 'number', 'added': 'date', 'lastPlayed': 'date'}
+OPERATORS = {'text': ('is', 'is not', 'contains', 'does not contain', 'starts with'),
+             'number': ('=', '!=', '<', '<=', '>', '>='),
+             'date': ('within days', 'not within days')}
+SORT_FIELDS = ('title', 'artist', 'album', 'genre', 'duration', 'added', 'rating', 'plays', 'lastPlayed', 'random')
+
+Rule = namedtuple('Rule', 'field operator value')
+
+
+def isSmartPlaylistFile(path):
+    return path.lower().endswith(SMART_EXTENSION)
+
+
+def likePattern(value, prefix='%'):
+    escaped = value.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+    return prefix + escaped + '%'
+
+
+class SmartPlaylist(object):
+    """ Rules over the library index stored as a small JSON file next to the static playlists.
+
+    The rules compile to an SQL condition on the tracks table. The index keeps the matching tracks
+    and tests only changed tracks again, so opening a smart playlist is a single indexed read.
+    """
+
+    def __init__(self, rules=(), matchAll=True, sort='', descending=False, limit=0):
+        self.rules = [Rule(*rule) for rule in rules]
+        self.matchAll = matchAll
+        self.sort = sort
+        self.descending = descending
+        self.limit = limit
+        self.validate()
+
+    @classmethod
+    def load(cls, path):
+        """ Raises OSError or ValueError for a missing or malformed rule file. """
+        with open(path, 'r', encoding='utf-8') as f:
+            data = json.load(f)
+        if not isinstance(data, dict):
+            raise ValueError("Not a smart playlist")
+        try:
+            rules = [(rule['field'], rule['operator'], rule['value']) for rule in data.get('rules', [])]
+        except (KeyError, TypeError):
+            raise ValueError("Malformed rule")
+        try:
+            limit = int(data.get('limit', 0))
+        except (TypeError, ValueError):
+            raise ValueError("The limit needs a number")
+        return cls(rules, data.get('match', 'all') == 'all', data.get('sort', ''), bool(data.get('descending')), limit)
+
+    def save(self, path):
+        data = json.dumps(self.definition(), indent=2)
+        handle, temp = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+        with os.fdopen(handle, 'w', encoding='utf-8') as f:
+            f.write(data)
+        os.replace(temp, path)
+
+    def definition(self):
+        return {'match': 'all' if self.matchAll else 'any',
+                'rules': [{'field': rule.field, 'operator': rule.operator, 'value': rule.value} for rule in self.rules],
+                'sort': self.sort, 'descending': self.descending, 'limit': self.limit}
+
+    def validate(self):
+        for rule in self.rules:
+            kind = FIELDS.get(rule.field) if isinstance(rule.field, str) else None
+            if kind is None:
+                raise ValueError("Unknown field %r" % rule.field)
+            if rule.operator not in OPERATORS[kind]:
+                raise ValueError("%r cannot be used with %s" % (rule.operator, rule.field))
+            if kind == 'text':
+                if not isinstance(rule.value, str):
+                    raise ValueError("%s needs text" % rule.field)
+            elif isinstance(rule.value, bool) or not isinstance(rule.value, (int, float)):
+                raise ValueError("%s needs a number" % rule.field)
+        if self.sort and self.sort not in SORT_FIELDS:
+            raise ValueError("Cannot sort by %r" % self.sort)
+        if self.limit < 0:
+            raise ValueError("Negative limit")
+
+    def query(self, now):
+        """ (version, condition, params) for LibraryIndex.defineSmartPlaylist.
+
+        Dates are compared to the start of the current day, so the version of a playlist with date
+        rules changes once a day and its members are rebuilt then.
+        """
+        today = int(now) // DAY * DAY
+        conditions = []
+        params = []
+        dated = False
+        for field, operator, value in self.rules:
+            kind = FIELDS[field]
+            if kind == 'text':
+                if operator in ('is', 'is not'):
+                    conditions.append('%s %s ? COLLATE NOCASE' % (field, '=' if operator == 'is' else '!='))
+                    params.append(value)
+                else:
+                    negate = 'NOT ' if operator == 'does not contain' else ''
+                    conditions.append("%s %sLIKE ? ESCAPE '\\'" % (field, negate))
+                    params.append(likePattern(value, '' if operator == 'starts with' else '%'))
+            elif kind == 'number':
+                conditions.append('%s %s ?' % (field, operator))
+                params.append(value * 1000 if field == 'duration' else value)
+            else:
+                dated = True
+                conditions.append('%s %s ?' % (field, '>=' if operator == 'within days' else '<'))
+                params.append(today - int(value) * DAY)
+        query = (' AND ' if self.matchAll else ' OR ').join('(%s)' % condition for condition in conditions) or '1'
+        version = json.dumps(self.definition(), sort_keys=True)
+        if dated:
+            version += '@%d' % today
+        return version, query, params
+
+    def order(self):
+        if self.sort == 'random':
+            return 'random()'
+        if not self.sort:
+            return 'artist COLLATE NOCASE, album COLLATE NOCASE, path'
+        collate = ' COLLATE NOCASE' if FIELDS.get(self.sort) == 'text' else ''
+        return '%s%s %s, path' % (self.sort, collate, 'DESC' if self.descending else 'ASC')
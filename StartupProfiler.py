@@ -0,0 +1,59 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import json
+import sys
+import time
+
+from PyQt5.QtCore import QObject, QEvent, QTimer, pyqtSignal
+
+MILESTONES = ('window', 'playable')
+
+
+class StartupProfiler(QObject):
+    """ Times launch milestones from process start: first paint of the window and the first playable track.
+
+    Each launch is appended as one JSON line to logPath so startup regressions show up over time.
+    """
+    windowShown = pyqtSignal()
+    finished = pyqtSignal(str)
+
+    def __init__(self, started, logPath=None, parent=None):
+        super(StartupProfiler, self).__init__(parent)
+        self.started = started
+        self.logPath = logPath
+        self.marks = {}
+        self.watched = None
+
+    def watch(self, widget):
+        self.watched = widget
+        widget.installEventFilter(self)
+
+    def eventFilter(self, obj, event):
+        if obj is self.watched and event.type() == QEvent.Paint:
+            obj.removeEventFilter(self)
+            self.watched = None
+            self.mark('window')
+            # Let the paint finish before deferred work starts
+            QTimer.singleShot(0, self.windowShown.emit)
+        return super(StartupProfiler, self).eventFilter(obj, event)
+
+    def mark(self, name):
+        """ Record the first time a milestone is reached, later calls are ignored. """
+        if name in self.marks:
+            return
+        self.marks[name] = (time.perf_counter() - self.started) * 1000
+        if all(milestone in self.marks for milestone in MILESTONES):
+            self.write()
+            self.finished.emit(self.report())
+
+    def report(self):
+        return ', '.join('%s %.0f ms' % (name, self.marks[name]) for name in MILESTONES if name in self.marks)
+
+    def write(self):
+        if self.logPath is None:
+            return
+        try:
+            with open(self.logPath, 'a') as log:
+                log.write(json.dumps(dict(self.marks, time=time.time(), argv=len(sys.argv) - 1)) + '\n')
+        except OSError:
+            pass
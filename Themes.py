@@ -0,0 +1,33 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+from PyQt5.QtCore import Qt
+from PyQt5.QtGui import QPalette, QColor
+
+# Each theme lists one color per role, in this order
+ROLES = (QPalette.Window, QPalette.WindowText, QPalette.Base, QPalette.AlternateBase, QPalette.ToolTipBase,
+         QPalette.ToolTipText, QPalette.Text, QPalette.Button, QPalette.ButtonText, QPalette.BrightText,
+         QPalette.Link, QPalette.Highlight, QPalette.HighlightedText)
+
+# Fusion dark palette from https://gist.github.com/QuantumCD/6245215. Modified by D.C
+THEMES = {
+    'dark': (QColor(53, 53, 53), Qt.white, QColor(25, 25, 25), QColor(53, 53, 53), Qt.white, Qt.white, Qt.white,
+             QColor(53, 53, 53), Qt.white, Qt.red, QColor(235, 101, 54), QColor(66, 155, 248), Qt.black),
+    'light': (Qt.white, Qt.black, QColor(240, 240, 240), Qt.white, Qt.white, Qt.white, Qt.black, Qt.white, Qt.black,
+              Qt.red, QColor(66, 155, 248), QColor(66, 155, 248), Qt.black),
+    'red': (QColor(178, 34, 34), Qt.white, QColor(128, 0, 0), QColor(178, 34, 34), Qt.white, Qt.white, Qt.white,
+            QColor(178, 34, 34), Qt.white, Qt.red, QColor(235, 101, 54), QColor(66, 155, 248), Qt.black),
+    'purple': (QColor(72, 61, 139), Qt.white, QColor(75, 0, 130), QColor(72, 61, 139), Qt.black, Qt.black,
+               Qt.white, QColor(72, 61, 139), Qt.white, Qt.red, QColor(235, 101, 54), QColor(53, 53, 53), Qt.white),
+}
+
+palettes = {}
+
+
+def palette(name):
+    """ The named palette, built the first time it is used and shared afterwards. """
+    cached = palettes.get(name)
+    if cached is None:
+        cached = palettes[name] = QPalette()
+        for role, color in zip(ROLES, THEMES[name]):
+            cached.setColor(role, color)
+    return cached
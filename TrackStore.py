@@ -0,0 +1,228 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import os
+import sys
+from array import array
+from bisect import bisect_left
+
+
+class StringPool(object):
+    """ Stores each distinct string once, columns refer to it by index. """
+
+    def __init__(self):
+        self.strings = ['']
+        self.lookup = {'': 0}
+
+    def __len__(self):
+        return len(self.strings)
+
+    def add(self, text):
+        index = self.lookup.get(text)
+        if index is None:
+            index = len(self.strings)
+            self.strings.append(text)
+            self.lookup[text] = index
+        return index
+
+    def get(self, index):
+        return self.strings[index]
+
+    def ranks(self):
+        """ Case-insensitive sort position of every string, so columns of indexes sort by their text. """
+        order = sorted(range(len(self.strings)), key=lambda index: self.strings[index].casefold())
+        ranks = array('I', [0]) * len(order)
+        for rank, index in enumerate(order):
+            ranks[index] = rank
+        return ranks
+
+    def memoryUsage(self):
+        return (sys.getsizeof(self.strings) + sys.getsizeof(self.lookup)
+                + sum(sys.getsizeof(text) for text in self.strings))
+
+
+class TrackStore(object):
+    """ Column oriented track table: one typed array per numeric column and interned path strings. """
+
+    def __init__(self, nextId=0):
+        # Ids keep counting across clear() so late results for old tracks never match new ones
+        self.baseId = self.nextId = nextId
+        self.ids = array('I')
+        self.durations = array('i')
+        self.paths = []
+        self.titles = []
+        self.artists = array('I')
+        self.albums = array('I')
+        self.names = StringPool()
+        self.rowsById = array('i')
+        self.rowsDirty = False
+        # True while every row still holds track id baseId + row
+        self.ordered = True
+
+    def __len__(self):
+        return len(self.ids)
+
+    def append(self, paths, durations=None, titles=None, artists=None, albums=None, names=None):
+        """ Add rows, with names given artists and albums are indexes into that pool instead of strings. """
+        if names is not None:
+            if not len(self.ids):
+                return self.share(paths, durations, titles, artists, albums, names)
+            artists = map(names.get, artists)
+            albums = map(names.get, albums)
+        self.ownStrings()
+        first = len(self.ids)
+        paths = [sys.intern(path) for path in paths]
+        count = len(paths)
+        self.paths.extend(paths)
+        self.ids.extend(range(self.nextId, self.nextId + count))
+        self.nextId += count
+        self.durations.extend(durations if durations is not None else array('i', [0]) * count)
+        if titles is not None:
+            self.titles.extend(sys.intern(title) for title in titles)
+        else:
+            self.titles.extend([''] * count)
+        for column, values in ((self.artists, artists), (self.albums, albums)):
+            if values is not None:
+                column.extend(self.names.add(value) for value in values)
+            else:
+                column.extend(array('I', [0]) * count)
+        if not self.rowsDirty:
+            self.rowsById.extend(range(first, first + count))
+        return first, first + count - 1
+
+    def share(self, paths, durations, titles, artists, albums, names):
+        """ Take the columns of an empty store as they are, paths and titles can be read-only sequences
+        such as the text columns of a library snapshot, which are copied once rows are added or retagged. """
+        self.clear()
+        count = len(paths)
+        self.ids = array('I', range(self.nextId, self.nextId + count))
+        self.nextId += count
+        self.paths, self.durations, self.titles, self.artists, self.albums = paths, durations, titles, artists, albums
+        self.names = names
+        self.rowsById = array('i', range(count))
+        return 0, count - 1
+
+    def ownStrings(self):
+        if not isinstance(self.paths, list):
+            self.paths = [sys.intern(path) for path in self.paths]
+        if not isinstance(self.titles, list):
+            self.titles = [sys.intern(title) for title in self.titles]
+
+    def remove(self, row):
+        for column in self.columns():
+            del column[row]
+        self.rowsDirty = True
+        self.ordered = False
+
+    def removeRows(self, rows):
+        """ Remove a sorted list of rows with one pass over each column instead of one per row. """
+        if not rows:
+            return
+        if rows[-1] - rows[0] + 1 == len(rows):
+            for column in self.columns():
+                del column[rows[0]:rows[-1] + 1]
+            self.rowsDirty = True
+            self.ordered = False
+            return
+        # Copy the runs between removed rows, slices copy in C
+        starts = [0] + [row + 1 for row in rows]
+        ends = rows + [len(self.ids)]
+
+        def keep(column):
+            kept = column[:0]
+            for start, end in zip(starts, ends):
+                kept += column[start:end]
+            return kept
+        self.setColumns(*[keep(column) for column in self.columns()])
+
+    def reorder(self, order):
+        """ Rearrange the rows so that row i holds what was row order[i]. """
+        def pick(column):
+            picked = map(column.__getitem__, order)
+            if isinstance(column, list):
+                return list(picked)
+            if isinstance(column, array):
+                return array(column.typecode, picked)
+            # Shared text columns only rearrange their row numbers
+            return column.select(order)
+        self.setColumns(*[pick(column) for column in self.columns()])
+
+    def columns(self):
+        return self.ids, self.durations, self.paths, self.titles, self.artists, self.albums
+
+    def setColumns(self, ids, durations, paths, titles, artists, albums):
+        self.ids, self.durations, self.paths, self.titles, self.artists, self.albums = (
+            ids, durations, paths, titles, artists, albums)
+        self.rowsDirty = True
+        self.ordered = False
+
+    def clear(self):
+        self.__init__(self.nextId)
+
+    def rowOf(self, trackId):
+        """ Current row of a track id, or -1 once the track has been removed. """
+        if self.rowsDirty:
+            self.rowsById = array('i', [-1]) * (self.nextId - self.baseId)
+            for row, value in enumerate(self.ids):
+                self.rowsById[value - self.baseId] = row
+            self.rowsDirty = False
+        if 0 <= trackId - self.baseId < len(self.rowsById):
+            return self.rowsById[trackId - self.baseId]
+        return -1
+
+    def rowsOf(self, trackIds):
+        """ Sorted rows of a collection of track ids, ids that have been removed are left out. """
+        if self.ordered:
+            rows = sorted(trackIds)
+            if self.baseId:
+                rows = map(self.baseId.__rsub__, rows)
+            return array('I', rows)
+        self.rowOf(self.baseId)
+        rows = sorted(map(self.rowsById.__getitem__, map(self.baseId.__rsub__, trackIds)))
+        return array('I', rows[bisect_left(rows, 0):])
+
+    def trackId(self, row):
+        return self.ids[row]
+
+    def path(self, row):
+        return self.paths[row]
+
+    def title(self, row):
+        return self.titles[row] or os.path.basename(self.paths[row])
+
+    def artist(self, row):
+        return self.names.get(self.artists[row])
+
+    def album(self, row):
+        return self.names.get(self.albums[row])
+
+    def duration(self, row):
+        return self.durations[row]
+
+    def setDuration(self, row, duration):
+        self.durations[row] = duration
+
+    def setTags(self, row, title, artist, album, duration):
+        self.ownStrings()
+        self.titles[row] = sys.intern(title)
+        self.artists[row] = self.names.add(artist)
+        self.albums[row] = self.names.add(album)
+        if duration:
+            self.durations[row] = duration
+
+    def memoryUsage(self):
+        # Strings are counted once even when the same interned path appears in several rows, text shared
+        # with other processes through a snapshot is not counted
+        seen = set()
+        size = 0
+        for column in (self.paths, self.titles):
+            if not isinstance(column, list):
+                size += column.memoryUsage()
+                continue
+            size += sys.getsizeof(column)
+            for text in column:
+                if id(text) not in seen:
+                    seen.add(id(text))
+                    size += sys.getsizeof(text)
+        for column in (self.ids, self.durations, self.artists, self.albums, self.rowsById):
+            size += column.itemsize * len(column)
+        return size + self.names.memoryUsage()
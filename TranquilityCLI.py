@@ -0,0 +1,210 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+""" Control a running Tranquility player, or run one without a window.
+
+    TranquilityCLI.py serve [files...]          headless player listening on the control socket
+    TranquilityCLI.py index [SECONDS]           keep indexing the library for players sharing library/sharedDir
+    TranquilityCLI.py status                    print the player status
+    TranquilityCLI.py play | pause | stop | next | previous
+    TranquilityCLI.py seek SECONDS
+    TranquilityCLI.py volume PERCENT
+    TranquilityCLI.py mute | unmute
+    TranquilityCLI.py mode sequential|repeat-one|repeat-all|shuffle
+    TranquilityCLI.py enqueue [--play] FILES...
+    TranquilityCLI.py tracks [START [COUNT]]
+    TranquilityCLI.py history [HOURS]           what was played, started and skipped, default the last day
+    TranquilityCLI.py top [DAYS [COUNT]]        most played tracks, DAYS 0 for all time
+    TranquilityCLI.py watch [EVENTS...]         print events as they happen
+
+Several commands separated by ';' are sent as one batch, e.g. TranquilityCLI.py enqueue a.mp3 ';' next
+A leading --profile NAME, or TRANQUILITY_PROFILE=NAME, picks one of several players on the machine.
+"""
+import json
+import os
+import signal
+import socket
+import sys
+import time
+
+from Settings import controlSocketPath, takeProfileArgument
+
+
+def command(name, args):
+    """ JSON-RPC (method, params) for a command line command. """
+    if name in ('status', 'play', 'pause', 'stop', 'next', 'previous', 'clear'):
+        return name, []
+    if name == 'seek':
+        return 'seek', [int(float(args[0]) * 1000)]
+    if name == 'volume':
+        return 'setVolume', [int(args[0])]
+    if name in ('mute', 'unmute'):
+        return 'setMuted', [name == 'mute']
+    if name == 'mode':
+        return 'setMode', [args[0]]
+    if name == 'enqueue':
+        play = '--play' in args
+        return 'enqueue', {'paths': [os.path.abspath(arg) if os.path.exists(arg) else arg
+                                     for arg in args if arg != '--play'], 'play': play}
+    if name == 'tracks':
+        return 'tracks', [int(arg) for arg in args[:2]]
+    if name == 'history':
+        hours = float(args[0]) if args else 24
+        return 'history', {'start': int((time.time() - hours * 3600) * 1000)}
+    if name == 'top':
+        days = float(args[0]) if args else 0
+        params = {'start': int((time.time() - days * 86400) * 1000)} if days > 0 else {}
+        return 'topTracks', dict(params, limit=int(args[1]) if len(args) > 1 else 25)
+    raise ValueError('Unknown command: %s' % name)
+
+
+def splitCommands(argv):
+    commands = [[]]
+    for arg in argv:
+        if arg == ';':
+            commands.append([])
+        else:
+            commands[-1].append(arg)
+    return [command(words[0], words[1:]) for words in commands if words]
+
+
+def connect(path):
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    client.connect(path)
+    return client, client.makefile('rb')
+
+
+def send(client, message):
+    client.sendall(json.dumps(message).encode('utf-8') + b'\n')
+
+
+def run(argv):
+    if argv[0] == 'watch':
+        return watch(argv[1:])
+    requests = [{'jsonrpc': '2.0', 'id': position, 'method': method, 'params': params}
+                for position, (method, params) in enumerate(splitCommands(argv))]
+    client, replies = connect(controlSocketPath())
+    with client:
+        send(client, requests if len(requests) > 1 else requests[0])
+        response = json.loads(replies.readline())
+    failed = False
+    for reply in response if isinstance(response, list) else [response]:
+        if 'error' in reply:
+            failed = True
+            print('error: %s' % reply['error']['message'], file=sys.stderr)
+        elif reply.get('result') is not None:
+            print(json.dumps(reply['result'], indent=2, ensure_ascii=False))
+    return 1 if failed else 0
+
+
+def watch(events):
+    client, replies = connect(controlSocketPath())
+    with client:
+        send(client, {'jsonrpc': '2.0', 'id': 0, 'method': 'subscribe', 'params': {'events': events}}
+             if events else {'jsonrpc': '2.0', 'id': 0, 'method': 'subscribe'})
+        for line in replies:
+            message = json.loads(line)
+            if 'error' in message:
+                print('error: %s' % message['error']['message'], file=sys.stderr)
+                return 1
+            if message.get('method') == 'event':
+                print(json.dumps(message['params'], ensure_ascii=False), flush=True)
+    return 0
+
+
+def serve(files):
+    from PyQt5.QtCore import QCoreApplication, QTimer
+    from ControlServer import ControlServer
+    from Instrumentation import recorder, tracePath
+    from PlayerCore import PlayerCore
+
+    if tracePath() is not None:
+        recorder.setEnabled(True)
+    app = QCoreApplication(sys.argv[:1])
+    core = PlayerCore()
+    core.start()
+    core.addTracks(files)
+    server = ControlServer(core, controlSocketPath())
+    if not server.start():
+        print('error: cannot listen on %s' % controlSocketPath(), file=sys.stderr)
+        return 1
+    # Let Ctrl+C and kill stop the event loop so the session is saved, Python only runs signal handlers
+    # when it gets control back from the Qt loop
+    signal.signal(signal.SIGINT, lambda *args: app.quit())
+    signal.signal(signal.SIGTERM, lambda *args: app.quit())
+    wakeUp = QTimer()
+    wakeUp.timeout.connect(lambda: None)
+    wakeUp.start(200)
+    status = app.exec_()
+    server.close()
+    core.close()
+    if tracePath() is not None:
+        recorder.writeTrace(tracePath())
+    return status
+
+
+def index(args):
+    """ Scan the library roots and playlist folders every interval and publish a snapshot when they changed. """
+    from Library import LibraryIndex, LibraryScanner
+    from LibrarySnapshot import publishSnapshot
+    from MetaData import TagCache, TagReader
+    from PlaylistRegistry import listPlaylists
+    from Settings import dataFile, libraryRoots, playlistRoots, sharedLibraryDir
+
+    directory = sharedLibraryDir()
+    if not directory:
+        print('error: set library/sharedDir to the folder the players read the library from', file=sys.stderr)
+        return 2
+    interval = float(args[0]) if args else 60
+    library = LibraryIndex(dataFile('library.db'))
+    tagReader = TagReader(TagCache(dataFile('tags.cache')))
+    published = None
+    try:
+        while True:
+            roots = libraryRoots()
+            library.loadSmartQueries()
+            scanner = LibraryScanner(library, roots, tagReader=tagReader.readMany)
+            scanner.scan()
+            playlists = listPlaylists(playlistRoots())
+            if scanner.changed or (roots, playlists) != published:
+                tagReader.cache.save()
+                columns = library.tracks(roots)
+                generation = publishSnapshot(directory, columns, playlists, roots)
+                published = (roots, playlists)
+                print('generation %d: %d tracks, %d playlists' % (generation, len(columns[0]), len(playlists)),
+                      flush=True)
+            time.sleep(interval)
+    except KeyboardInterrupt:
+        return 0
+    finally:
+        tagReader.close()
+        library.close()
+
+
+def main(argv):
+    try:
+        argv = takeProfileArgument(argv)
+    except ValueError as error:
+        print('error: %s' % error, file=sys.stderr)
+        return 2
+    if not argv or argv[0] in ('-h', '--help'):
+        print(__doc__.strip())
+        return 0
+    if argv[0] == 'serve':
+        return serve(argv[1:])
+    if argv[0] == 'index':
+        return index(argv[1:])
+    try:
+        return run(argv)
+    except IndexError:
+        print('error: missing argument', file=sys.stderr)
+        return 2
+    except ValueError as error:
+        print('error: %s' % error, file=sys.stderr)
+        return 2
+    except OSError as error:
+        print('error: no player is listening on %s (%s)' % (controlSocketPath(), error), file=sys.stderr)
+        return 1
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
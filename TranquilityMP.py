@@ -1,58 +1,229 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
-import os
-import sys
+import time
 
-from PyQt5.QtCore import QUrl, QFileInfo, Qt
-from PyQt5.QtGui import QPalette, QColor
-from PyQt5.QtMultimedia import QMediaPlayer, QMediaPlaylist, QMediaContent, QMediaMetaData
-from PyQt5.QtWidgets import (QApplication, QLineEdit, QInputDialog, QMainWindow)
+# Taken before the Qt imports so the startup profile covers them
+STARTED = time.perf_counter()
 
-from MainWindow import MainWindow
+import os
+import sys
+import threading
+
+from PyQt5.QtCore import Qt, QEvent, pyqtSignal
+from PyQt5.QtMultimedia import QMediaPlayer, QMediaPlaylist
+from PyQt5.QtWidgets import (QApplication, QLabel, QLineEdit, QInputDialog, QMainWindow)
+
+from Artwork import Artwork
+from ControlServer import ControlServer
+from Dedupe import Deduper, fileCandidates, libraryCandidates
+from DiagnosticsDock import DiagnosticsDock, LagMonitor
+from DuplicatesDialog import DuplicatesDialog
+from Instrumentation import recorder, timed, tracePath
+from Library import LibraryIndex, LibraryScanner
+from LibrarySnapshot import SnapshotWatcher
+from MainWindow import MainWindow, LIBRARY_ITEM
+from PlayerCore import PlayerCore
+from PlaylistIO import writePlaylist
+from PlaylistModel import configureTime
+from PlaylistRegistry import PlaylistRegistry
+from ReadAheadCache import formatBytes
+from Settings import (dataFile, libraryRoots, playlistRoots, setCrossfadeTime, controlSocketPath, sharedLibraryDir,
+                      takeProfileArgument)
+from SmartPlaylistDialog import SmartPlaylistDialog
+from SmartPlaylists import SMART_EXTENSION, SmartPlaylist, isSmartPlaylistFile
+from StartupProfiler import StartupProfiler
+from Themes import palette
+
+MODE_DESCRIPTIONS = {QMediaPlaylist.CurrentItemInLoop: "Repeat One", QMediaPlaylist.Loop: "Repeat All",
+                     QMediaPlaylist.Random: "Shuffle"}
 
 
 class TranquilityMP(QMainWindow, MainWindow):
+    libraryChunk = pyqtSignal(object)
+    libraryRemoved = pyqtSignal(list)
+    libraryScanFinished = pyqtSignal()
+    duplicatesFound = pyqtSignal(list)
+    libraryDuplicatesFound = pyqtSignal(list)
+    dedupeProgress = pyqtSignal(str, int, int)
+
     def __init__(self, playlist, parent=None):
         super(TranquilityMP, self).__init__(parent)
         self.statusInfo = ""
         self.trackInfo = ""
         self.theme = 0
         self.colorTheme = 0
-        self.mediaPlayer = QMediaPlayer()
-        self.playlist = QMediaPlaylist()
-        self.mediaPlayer.setPlaylist(self.playlist)
+        self.loadStarted = None
+        self.library = LibraryIndex(dataFile('library.db'))
+        self.scanner = None
+        self.deduper = None
+        self.artwork = None
+        self.diagnostics = None
+        self.snapshotWatcher = None
+        if tracePath() is not None:
+            recorder.setEnabled(True)
+            LagMonitor(parent=self).start()
+        # Playback lives in the core, the window and the control socket are its clients
+        self.core = PlayerCore(parent=self)
+        # Completed plays reach the library's counters from the history writer thread
+        self.core.history.onPlays = self.library.recordPlays
+        self.controlServer = ControlServer(self.core, controlSocketPath(), parent=self)
         self.establishLayout()
+        self.cacheLabel = QLabel()
+        self.statusBar().addPermanentWidget(self.cacheLabel)
         self.connectSignals()
-        self.allPlaylists = self.loadPlaylists()
+        self.addGauges()
+        self.registry = PlaylistRegistry([], parent=self)
         self.toggleTheme()
-        self.addToPlaylist(playlist)
+        # Only the bare window is built here, everything that touches the disk or the media backend
+        # waits until it has been painted once
+        self.startupFiles = playlist
+        self.startup = StartupProfiler(STARTED, dataFile('startup.log'), parent=self)
+        self.startup.windowShown.connect(self.finishStartup)
+        self.startup.finished.connect(self.setStatusInfo)
+        self.startup.watch(self)
+
+    def finishStartup(self):
+        self.loadStarted = time.perf_counter()
+        if sharedLibraryDir():
+            # An indexer process keeps the library and the playlist folders, this player maps what it publishes
+            self.snapshotWatcher = SnapshotWatcher(sharedLibraryDir(), parent=self)
+            self.snapshotWatcher.snapshotChanged.connect(self.snapshotChanged)
+        self.core.start(self.libraryTracks)
+        self.controlServer.start()
+        self.artwork = Artwork(dataFile('artwork'), parent=self)
+        self.artwork.artworkReady.connect(self.artworkReady)
+        self.playlistModel.setArtwork(self.artwork)
+        self.showCover(self.core.currentIndex)
+        self.analyzeAction.setEnabled(self.core.analyzer is not None)
+        self.normalizeAction.setEnabled(self.core.analyzer is not None)
+        self.normalizeAction.setChecked(self.core.normalize)
+        self.loadPlaylists()
+        self.library.retainSmartPlaylists(self.smartPlaylistPaths())
+        self.addToPlaylist(self.startupFiles)
+        self.startupFiles = None
+        if self.core.playlistLoader is None:
+            self.startup.mark('playable')
+        self.rescanLibrary()
 
     def connectSignals(self):
-        self.mediaPlayer.durationChanged.connect(self.durationChanged)
-        self.mediaPlayer.positionChanged.connect(self.positionChanged)
-        self.mediaPlayer.metaDataChanged.connect(self.metaDataChanged)
-        self.mediaPlayer.mediaStatusChanged.connect(self.statusChanged)
-        self.mediaPlayer.stateChanged.connect(self.stateChanged)
+        self.core.started.connect(self.connectEngine)
+        self.core.currentChanged.connect(self.showCacheStats)
+        self.core.currentChanged.connect(lambda row: self.seekSlider.setWaveform(None, None))
+        self.core.currentChanged.connect(self.showCover)
+        self.core.analysisReady.connect(self.showWaveform)
+        self.core.analysisProgress.connect(
+            lambda done, total: self.setStatusInfo("Loudness analyzed for %d of %d tracks" % (done, total)))
+        self.core.modeChanged.connect(self.modeChanged)
+        self.core.tracksAdded.connect(lambda first, last: self.startup.mark('playable'))
+        self.core.tracksLoaded.connect(lambda count: self.setStatusInfo("%d tracks loaded" % count))
+        self.core.message.connect(self.setStatusInfo)
+        self.core.appearanceRestored.connect(self.restoreAppearance)
+        self.libraryChunk.connect(self.libraryChunkReady)
+        self.libraryRemoved.connect(self.libraryTracksRemoved)
+        self.libraryScanFinished.connect(self.libraryScanDone)
+        self.duplicatesFound.connect(self.removeDuplicateTracks)
+        self.libraryDuplicatesFound.connect(self.showDuplicates)
+        self.dedupeProgress.connect(
+            lambda stage, done, total: self.setStatusInfo("Duplicates, %s pass: %d of %d files" % (stage, done, total)))
+
+    def addGauges(self):
+        recorder.addGauge('read-ahead hit rate', self.core.readAhead.hitRate)
+        recorder.addGauge('tag cache hit rate', lambda: self.core.tagReader.cache.hits / max(
+            1, self.core.tagReader.cache.hits + self.core.tagReader.cache.misses))
+        recorder.addGauge('seek bar updates applied', lambda: self.positionThrottle.applied)
+        recorder.addGauge('seek bar ticks skipped', lambda: self.positionThrottle.skipped)
+        recorder.addGauge('playlist bytes per track', self.playlistModel.bytesPerTrack)
+        recorder.addGauge('artwork cache hit rate', lambda: self.artwork.hitRate())
+
+    def toggleDiagnostics(self, visible):
+        if self.diagnostics is None:
+            if not visible:
+                return
+            self.diagnostics = DiagnosticsDock(parent=self)
+            self.diagnostics.closed.connect(lambda: self.diagnosticsAction.setChecked(False))
+            self.addDockWidget(Qt.BottomDockWidgetArea, self.diagnostics)
+        if visible:
+            self.diagnostics.show()
+        else:
+            self.diagnostics.close()
 
     def createPlaylist(self):
-        root = QFileInfo(__file__).absolutePath()
-        spot = (root + '/playlists/')
         playlistName = self.getText()
-        completeName = os.path.join(spot, f'{playlistName}.m3u')
-        file = open(completeName, 'w')
-        file.close()
-        self.playlistView.addItem(playlistName)
-        self.allPlaylists = self.loadPlaylists()
+        if playlistName:
+            self.writeRegistryPlaylist(playlistName, [])
 
     def savePlaylist(self):
-        root = "C:\\Users\\dchtk\\Music\\Playlists"
         playlistName = self.getText()
-        completeName = os.path.join(root, f'{playlistName}.m3u')
-        file = open(completeName, 'a+')
-        for i in range(self.currentPlaylist.count()):
-            file.write(''.join([str(self.currentPlaylist.item(i).text()), '\n']))
-        file.close()
-        self.playlistView.addItem(playlistName)
+        if playlistName:
+            self.writeRegistryPlaylist(playlistName, self.playlistModel.entries())
+
+    def writeRegistryPlaylist(self, playlistName, entries):
+        completeName = self.registry.pathFor(playlistName)
+        # A smart playlist's rules are not a track list, saving over them would lose them
+        if isSmartPlaylistFile(completeName):
+            self.setStatusInfo("A smart playlist with that name already exists")
+            return
+        writePlaylist(completeName, entries)
+        # Refresh right away instead of waiting for the debounced watcher
+        self.registry.invalidate(completeName)
+        self.registry.refresh(os.path.dirname(completeName))
+
+    def createSmartPlaylist(self):
+        dialog = SmartPlaylistDialog(parent=self)
+        if not dialog.exec_():
+            return
+        path = self.registry.pathFor(dialog.name.text().strip(), SMART_EXTENSION)
+        if not isSmartPlaylistFile(path):
+            self.setStatusInfo("A playlist with that name already exists")
+            return
+        dialog.playlist().save(path)
+        self.registry.refresh(os.path.dirname(path))
+
+    def editSmartPlaylist(self):
+        item = self.playlistView.currentItem()
+        path = self.registry.path(item.text()) if item is not None else None
+        if path is None or not isSmartPlaylistFile(path):
+            return
+        playlist = self.loadSmartPlaylist(path)
+        if playlist is None:
+            return
+        dialog = SmartPlaylistDialog(item.text(), playlist, editing=True, parent=self)
+        if dialog.exec_():
+            dialog.playlist().save(path)
+            self.defineSmartPlaylist(path)
+
+    def loadSmartPlaylist(self, path):
+        try:
+            return SmartPlaylist.load(path)
+        except (OSError, ValueError) as error:
+            self.setStatusInfo("%s: %s" % (os.path.basename(path), error))
+            return None
+
+    def defineSmartPlaylist(self, path):
+        # Members are only rebuilt when the rules changed, or once a day for rules on dates
+        playlist = self.loadSmartPlaylist(path)
+        if playlist is not None:
+            try:
+                query = playlist.query(time.time())
+            except (TypeError, ValueError) as error:
+                # A hand edited rule file must not raise out of the watcher
+                self.setStatusInfo("%s: %s" % (os.path.basename(path), error))
+                return None
+            self.library.defineSmartPlaylist(path, *query)
+        return playlist
+
+    def openSmartPlaylist(self, path):
+        playlist = self.defineSmartPlaylist(path)
+        if playlist is not None:
+            self.loadStarted = time.perf_counter()
+            self.core.setTracks(self.library.smartTracks(path, playlist.order(), playlist.limit))
+
+    def smartPlaylistPaths(self):
+        return [path for path in self.registry.playlists.values() if isSmartPlaylistFile(path)]
+
+    def rateSelection(self, stars):
+        paths = [self.playlistModel.path(self.playlistModel.storeRow(row)) for row in self.selectedRows()]
+        self.library.setRating(paths, stars)
 
     def getText(self):
         text, okPressed = QInputDialog.getText(self, "New Playlist", "Playlist Name:", QLineEdit.Normal, "")
@@ -60,79 +231,234 @@ class TranquilityMP(QMainWindow, MainWindow):
             return text
 
     def loadPlaylists(self):
-        playlists = []
-        root = "C:\\Users\\dchtk\\Music\\Playlists"
-        songsPlaylist = os.listdir(root)
-        for item in songsPlaylist:
-            if str(item[-4:]) == '.m3u':
-                self.playlistView.addItem(item[:-4])
-                playlists.append(root + item)
-        return playlists
+        self.registry.playlistAdded.connect(self.playlistAdded)
+        self.registry.playlistRemoved.connect(self.playlistRemoved)
+        snapshot = self.snapshotWatcher.snapshot if self.snapshotWatcher is not None else None
+        for root in playlistRoots():
+            self.registry.addRoot(root, watch=snapshot is None)
+        if snapshot is not None:
+            self.registry.setPlaylists(snapshot.playlists())
+
+    def playlistAdded(self, name):
+        # Row 0 is the library, playlists follow in alphabetical order
+        row = 1
+        while row < self.playlistView.count() and self.playlistView.item(row).text().lower() < name.lower():
+            row += 1
+        self.playlistView.insertItem(row, name)
+        path = self.registry.path(name)
+        if isSmartPlaylistFile(path):
+            self.defineSmartPlaylist(path)
+
+    def playlistRemoved(self, name):
+        for item in self.playlistView.findItems(name, Qt.MatchExactly):
+            if item.text() != LIBRARY_ITEM:
+                self.playlistView.takeItem(self.playlistView.row(item))
+        self.library.retainSmartPlaylists(self.smartPlaylistPaths())
 
     def addToPlaylist(self, fileNames):
-        for name in fileNames:
-            fileInfo = QFileInfo(name)
-            songFileTitle = os.path.basename(name)
-            if fileInfo.exists():
-                url = QUrl.fromLocalFile(fileInfo.absoluteFilePath())
-                if fileInfo.suffix().lower() == 'm3u':
-                    self.playlist.load(url)
-                else:
-                    self.playlist.addMedia(QMediaContent(url))
-                    self.currentPlaylist.addItem(songFileTitle)
-            else:
-                url = QUrl(name)
-                if url.isValid():
-                    self.playlist.addMedia(QMediaContent(url))
-                    self.currentPlaylist.addItem(songFileTitle)
-
+        self.loadStarted = time.perf_counter()
+        self.core.addTracks(fileNames)
+
+    def loadPlaylistBatches(self, batches):
+        self.loadStarted = time.perf_counter()
+        self.core.loadPlaylistBatches(batches)
+
+    def removeDuplicateFiles(self):
+        # Hashing reads files, so it runs off the GUI thread on a snapshot and removes by track id,
+        # the hashes are cached in the library index for the next run
+        if self.deduper is not None:
+            return
+        count = self.playlistModel.trackCount()
+        trackIds = self.playlistModel.trackIds(0, count - 1)
+        paths = [self.playlistModel.path(row) for row in range(count)]
+        self.deduper = Deduper(self.library, onProgress=self.dedupeProgress.emit)
+        self.setStatusInfo("Looking for duplicate files")
+        threading.Thread(target=self.runDedupe, args=(self.deduper, fileCandidates(paths), self.duplicatesFound,
+                                                      lambda groups: duplicateTrackIds(groups, paths, trackIds)),
+                         daemon=True).start()
+
+    def removeDuplicateTracks(self, trackIds):
+        self.setStatusInfo("%d duplicate files removed" % self.core.removeTrackIds(trackIds))
+
+    def findDuplicates(self):
+        # Different rips of a recording are only looked for here, decoding is too slow for a playlist command
+        if self.deduper is not None:
+            return
+        self.deduper = Deduper(self.library, acoustic=True, onProgress=self.dedupeProgress.emit)
+        self.setStatusInfo("Looking for duplicates in the library")
+        threading.Thread(target=self.runDedupe, args=(self.deduper, libraryCandidates(self.library, libraryRoots()),
+                                                      self.libraryDuplicatesFound, list), daemon=True).start()
+
+    def runDedupe(self, deduper, candidates, signal, convert):
+        try:
+            groups = deduper.find(candidates)
+        finally:
+            self.deduper = None
+        if not deduper.cancelled:
+            signal.emit(convert(groups))
+
+    def showDuplicates(self, groups):
+        if not groups:
+            self.setStatusInfo("No duplicates found")
+            return
+        self.setStatusInfo("%d groups of duplicates" % len(groups))
+        dialog = DuplicatesDialog(groups, parent=self)
+        dialog.removeFromPlaylist.connect(self.removePaths)
+        dialog.filesTrashed.connect(self.removePaths)
+        dialog.filesTrashed.connect(lambda paths: self.rescanLibrary())
+        dialog.setAttribute(Qt.WA_DeleteOnClose)
+        dialog.show()
+
+    def removePaths(self, paths):
+        paths = set(paths)
+        count = self.playlistModel.trackCount()
+        trackIds = self.playlistModel.trackIds(0, count - 1)
+        self.removeDuplicateTracks([trackIds[row] for row in range(count) if self.playlistModel.path(row) in paths])
+
+    def showLibrary(self):
+        # The index already holds every track, so opening the library never touches the disk
+        columns = self.libraryTracks()
+        self.loadStarted = time.perf_counter()
+        self.core.setTracks(columns, library=True)
+
+    def libraryTracks(self):
+        snapshot = self.snapshotWatcher.snapshot if self.snapshotWatcher is not None else None
+        if snapshot is not None:
+            return snapshot.tracks()
+        return self.library.tracks(libraryRoots())
+
+    def snapshotChanged(self, snapshot):
+        self.registry.setPlaylists(snapshot.playlists())
+        if self.core.showingLibrary:
+            # The playing track goes on and stays marked when it is still in the library
+            path = self.core.currentPath()
+            self.showLibrary()
+            if path is not None:
+                self.core.followTrack(snapshot.rowOf(path))
+        self.setStatusInfo("Library updated, %d tracks" % len(snapshot))
+
+    def rescanLibrary(self):
+        roots = libraryRoots()
+        if not roots or self.scanner is not None or self.core.tagReader is None or self.snapshotWatcher is not None:
+            return
+        self.scanner = LibraryScanner(self.library, roots, onChunk=self.libraryChunk.emit,
+                                      onRemoved=self.libraryRemoved.emit, tagReader=self.core.tagReader.readMany)
+        threading.Thread(target=self.runScan, args=(self.scanner,), daemon=True).start()
+        self.setStatusInfo("Scanning library")
+
+    def runScan(self, scanner):
+        try:
+            scanner.scan()
+            # Tags read by the scan are kept for the next start, written here off the GUI thread
+            self.core.tagReader.cache.save()
+        finally:
+            self.libraryScanFinished.emit()
+
+    def analyzeLibrary(self):
+        # Tracks analyzed before are skipped without reading them, so an interrupted run just continues
+        paths = self.library.tracks(libraryRoots())[0]
+        if self.core.analyzeLibrary(paths):
+            self.setStatusInfo("Analyzing loudness of %d tracks" % len(paths))
+
+    def showCover(self, row):
+        path = self.core.currentPath()
+        if self.artwork is not None:
+            self.coverView.setCover(self.artwork.cover(path) if path is not None else None)
+
+    def artworkReady(self, path):
+        if path == self.core.currentPath():
+            self.coverView.setCover(self.artwork.cover(path))
+
+    def showWaveform(self, path, analysis):
+        if path == self.core.currentPath():
+            self.seekSlider.setWaveform(analysis.peaks, analysis.rms)
+
+    def libraryChunkReady(self, columns):
+        # New files stream in while the scan is still running
+        if self.core.showingLibrary:
+            self.playlistModel.appendTracks(*columns)
+
+    def libraryTracksRemoved(self, paths):
+        self.setStatusInfo("%d tracks no longer in library" % len(paths))
+
+    def libraryScanDone(self):
+        self.scanner = None
+        self.setStatusInfo("%d tracks in library" % self.library.count())
+
+    def closeEvent(self, event):
+        if self.scanner is not None:
+            self.scanner.cancel()
+        if self.deduper is not None:
+            self.deduper.cancel()
+        self.controlServer.close()
+        if self.artwork is not None:
+            self.artwork.close()
+        self.core.close()
+        if tracePath() is not None:
+            recorder.writeTrace(tracePath())
+        super(TranquilityMP, self).closeEvent(event)
+
+    def eventFilter(self, obj, event):
+        # Report time-to-first-paint and the per-track footprint of the last batch load
+        if (self.loadStarted is not None and event.type() == QEvent.Paint
+                and obj is self.currentPlaylist.viewport()):
+            elapsed = (time.perf_counter() - self.loadStarted) * 1000
+            self.loadStarted = None
+            self.setStatusInfo("%d tracks, first paint %.0f ms, %d B/track"
+                               % (self.playlistModel.trackCount(), elapsed, self.playlistModel.bytesPerTrack()))
+        return super(TranquilityMP, self).eventFilter(obj, event)
+
+    def showCacheStats(self, *args):
+        readAhead = self.core.readAhead
+        if readAhead.hits + readAhead.misses:
+            self.cacheLabel.setText("Cache %.0f%% hits, %s saved"
+                                    % (readAhead.hitRate() * 100, formatBytes(readAhead.bytesSaved)))
+
+    def setCrossfade(self):
+        value, okPressed = QInputDialog.getInt(self, "Crossfade", "Crossfade (ms):", self.core.engine.crossfade,
+                                               0, 12000, 500)
+        if okPressed:
+            setCrossfadeTime(value)
+            self.core.engine.setCrossfade(value)
+
+    @timed()
     def metaDataChanged(self):
-        if self.mediaPlayer.isMetaDataAvailable():
-            self.setTrackInfo("%s - %s" % (self.mediaPlayer.metaData(QMediaMetaData.AlbumArtist),
-                                           self.mediaPlayer.metaData(QMediaMetaData.Title)))
+        info = self.core.metaDataText()
+        if info is not None:
+            self.setTrackInfo(info)
 
-    def previousMedia(self):
-        if self.mediaPlayer.position() <= 5000:
-            self.playlist.previous()
-        else:
-            self.playlist.setPosition(0)
+    def modeChanged(self, mode):
+        self.setStatusInfo(MODE_DESCRIPTIONS.get(mode, ""))
 
     def setRepeatOne(self):
-        if self.mediaPlayer.state == QMediaPlayer.PlayingState:
-            self.playlist.setPlaybackMode(QMediaPlaylist.CurrentItemInLoop)
+        self.core.togglePlaybackMode(QMediaPlaylist.CurrentItemInLoop)
 
     def setRepeatAll(self):
-        if self.mediaPlayer.state == QMediaPlayer.PlayingState:
-            self.playlist.setPlaybackMode(QMediaPlaylist.Loop)
+        self.core.togglePlaybackMode(QMediaPlaylist.Loop)
 
+    def setShuffle(self):
+        self.core.togglePlaybackMode(QMediaPlaylist.Random)
+
+    @timed()
     def durationChanged(self, duration):
         self.duration = duration
-        self.seekSlider.setMaximum(duration)
+        self.positionThrottle.setDuration(duration)
         if duration > 0:
             self.totalTimeLabel.setText(configureTime(self.duration))
 
+    @timed()
     def positionChanged(self, position):
-        if not self.seekSlider.isSliderDown():
-            self.seekSlider.setValue(position)
-        if position > 0:
-            self.currentTimeLabel.setText(configureTime(position))
-
-    def seek(self, seconds):
-        if self.mediaPlayer.isSeekable():
-            self.mediaPlayer.setPosition(seconds)
-
-    def stateChanged(self):
-        if self.mediaPlayer.state == QMediaPlayer.StoppedState:
-            self.mediaPlayer.stop()
+        self.positionThrottle.setPosition(position)
 
+    @timed()
     def statusChanged(self, status):
+        # The core reacts to the status, the window only reports it
         self.handleCursor(status)
 
         if status == QMediaPlayer.LoadingMedia:
             self.setStatusInfo("Loading")
         elif status == QMediaPlayer.LoadedMedia:
             self.setStatusInfo("Loaded")
-            self.mediaPlayer.play()
         elif status == QMediaPlayer.BufferingMedia:
             self.setStatusInfo("Buffering")
         elif status == QMediaPlayer.EndOfMedia:
@@ -165,93 +491,45 @@ class TranquilityMP(QMainWindow, MainWindow):
             self.statusBar().showMessage(self.trackInfo)
 
     def displayError(self):
-        self.setStatusInfo(self.mediaPlayer.errorString())
+        self.setStatusInfo(self.core.engine.errorString())
 
     def toggleTheme(self):
-        """ Fusion dark palette from https://gist.github.com/QuantumCD/6245215. Modified by D.C """
-        app.setStyle("Fusion")
-        palette = QPalette()
-        if self.theme == 0:
-            palette.setColor(QPalette.Window, QColor(53, 53, 53))
-            palette.setColor(QPalette.WindowText, Qt.white)
-            palette.setColor(QPalette.Base, QColor(25, 25, 25))
-            palette.setColor(QPalette.AlternateBase, QColor(53, 53, 53))
-            palette.setColor(QPalette.ToolTipBase, Qt.white)
-            palette.setColor(QPalette.ToolTipText, Qt.white)
-            palette.setColor(QPalette.Text, Qt.white)
-            palette.setColor(QPalette.Button, QColor(53, 53, 53))
-            palette.setColor(QPalette.ButtonText, Qt.white)
-            palette.setColor(QPalette.BrightText, Qt.red)
-            palette.setColor(QPalette.Link, QColor(235, 101, 54))
-            palette.setColor(QPalette.Highlight, QColor(66, 155, 248))
-            palette.setColor(QPalette.HighlightedText, Qt.black)
-            app.setPalette(palette)
-            self.theme = 1
-        elif self.theme == 1:
-            palette.setColor(QPalette.Window, Qt.white)
-            palette.setColor(QPalette.WindowText, Qt.black)
-            palette.setColor(QPalette.Base, QColor(240, 240, 240))
-            palette.setColor(QPalette.AlternateBase, Qt.white)
-            palette.setColor(QPalette.ToolTipBase, Qt.white)
-            palette.setColor(QPalette.ToolTipText, Qt.white)
-            palette.setColor(QPalette.Text, Qt.black)
-            palette.setColor(QPalette.Button, Qt.white)
-            palette.setColor(QPalette.ButtonText, Qt.black)
-            palette.setColor(QPalette.BrightText, Qt.red)
-            palette.setColor(QPalette.Link, QColor(66, 155, 248))
-            palette.setColor(QPalette.Highlight, QColor(66, 155, 248))
-            palette.setColor(QPalette.HighlightedText, Qt.black)
-            app.setPalette(palette)
-            self.theme = 0
+        self.theme = 1 - self.theme
+        self.applyPalette('dark' if self.theme else 'light')
 
     def toggleColor(self):
-        app.setStyle("Fusion")
-        palette = QPalette()
-        if self.colorTheme == 0:
-            palette.setColor(QPalette.Window, QColor(178, 34, 34))
-            palette.setColor(QPalette.WindowText, Qt.white)
-            palette.setColor(QPalette.Base, QColor(128, 0, 0))
-            palette.setColor(QPalette.AlternateBase, QColor(178, 34, 34))
-            palette.setColor(QPalette.ToolTipBase, Qt.white)
-            palette.setColor(QPalette.ToolTipText, Qt.white)
-            palette.setColor(QPalette.Text, Qt.white)
-            palette.setColor(QPalette.Button, QColor(178, 34, 34))
-            palette.setColor(QPalette.ButtonText, Qt.white)
-            palette.setColor(QPalette.BrightText, Qt.red)
-            palette.setColor(QPalette.Link, QColor(235, 101, 54))
-            palette.setColor(QPalette.Highlight, QColor(66, 155, 248))
-            palette.setColor(QPalette.HighlightedText, Qt.black)
-            app.setPalette(palette)
-            self.colorTheme = 1
-        elif self.colorTheme == 1:
-            palette.setColor(QPalette.Window, QColor(72, 61, 139))
-            palette.setColor(QPalette.WindowText, Qt.white)
-            palette.setColor(QPalette.Base, QColor(75, 0, 130))
-            palette.setColor(QPalette.AlternateBase, QColor(72, 61, 139))
-            palette.setColor(QPalette.ToolTipBase, Qt.black)
-            palette.setColor(QPalette.ToolTipText, Qt.black)
-            palette.setColor(QPalette.Text, Qt.white)
-            palette.setColor(QPalette.Button, QColor(72, 61, 139))
-            palette.setColor(QPalette.ButtonText, Qt.white)
-            palette.setColor(QPalette.BrightText, Qt.red)
-            palette.setColor(QPalette.Link, QColor(235, 101, 54))
-            palette.setColor(QPalette.Highlight, QColor(53, 53, 53))
-            palette.setColor(QPalette.HighlightedText, Qt.white)
-            app.setPalette(palette)
-            self.colorTheme = 0
-
-
-def configureTime(ms):
-    s = round(ms / 1000)
-    m, s = divmod(s, 60)
-    h, m = divmod(m, 60)
-
-    return ("%d:%02d:%02d" % (h, m, s)) if h else ("%02d:%02d" % (m, s))
+        self.colorTheme = 1 - self.colorTheme
+        self.applyPalette('red' if self.colorTheme else 'purple')
+
+    def restoreAppearance(self, name, theme, colorTheme):
+        self.theme = theme
+        self.colorTheme = colorTheme
+        self.applyPalette(name)
+
+    def applyPalette(self, name):
+        self.core.appearance = (name, self.theme, self.colorTheme)
+        QApplication.instance().setPalette(palette(name))
+
+
+def duplicateTrackIds(groups, paths, trackIds):
+    """ Track ids of every row holding a copy of an earlier row's file. """
+    groupOf = {path: number for number, group in enumerate(groups) for path in group.paths}
+    seen = set()
+    duplicates = []
+    for path, trackId in zip(paths, trackIds):
+        number = groupOf.get(path)
+        if number is not None:
+            if number in seen:
+                duplicates.append(trackId)
+            seen.add(number)
+    return duplicates
 
 
 if __name__ == '__main__':
-    app = QApplication(sys.argv)
-    player = TranquilityMP(sys.argv[1:])
+    # Profiles before Qt sees the arguments, --profile NAME runs one of several players with its own data
+    argv = sys.argv[:1] + takeProfileArgument(sys.argv[1:])
+    app = QApplication(argv)
+    app.setStyle("Fusion")
+    player = TranquilityMP(argv[1:])
     player.show()
     sys.exit(app.exec_())
-
@@ -0,0 +1,102 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+from PyQt5.QtCore import Qt, QEvent, QLineF
+from PyQt5.QtGui import QPainter, QPalette, QPixmap
+from PyQt5.QtWidgets import QSlider, QStyle
+
+WAVEFORM_HEIGHT = 36
+
+
+class WaveformSlider(QSlider):
+    """ Seek bar that draws the track's waveform, the played part highlighted, once one is set.
+
+    The waveform is rendered into two pixmaps, played and unplayed, whenever the size, the palette or
+    the track changes, so a position update only copies pixmap halves. Without a waveform it is a
+    plain slider.
+    """
+
+    def __init__(self, orientation=Qt.Horizontal, parent=None):
+        super(WaveformSlider, self).__init__(orientation, parent)
+        self.peaks = None
+        self.rms = None
+        self.pixmaps = None
+
+    def setWaveform(self, peaks, rms):
+        """ Peak and RMS columns as bytes scaled to 0-255, None or empty for a plain slider. """
+        self.peaks = peaks or None
+        self.rms = rms or None
+        self.pixmaps = None
+        self.setMinimumHeight(WAVEFORM_HEIGHT if self.peaks else 0)
+        self.update()
+
+    def resizeEvent(self, event):
+        self.pixmaps = None
+        super(WaveformSlider, self).resizeEvent(event)
+
+    def changeEvent(self, event):
+        if event.type() == QEvent.PaletteChange:
+            self.pixmaps = None
+        super(WaveformSlider, self).changeEvent(event)
+
+    def renderWaveform(self, peakColor, rmsColor):
+        width, height = self.width(), self.height()
+        pixmap = QPixmap(width, height)
+        pixmap.fill(Qt.transparent)
+        middle = height / 2
+        scale = (height - 2) / 2 / 255
+        peakLines = []
+        rmsLines = []
+        for x in range(width):
+            column = x * len(self.peaks) // width
+            peak = max(0.5, self.peaks[column] * scale)
+            peakLines.append(QLineF(x, middle - peak, x, middle + peak))
+            if self.rms:
+                rms = self.rms[column] * scale
+                rmsLines.append(QLineF(x, middle - rms, x, middle + rms))
+        painter = QPainter(pixmap)
+        painter.setPen(peakColor)
+        painter.drawLines(peakLines)
+        painter.setPen(rmsColor)
+        painter.drawLines(rmsLines)
+        painter.end()
+        return pixmap
+
+    def paintEvent(self, event):
+        if self.peaks is None or self.orientation() != Qt.Horizontal:
+            return super(WaveformSlider, self).paintEvent(event)
+        palette = self.palette()
+        if self.pixmaps is None:
+            highlight = palette.color(QPalette.Highlight)
+            self.pixmaps = (self.renderWaveform(highlight, highlight.darker()),
+                            self.renderWaveform(palette.color(QPalette.Mid), palette.color(QPalette.Dark)))
+        played, unplayed = self.pixmaps
+        width, height = self.width(), self.height()
+        split = QStyle.sliderPositionFromValue(self.minimum(), self.maximum(), self.sliderPosition(), width)
+        painter = QPainter(self)
+        painter.drawPixmap(0, 0, played, 0, 0, split, height)
+        painter.drawPixmap(split, 0, unplayed, split, 0, width - split, height)
+        painter.setPen(palette.color(QPalette.WindowText))
+        painter.drawLine(split, 0, split, height)
+
+    # With a waveform a click seeks to the clicked spot instead of stepping a page
+
+    def mousePressEvent(self, event):
+        if self.peaks is None or event.button() != Qt.LeftButton:
+            return super(WaveformSlider, self).mousePressEvent(event)
+        self.setSliderDown(True)
+        self.seekTo(event.x())
+
+    def mouseMoveEvent(self, event):
+        if self.peaks is None or not self.isSliderDown():
+            return super(WaveformSlider, self).mouseMoveEvent(event)
+        self.seekTo(event.x())
+
+    def mouseReleaseEvent(self, event):
+        if self.peaks is None or not self.isSliderDown():
+            return super(WaveformSlider, self).mouseReleaseEvent(event)
+        self.setSliderDown(False)
+
+    def seekTo(self, x):
+        # Emits sliderMoved while the slider is down, like dragging the handle
+        self.setSliderPosition(QStyle.sliderValueFromPosition(self.minimum(), self.maximum(), x, self.width()))
+        self.update()
@@ -0,0 +1,328 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+""" Benchmark and regression suite for the library, playlist and UI hot paths.
+
+Every scenario runs in its own process on the offscreen Qt platform, with empty settings and data
+directories, against the synthetic libraries of SyntheticLibrary.py:
+
+    startup     time to the first painted window and to the first playable track, the library
+                playlist given on the command line as a user would
+    playlist    loading the library playlist into a visible playlist table, peak RSS afterwards,
+                filter keystroke latency, and seek bar updates while a track plays
+    library     cold scan of the library folders with tag reading, then an unchanged rescan
+
+Results are written as JSON. Given the results of an earlier run as the baseline, metrics that got
+worse by more than the threshold are listed and the exit code is 1.
+
+Usage: python benchmarks/BenchmarkSuite.py [--sizes 1000,10000,100000] [--output results.json]
+                                           [--baseline baseline.json] [--threshold 0.15] [--work DIR]
+"""
+import time
+
+# Taken before anything else is imported so startup times cover the imports
+PROCESS_STARTED = time.perf_counter()
+
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+from collections import Counter
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from SyntheticLibrary import buildLibrary  # noqa: E402
+
+SIZES = (1000, 10000, 100000)
+SCENARIOS = ('startup', 'playlist', 'library')
+# name: (unit, higher is better, smallest change that counts, below it is noise)
+METRICS = {
+    'startupWindowMs': ('ms', False, 20),
+    'startupPlayableMs': ('ms', False, 20),
+    'playlistFirstRowsMs': ('ms', False, 10),
+    'playlistLoadMs': ('ms', False, 20),
+    'peakRssMb': ('MB', False, 5),
+    'searchIndexMs': ('ms', False, 20),
+    'searchP95Ms': ('ms', False, 2),
+    'positionUpdatesPerSecond': ('/s', True, 1),
+    'positionTickUs': ('us', False, 5),
+    'libraryScanMs': ('ms', False, 50),
+    'libraryRescanMs': ('ms', False, 20),
+}
+PLAYBACK_SECONDS = 3
+# Well above the backend's own notify rate, so the throttle has to do its job
+TICK_INTERVAL_MS = 5
+TIMEOUT_SECONDS = 900
+
+
+def peakRss():
+    """ Peak resident set size of this process in MB, None where it cannot be measured. """
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS bytes
+    return peak / (1024 * 1024 if sys.platform == 'darwin' else 1024)
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))] if values else None
+
+
+def waitFor(signal, timeout=TIMEOUT_SECONDS):
+    """ Run the event loop until signal is emitted, returns its arguments or None on timeout. """
+    from PyQt5.QtCore import QEventLoop, QTimer
+    loop = QEventLoop()
+    received = []
+    signal.connect(lambda *args: (received.append(args), loop.quit()))
+    QTimer.singleShot(timeout * 1000, loop.quit)
+    loop.exec_()
+    return received[0] if received else None
+
+
+def searchQueries(titles):
+    """ Words of falling frequency from the titles, a two word query and one without matches. """
+    words = [word for word, _ in Counter(word.lower() for title in titles for word in title.split()).most_common()]
+    if not words:
+        return ['qqqx']
+    pick = lambda rank: words[min(rank, len(words) - 1)]
+    return [pick(0), pick(3), pick(40), pick(400), pick(4000), '%s %s' % (pick(1), pick(30)), 'qqqx']
+
+
+# Scenarios, each run in a child process
+
+def runStartup(playlistPath):
+    import TranquilityMP
+    from PyQt5.QtWidgets import QApplication, QMessageBox
+
+    # Nobody is there to dismiss a dialog when the multimedia backend is missing
+    QMessageBox.warning = lambda *args, **kwargs: QMessageBox.Ok
+    app = QApplication(sys.argv[:1])
+    app.setStyle("Fusion")
+    player = TranquilityMP.TranquilityMP([playlistPath])
+    player.show()
+    waitFor(player.startup.finished)
+    offset = (TranquilityMP.STARTED - PROCESS_STARTED) * 1000
+    marks = player.startup.marks
+    result = {'startupWindowMs': marks['window'] + offset if 'window' in marks else None,
+              'startupPlayableMs': marks['playable'] + offset if 'playable' in marks else None}
+    player.close()
+    return result
+
+
+def runPlaylist(playlistPath):
+    from PyQt5.QtCore import Qt, QTimer
+    from PyQt5.QtWidgets import QApplication, QLabel, QSlider, QTableView, QVBoxLayout, QWidget
+    from PlayerCore import PlayerCore
+    from PlaylistIO import iterPlaylists
+    from PositionThrottle import PositionThrottle
+
+    app = QApplication(sys.argv[:1])
+    core = PlayerCore()
+    window = QWidget()
+    table = QTableView()
+    table.setModel(core.model)
+    slider = QSlider(Qt.Horizontal)
+    label = QLabel()
+    layout = QVBoxLayout(window)
+    for widget in (table, slider, label):
+        layout.addWidget(widget)
+    window.resize(1000, 700)
+    window.show()
+    app.processEvents()
+    result = {}
+
+    # Tags are not read, the playlist already carries titles and durations and tag reading runs
+    # in other processes
+    firstRows = []
+    core.tracksAdded.connect(lambda first, last: firstRows.append(time.perf_counter()) if not firstRows else None)
+    started = time.perf_counter()
+    core.loadPlaylistBatches(iterPlaylists([playlistPath]))
+    waitFor(core.tracksLoaded)
+    app.processEvents()
+    result['playlistLoadMs'] = (time.perf_counter() - started) * 1000
+    result['playlistFirstRowsMs'] = (firstRows[0] - started) * 1000 if firstRows else None
+    result['tracks'] = core.model.trackCount()
+    result['bytesPerTrack'] = core.model.bytesPerTrack()
+
+    model = core.model
+    started = time.perf_counter()
+    model.setFilterText('')
+    model.finishIndexing()
+    result['searchIndexMs'] = (time.perf_counter() - started) * 1000
+    latencies = []
+    for query in searchQueries(model.store.titles):
+        model.setFilterText('')
+        for length in range(1, len(query) + 1):
+            started = time.perf_counter()
+            model.setFilterText(query[:length])
+            app.processEvents()
+            latencies.append((time.perf_counter() - started) * 1000)
+    model.setFilterText('')
+    app.processEvents()
+    result['searchP95Ms'] = percentile(latencies, 0.95)
+    result['searchMaxMs'] = max(latencies)
+
+    # Playback as the window sees it: position ticks into the throttled seek bar while the playing
+    # row is highlighted in the table
+    throttle = PositionThrottle(slider, label)
+    throttle.setDuration(PLAYBACK_SECONDS * 2000)
+    model.setCurrentRow(0)
+    tickCost = [0.0]
+    playStarted = time.perf_counter()
+
+    def tick():
+        started = time.perf_counter()
+        throttle.setPosition(int((started - playStarted) * 1000))
+        tickCost[0] += time.perf_counter() - started
+
+    ticker = QTimer()
+    ticker.setTimerType(Qt.PreciseTimer)
+    ticker.timeout.connect(tick)
+    ticker.start(TICK_INTERVAL_MS)
+    done = QTimer()
+    done.setSingleShot(True)
+    done.start(PLAYBACK_SECONDS * 1000)
+    waitFor(done.timeout)
+    ticker.stop()
+    elapsed = time.perf_counter() - playStarted
+    stats = throttle.stats()
+    result['positionUpdatesPerSecond'] = stats['applied'] / elapsed
+    result['positionTicksPerSecond'] = stats['received'] / elapsed
+    result['positionTickUs'] = tickCost[0] / max(1, stats['received']) * 1e6
+    result['peakRssMb'] = peakRss()
+    window.close()
+    core.close()
+    return result
+
+
+def runLibrary(musicPath):
+    from Library import LibraryIndex, LibraryScanner
+    from MetaData import TagCache, TagReader
+
+    result = {}
+    with tempfile.TemporaryDirectory() as data:
+        index = LibraryIndex(os.path.join(data, 'library.db'))
+        tagReader = TagReader(TagCache(os.path.join(data, 'tags.cache')))
+        for name in ('libraryScanMs', 'libraryRescanMs'):
+            scanner = LibraryScanner(index, [musicPath], onChunk=lambda columns: None, tagReader=tagReader.readMany)
+            started = time.perf_counter()
+            scanner.scan()
+            result[name] = (time.perf_counter() - started) * 1000
+        result['libraryTracks'] = index.count()
+        result['libraryPeakRssMb'] = peakRss()
+        tagReader.close()
+        index.close()
+    return result
+
+
+def runScenario(name, libraryPath):
+    playlistPath = os.path.join(libraryPath, 'playlists', 'All Tracks.m3u')
+    if name == 'startup':
+        return runStartup(playlistPath)
+    if name == 'playlist':
+        return runPlaylist(playlistPath)
+    return runLibrary(os.path.join(libraryPath, 'music'))
+
+
+# Driver
+
+def scenarioProcess(name, libraryPath):
+    """ Run a scenario in a fresh process with its own empty settings, returns its metrics. """
+    with tempfile.TemporaryDirectory(prefix='tranquility-bench-') as home:
+        env = dict(os.environ, QT_QPA_PLATFORM='offscreen')
+        for variable in ('XDG_DATA_HOME', 'XDG_CONFIG_HOME', 'XDG_CACHE_HOME', 'XDG_RUNTIME_DIR'):
+            env[variable] = os.path.join(home, variable.lower())
+            os.makedirs(env[variable], mode=0o700)
+        process = subprocess.run([sys.executable, os.path.abspath(__file__), '--scenario', name,
+                                  '--library', libraryPath], env=env, stdout=subprocess.PIPE,
+                                 stderr=subprocess.PIPE, universal_newlines=True, timeout=TIMEOUT_SECONDS)
+    lines = process.stdout.strip().splitlines()
+    if process.returncode != 0 or not lines:
+        error = process.stderr.strip().splitlines()
+        raise RuntimeError('%s failed: %s' % (name, error[-1] if error else 'exit code %d' % process.returncode))
+    return json.loads(lines[-1])
+
+
+def compare(results, baseline, threshold):
+    """ Descriptions of the metrics in results that are worse than in baseline by more than threshold. """
+    regressions = []
+    for size, metrics in sorted(results['sizes'].items(), key=lambda item: int(item[0])):
+        previous = baseline.get('sizes', {}).get(size, {})
+        for name, (unit, higherIsBetter, noise) in METRICS.items():
+            value, old = metrics.get(name), previous.get(name)
+            if value is None or old is None:
+                continue
+            worse = old - value if higherIsBetter else value - old
+            if worse > max(abs(old) * threshold, noise):
+                regressions.append('%s tracks: %s %.1f -> %.1f %s (%+.0f%%)'
+                                   % (size, name, old, value, unit, (value - old) / old * 100 if old else 0))
+    return regressions
+
+
+def report(results):
+    sizes = sorted(results['sizes'], key=int)
+    print('%-26s' % 'tracks' + ''.join('%14s' % size for size in sizes))
+    for name, (unit, _, _) in METRICS.items():
+        values = [results['sizes'][size].get(name) for size in sizes]
+        print('%-26s' % ('%s (%s)' % (name, unit))
+              + ''.join('%14s' % ('-' if value is None else '%.1f' % value) for value in values))
+    for size in sizes:
+        for error in results['sizes'][size].get('errors', []):
+            print('%s tracks: %s' % (size, error))
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0].strip())
+    parser.add_argument('--sizes', default=','.join(str(size) for size in SIZES),
+                        help='comma separated library sizes in tracks')
+    parser.add_argument('--output', default='benchmark-results.json', help='where to write the results')
+    parser.add_argument('--baseline', help='results of an earlier run to compare with')
+    parser.add_argument('--threshold', type=float, default=0.15, help='allowed relative slowdown, 0.15 is 15%%')
+    parser.add_argument('--work', default=os.path.join(tempfile.gettempdir(), 'tranquility-bench'),
+                        help='where the synthetic libraries are kept between runs')
+    parser.add_argument('--scenario', choices=SCENARIOS, help=argparse.SUPPRESS)
+    parser.add_argument('--library', help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    if args.scenario:
+        print(json.dumps(runScenario(args.scenario, args.library)))
+        return 0
+
+    results = {'time': time.strftime('%Y-%m-%dT%H:%M:%S'), 'python': platform.python_version(),
+               'platform': platform.platform(), 'cpus': os.cpu_count(), 'sizes': {}}
+    failed = False
+    for size in [int(size) for size in args.sizes.split(',') if size]:
+        libraryPath = os.path.join(args.work, str(size))
+        started = time.perf_counter()
+        buildLibrary(libraryPath, size)
+        print('%d tracks: library ready in %.1f s' % (size, time.perf_counter() - started), flush=True)
+        metrics = results['sizes'][str(size)] = {}
+        for name in SCENARIOS:
+            try:
+                metrics.update(scenarioProcess(name, libraryPath))
+            except (RuntimeError, ValueError, subprocess.TimeoutExpired) as error:
+                failed = True
+                metrics.setdefault('errors', []).append(str(error))
+    with open(args.output, 'w') as f:
+        json.dump(results, f, indent=2, sort_keys=True)
+    report(results)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f), args.threshold)
+        for regression in regressions:
+            print('REGRESSION %s' % regression)
+        if regressions:
+            return 1
+        print('No regressions against %s (threshold %.0f%%)' % (args.baseline, args.threshold * 100))
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,90 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+""" Keystroke latency of the playlist filter on a synthetic playlist.
+
+Every prefix of each query is searched in turn, the way the filter box sees it while typing, and the
+time to get from the text to the matching table rows is recorded.
+
+Usage: python benchmarks/SearchBenchmark.py [tracks]
+"""
+import os
+import random
+import sys
+import time
+from itertools import accumulate
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from SearchIndex import SearchIndex  # noqa: E402
+from TrackStore import TrackStore  # noqa: E402
+
+CONSONANTS = 'bcdfghjklmnprstvwz'
+VOWELS = 'aeiouyéü'
+BUDGET_MS = 16.0
+
+
+def vocabulary(rng, size):
+    words = set()
+    while len(words) < size:
+        words.add(''.join(rng.choice(CONSONANTS) + rng.choice(VOWELS) for _ in range(rng.randint(1, 4))))
+    return sorted(words)
+
+
+def synthesize(count, seed=1):
+    """ Track ids, title and file name texts, artists and albums with word frequencies following Zipf's law. """
+    rng = random.Random(seed)
+    words = vocabulary(rng, max(100, count // 8))
+    rng.shuffle(words)
+    weights = list(accumulate(1.0 / rank for rank in range(1, len(words) + 1)))
+
+    def phrase(most):
+        return ' '.join(rng.choices(words, cum_weights=weights, k=rng.randint(1, most))).title()
+
+    artists = [phrase(2) for _ in range(max(1, count // 40))]
+    albums = [phrase(3) for _ in range(max(1, count // 12))]
+    titles = [phrase(5) for _ in range(count)]
+    store = TrackStore()
+    store.append(['/music/%02d %s.mp3' % (row % 20 + 1, title) for row, title in enumerate(titles)],
+                 titles=titles, artists=[rng.choice(artists) for _ in range(count)],
+                 albums=[rng.choice(albums) for _ in range(count)])
+    pick = lambda rank: words[min(rank, len(words) - 1)]
+    queries = [pick(0), pick(3), pick(40), pick(400), pick(4000), '%s %s' % (pick(1), pick(30)),
+               '%s %s' % (words[10], words[2000]), words[5][:2] + ' ' + words[9][:2], 'qqqx']
+    return store, queries
+
+
+def main(count):
+    store, queries = synthesize(count)
+    index = SearchIndex()
+    started = time.perf_counter()
+    rows = range(len(store))
+    index.add(store.ids, ['%s %s' % (store.titles[row], os.path.basename(store.paths[row])) for row in rows],
+              ([store.artist(row) for row in rows], [store.album(row) for row in rows]))
+    print('%d tracks, %d words indexed in %.2f s' % (count, len(index), time.perf_counter() - started))
+
+    everything = []
+    for query in queries:
+        index.forget()
+        rows = None
+        latencies = []
+        for length in range(1, len(query) + 1):
+            started = time.perf_counter()
+            matches = index.search(query[:length])
+            if matches is None:
+                rows = range(len(store))
+            elif not index.unchanged:
+                rows = store.rowsOf(matches)
+            latencies.append((time.perf_counter() - started) * 1000)
+        everything.extend(latencies)
+        print('%-22s %7d rows  mean %6.2f ms  max %6.2f ms'
+              % (repr(query), len(rows), sum(latencies) / len(latencies), max(latencies)))
+    everything.sort()
+    p95 = everything[int(len(everything) * 0.95)]
+    print('%d keystrokes: median %.2f ms, p95 %.2f ms, max %.2f ms (budget %.0f ms): %s'
+          % (len(everything), everything[len(everything) // 2], p95, everything[-1], BUDGET_MS,
+             'ok' if p95 <= BUDGET_MS else 'SLOW'))
+    return 0 if p95 <= BUDGET_MS else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main(int(sys.argv[1]) if len(sys.argv) > 1 else 200000))
@@ -0,0 +1,104 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+""" Synthetic music library on disk: tagged MP3 files in artist/album folders and M3U playlists.
+
+The files are tiny but real, an ID3v2.4 tag with title, artist, album and length followed by one
+silent MPEG frame, so the tag reader, the scanner and the playlist loader all do their usual work.
+Words follow Zipf's law like real titles. A finished library is reused by later runs.
+
+Usage: python benchmarks/SyntheticLibrary.py directory tracks
+"""
+import os
+import random
+import sys
+from itertools import accumulate
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from SearchBenchmark import vocabulary  # noqa: E402
+
+TRACKS_PER_ALBUM = 12
+ALBUMS_PER_ARTIST = 4
+# MPEG-1 layer III, 128 kbit/s, 44.1 kHz: 417 byte frames
+MPEG_FRAME = b'\xff\xfb\x90\x64' + bytes(413)
+MARKER = '.complete'
+
+
+def syncsafeBytes(size):
+    return bytes(((size >> 21) & 0x7f, (size >> 14) & 0x7f, (size >> 7) & 0x7f, size & 0x7f))
+
+
+def id3Frame(frameId, text):
+    data = b'\x03' + text.encode('utf-8')
+    return frameId.encode('latin-1') + syncsafeBytes(len(data)) + b'\x00\x00' + data
+
+
+def id3Tag(title, artist, album, duration):
+    frames = (id3Frame('TIT2', title) + id3Frame('TPE1', artist) + id3Frame('TALB', album)
+              + id3Frame('TLEN', str(duration)))
+    return b'ID3\x04\x00\x00' + syncsafeBytes(len(frames)) + frames
+
+
+def safeName(text):
+    return ''.join(char if char.isalnum() or char in ' -' else '_' for char in text).strip() or '_'
+
+
+def buildLibrary(directory, count, seed=1):
+    """ Create count tracks below directory/music and playlists below directory/playlists.
+
+    Returns the path of the M3U playlist holding every track.
+    """
+    music = os.path.join(directory, 'music')
+    playlists = os.path.join(directory, 'playlists')
+    everything = os.path.join(playlists, 'All Tracks.m3u')
+    marker = os.path.join(directory, MARKER)
+    if os.path.exists(marker):
+        with open(marker) as markerFile:
+            if markerFile.read().strip() == '%d %d' % (count, seed):
+                return everything
+
+    rng = random.Random(seed)
+    words = vocabulary(rng, max(100, count // 8))
+    rng.shuffle(words)
+    weights = list(accumulate(1.0 / rank for rank in range(1, len(words) + 1)))
+
+    def phrase(most):
+        return ' '.join(rng.choices(words, cum_weights=weights, k=rng.randint(1, most))).title()
+
+    os.makedirs(playlists, exist_ok=True)
+    entries = []
+    albumCount = (count + TRACKS_PER_ALBUM - 1) // TRACKS_PER_ALBUM
+    artists = [phrase(2) for _ in range(max(1, albumCount // ALBUMS_PER_ARTIST))]
+    for albumNumber in range(albumCount):
+        artist = artists[albumNumber % len(artists)]
+        album = phrase(3)
+        folder = os.path.join(music, safeName(artist), '%s (%d)' % (safeName(album), albumNumber))
+        os.makedirs(folder, exist_ok=True)
+        first = albumNumber * TRACKS_PER_ALBUM
+        for trackNumber in range(1, min(TRACKS_PER_ALBUM, count - first) + 1):
+            title = phrase(5)
+            duration = rng.randint(90, 420) * 1000
+            path = os.path.join(folder, '%02d %s.mp3' % (trackNumber, safeName(title)))
+            with open(path, 'wb') as trackFile:
+                trackFile.write(id3Tag(title, artist, album, duration) + MPEG_FRAME)
+            entries.append((path, title, duration))
+
+    writeM3u(everything, entries)
+    # A few smaller playlists for the registry to find
+    for number in range(10):
+        writeM3u(os.path.join(playlists, 'Mix %d.m3u' % number), rng.sample(entries, min(len(entries), 200)))
+    with open(marker, 'w') as markerFile:
+        markerFile.write('%d %d\n' % (count, seed))
+    return everything
+
+
+def writeM3u(path, entries):
+    base = os.path.dirname(path)
+    with open(path, 'w', encoding='utf-8', newline='\n') as playlist:
+        playlist.write('#EXTM3U\n')
+        for trackPath, title, duration in entries:
+            playlist.write('#EXTINF:%d,%s\n%s\n' % (duration // 1000, title, os.path.relpath(trackPath, base)))
+
+
+if __name__ == '__main__':
+    print(buildLibrary(sys.argv[1], int(sys.argv[2])))